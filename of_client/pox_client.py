@@ -135,7 +135,8 @@ class BackendChannel(asynchat.async_chat):
             self.of_client.clear(switch)
         elif msg[0] == 'barrier':
             switch = msg[1]
-            self.of_client.barrier(switch)
+            xid = msg[2] if len(msg) > 2 else None
+            self.of_client.barrier(switch,xid)
         elif msg[0] == 'flow_stats_request':
             switch = msg[1]
             self.of_client.flow_stats_request(switch)
@@ -432,8 +433,8 @@ class POXClient(revent.EventMixin):
         except KeyError, e:
             print "WARNING:delete_flow: No connection to switch %d available" % switch
 
-    def barrier(self,switch):
-        b = of.ofp_barrier_request()
+    def barrier(self,switch,xid=None):
+        b = of.ofp_barrier_request(xid=xid)
         self.switches[switch]['connection'].send(b) 
 
     def flow_stats_request(self,switch):
@@ -597,6 +598,9 @@ class POXClient(revent.EventMixin):
             else:
                 raise RuntimeException("Unknown port status event")
 
+    def _handle_BarrierIn(self, event):
+        self.send_to_pyretic(['barrier_reply', event.dpid, event.ofp.xid])
+
     def _handle_FlowRemoved(self, event):
         dpid = event.connection.dpid
         ofp = event.ofp
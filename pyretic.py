@@ -29,6 +29,7 @@
 ################################################################################
 
 from pyretic.core.runtime import Runtime
+from pyretic.core.classifier_cache import ClassifierCache
 from pyretic.backend.backend import Backend
 import sys
 import threading
@@ -41,6 +42,8 @@ import os
 import logging
 from multiprocessing import Queue, Process
 import pyretic.core.util as util
+import pyretic.core.language as language
+import pyretic.core.classifier as classifier
 import yappi
 
 of_client = None
@@ -87,6 +90,25 @@ def parseArgs():
     op.add_option( '--mode', '-m', type='choice',
                      choices=['interpreted','i','reactive0','r0','proactive0','p0','proactive1','p1'], 
                      help = '|'.join( ['interpreted/i','reactive0/r0','proactiveN/pN for N={0,1}'] )  )
+    op.add_option( '--compiler', '-c', type='choice',
+                     choices=['classifier','fdd'],
+                     help = 'proactive compiler backend: classifier|fdd' )
+    op.add_option( '--provenance', type='choice',
+                     choices=['off','ids','full'],
+                     help = 'rule provenance kept for debugging: off|ids|full' )
+    op.add_option( '--classifier-cache', dest='classifier_cache',
+                     help = 'directory caching compiled classifiers across restarts' )
+    op.add_option( '--classifier-cache-size', dest='classifier_cache_size',
+                     type='int',
+                     help = 'bound on the classifier cache, in MB' )
+    op.add_option( '--eval-cache-size', dest='eval_cache_size', type='int',
+                     help = 'flows whose evaluation the interpreter remembers, 0 for none' )
+    op.add_option( '--codegen', action="store_true", dest="codegen",
+                     help = 'interpret the policy with generated code' )
+    op.add_option( '--update-delay', dest='update_delay', type='float',
+                     help = 'seconds to coalesce policy changes over before installing them' )
+    op.add_option( '--workers', dest='workers', type='int',
+                     help = 'processes evaluating packet-ins, 0 for none' )
     op.add_option( '--verbosity', '-v', type='choice',
                    choices=['low','normal','high','please-make-it-stop'],
                    default = 'low',
@@ -95,7 +117,11 @@ def parseArgs():
                    dest="enable_profile",
                    help = 'enable yappi multithreaded profiler' )
 
-    op.set_defaults(frontend_only=False,mode='reactive0',enable_profile=False)
+    op.set_defaults(frontend_only=False,mode='reactive0',enable_profile=False,
+                    compiler='classifier',provenance='off',
+                    classifier_cache=None,classifier_cache_size=64,
+                    eval_cache_size=10000,codegen=False,update_delay=0,
+                    workers=0)
     options, args = op.parse_args()
 
     return (op, options, args, kwargs_to_pass)
@@ -112,6 +138,8 @@ def main():
         options.mode = 'proactive0'
     elif options.mode == 'p1':
         options.mode = 'proactive1'
+    language.COMPILER = options.compiler
+    classifier.PROVENANCE = options.provenance
     try:
         module_name = args[0]
     except IndexError:
@@ -175,7 +203,13 @@ def main():
     logger.addHandler(handler)
     logger.setLevel(log_level)
     
-    runtime = Runtime(Backend(),main,path_main,kwargs,options.mode,options.verbosity)
+    cache = None
+    if options.classifier_cache:
+        cache = ClassifierCache(options.classifier_cache,
+                                options.classifier_cache_size * 1024 * 1024)
+    runtime = Runtime(Backend(),main,path_main,kwargs,options.mode,options.verbosity,
+                      cache,options.eval_cache_size,options.codegen,
+                      options.update_delay,options.workers)
     if not options.frontend_only:
         try:
             output = subprocess.check_output('echo $PYTHONPATH',shell=True).strip()
@@ -110,6 +110,8 @@ class BackendChannel(asynchat.async_chat):
             self.backend.runtime.handle_flow_stats_reply(msg[1],msg[2])
         elif msg[0] == 'flow_removed':
             self.backend.runtime.handle_flow_removed(msg[1], msg[2])
+        elif msg[0] == 'barrier_reply':
+            self.backend.runtime.handle_barrier_reply(msg[1], msg[2])
         else:
             print 'ERROR: Unknown msg from backend %s' % msg
         return
@@ -154,8 +156,8 @@ class Backend(object):
     def send_flow_stats_request(self,switch):
         self.send_to_OF_client(['flow_stats_request',switch])
 
-    def send_barrier(self,switch):
-        self.send_to_OF_client(['barrier',switch])
+    def send_barrier(self,switch,xid=None):
+        self.send_to_OF_client(['barrier',switch,xid])
 
     def inject_discovery_packet(self,dpid, port):
         self.send_to_OF_client(['inject_discovery_packet',dpid,port])
@@ -1,11 +1,26 @@
 
 from collections import deque
 import copy
+import heapq
+import itertools
+import struct
+
+try:
+    import numpy
+except ImportError:   # Classifier.eval_batch then looks packets up one by one
+    numpy = None
 
 ###############################################################################
 # Classifiers
 # an intermediate representation for proactive compilation.
 
+# How rules produced by composing classifiers record the rules they were
+# derived from, for get_rule_derivation_tree: 'full' keeps the parent rules
+# themselves, and thereby every intermediate rule of every intermediate
+# classifier; 'ids' keeps compact records in provenance_table; 'off' keeps
+# nothing.
+PROVENANCE = 'off'
+
 
 class Rule(object):
     """
@@ -17,10 +32,17 @@ class Rule(object):
     # modify, identity, and/or Controller/CountBucket/FwdBucket policies.
     # Actions is Rule are semantically meant to run in parallel
     # unlike OpenFlow rules.
+    prov = None   # id in provenance_table, when PROVENANCE is 'ids'
+
     def __init__(self,m,acts,parents=[],op="policy"):
         self.match = m
         self.actions = acts
-        self.parents = parents
+        if PROVENANCE == 'full' or op == "policy":
+            self.parents = parents
+        else:
+            self.parents = ()
+        if PROVENANCE == 'ids':
+            self.prov = provenance_table.record(op, parents)
         """ op is the operator which combined the parents of this rule. Set of
         values it can take:
         - a class name of type CombinatorPolicy (in particular: "negate",
@@ -57,14 +79,86 @@ class Rule(object):
             return None
         rv = set()
         for pkt in filtered_pkt:
-            for act in self.actions:
-                rv |= act.eval(pkt)
+            rv |= self.apply_actions(pkt)
         return rv
 
+    def apply_actions(self, pkt):
+        """
+        Return the union of the sets of packets produced by the actions of
+        this rule on pkt, without checking the match.
+        """
+        rv = set()
+        for act in self.actions:
+            rv |= act.eval(pkt)
+        return rv
+
+
+class ProvenanceTable(object):
+    """
+    Compact provenance for rules, used when PROVENANCE is 'ids'.  Every rule
+    gets an integer id, under which the table records the operator that
+    produced it and the ids of its parent rules (or, for a rule generated
+    directly from a policy, that policy).  Only the most recent size records
+    are kept, so memory stays bounded however much is compiled.
+    """
+    def __init__(self, size=100000):
+        self.size = size
+        self.records = [None] * size
+        self.ids = itertools.count()
+
+    def record(self, op, parents):
+        i = next(self.ids)
+        if op == "policy":
+            origin = parents[0] if parents else None
+        elif op == "empty_parallel":
+            origin = None
+        else:
+            origin = tuple(p.prov for p in parents)
+        self.records[i % self.size] = (i, op, origin)
+        return i
+
+    def lookup(self, i):
+        """ Return (op, origin) for rule id i, or None if overwritten. """
+        rec = self.records[i % self.size]
+        if rec is None or rec[0] != i:
+            return None
+        return rec[1:]
+
+provenance_table = ProvenanceTable()
+
+
+def get_provenance_tree(i, pre_spaces='', only_leaves=False):
+    """
+    Get the tree of operators and policies deriving the rule with
+    provenance id i.  Only leaf policies are recorded, so intermediate rules
+    are shown by their operator alone.
+    """
+    rec = None if i is None else provenance_table.lookup(i)
+    if rec is None:
+        return pre_spaces + "[provenance not recorded]\n"
+    (op, origin) = rec
+    extra_ind = '    '
+    output = ''
+    if op == "parallel" or op == "negate" or op == "sequential":
+        output += pre_spaces + '[operator ' + op + ']\n'
+        for pi in origin:
+            output += get_provenance_tree(pi, pre_spaces+extra_ind,
+                                          only_leaves)
+    elif op == "policy":
+        if origin:
+            output = pre_spaces + str(origin) + '\n'
+    elif op == "empty_parallel":
+        output = pre_spaces + "empty classifier\n"
+    else:
+        raise TypeError
+    return output
+
 
 def get_rule_derivation_tree(r, pre_spaces='', only_leaves=False):
     """ Get the tree of rules deriving the current rule."""
     assert isinstance(r, Rule)
+    if r.prov is not None:
+        return get_provenance_tree(r.prov, pre_spaces, only_leaves)
     op = r.op
     assert op in ["policy", "parallel", "empty_parallel",
                   "sequential", "negate"]
@@ -88,6 +182,354 @@ def get_rule_derivation_tree(r, pre_spaces='', only_leaves=False):
     return output
 
 
+class RuleIndex(object):
+    """
+    A tuple-space index over the rules of a classifier, used to find the
+    highest-priority rule matching a packet without trying every rule.
+
+    Rules are grouped by the shape of their match: the exact-match fields
+    they constrain, plus the prefix length of any srcip/dstip match.  Inside
+    a group every rule is hashed on the header values it requires, so a
+    lookup costs one hash probe per group.  Groups are visited in order of
+    their highest-priority rule, and the search stops as soon as no
+    remaining group can beat the best rule found so far.  Rules whose match
+    is not a plain match (e.g., a negated filter) are tried linearly.
+    """
+    ip_fields = ('srcip', 'dstip')
+
+    class Group(object):
+        def __init__(self, exact_fields, prefix_fields):
+            self.exact_fields = exact_fields
+            self.prefix_fields = prefix_fields
+            self.first = None
+            self.table = {}
+
+        def add(self, key, pos):
+            if not key in self.table:
+                self.table[key] = pos
+            if self.first is None:
+                self.first = pos
+
+        def probe(self, header, ip_ints):
+            key = [header.get(f) for f in self.exact_fields]
+            for (f, plen, mask) in self.prefix_fields:
+                v = ip_ints.get(f)
+                if v is None:
+                    return None
+                key.append(v & mask)
+            return self.table.get(tuple(key))
+
+    def __init__(self, rules):
+        from pyretic.core.language import identity, drop
+        self.rules = list(rules)
+        self.linear = []
+        groups = {}
+        for pos, rule in enumerate(self.rules):
+            m = rule.match
+            if m == drop:
+                continue
+            elif m == identity:
+                shape, key = ((), ()), ()
+            else:
+                shaped = self.shape_of(m)
+                if shaped is None:
+                    self.linear.append((pos, rule))
+                    continue
+                shape, key = shaped
+            try:
+                group = groups[shape]
+            except KeyError:
+                group = groups[shape] = self.Group(*shape)
+            group.add(key, pos)
+        self.groups = sorted(groups.values(), key=lambda g: g.first)
+        self.ip_fields_used = set()
+        for g in self.groups:
+            self.ip_fields_used |= set(f for (f, _, _) in g.prefix_fields)
+        self.batch = None
+
+    def __len__(self):
+        return len(self.rules)
+
+    def shape_of(self, m):
+        """
+        Return ((exact fields, prefix fields), key) for match m, or None if
+        m cannot be indexed.
+        """
+        from pyretic.core.language import match, _match
+        if not isinstance(m, match):
+            return None
+        if isinstance(m, _match):
+            fmap = m.map
+        else:
+            fmap = _match(**m.map).map
+        exact = []
+        prefix = []
+        for f in sorted(fmap.keys()):
+            v = fmap[f]
+            if f in self.ip_fields and v is not None:
+                mask = int(v.netmask)
+                prefix.append(((f, v.prefixlen, mask), int(v.network) & mask))
+            else:
+                exact.append((f, v))
+        key = tuple([v for (_, v) in exact] + [v for (_, v) in prefix])
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        shape = (tuple(f for (f, _) in exact), tuple(p for (p, _) in prefix))
+        return (shape, key)
+
+    def ip_ints(self, header):
+        from pyretic.core import util
+        ip_ints = {}
+        for f in self.ip_fields_used:
+            try:
+                ip_ints[f] = int(util.string_to_IP(header[f]))
+            except Exception:
+                pass
+        return ip_ints
+
+    def lookup(self, pkt):
+        """
+        Return the highest-priority rule matching pkt, or None.
+        """
+        header = pkt.header
+        ip_ints = self.ip_ints(header)
+        best = None
+        for group in self.groups:
+            if best is not None and group.first >= best:
+                break
+            pos = group.probe(header, ip_ints)
+            if pos is not None and (best is None or pos < best):
+                best = pos
+        for (pos, rule) in self.linear:
+            if best is not None and pos >= best:
+                break
+            if rule.match.eval(pkt):
+                best = pos
+                break
+        if best is None:
+            return None
+        return self.rules[best]
+
+
+class BatchIndex(object):
+    """
+    The tuple-space search of a RuleIndex, done for many packets at once with
+    numpy.
+
+    Packets are packed into integer columns, one per field some rule group
+    constrains: exact-match fields are coded as small integers, one per value
+    appearing in some rule (-1 for any other value), and srcip/dstip are the
+    address with bit 32 set when present.  Every group keeps its keys,
+    coded the same way, as a sorted array; the columns of all packets are
+    masked with the group's prefix masks and looked up in that array with
+    one searchsorted, and each packet keeps the highest-priority hit over
+    all groups.  Rules the RuleIndex tries linearly are still tried one by
+    one, on the packets they could take.
+    """
+    PRESENT = 1 << 32
+
+    class Group(object):
+        def __init__(self, columns, masks, rows):
+            rows.sort()
+            self.columns = columns
+            self.masks = numpy.array(masks, dtype=numpy.int64)
+            self.positions = numpy.array([pos for (_, pos) in rows],
+                                         dtype=numpy.int64)
+            self.keys = None
+            if columns:
+                self.keys = BatchIndex.as_rows(
+                    numpy.array([key for (key, _) in rows], dtype=numpy.int64))
+                order = numpy.argsort(self.keys, kind='mergesort')
+                self.keys = self.keys[order]
+                self.positions = self.positions[order]
+
+        def probe(self, packed):
+            """ Position of the rule of this group each packet hits, or -1. """
+            if not self.columns:
+                return numpy.repeat(self.positions[:1], len(packed))
+            probes = BatchIndex.as_rows(packed[:, self.columns] & self.masks)
+            i = numpy.searchsorted(self.keys, probes)
+            i = numpy.minimum(i, len(self.keys) - 1)
+            return numpy.where(self.keys[i] == probes, self.positions[i], -1)
+
+    @staticmethod
+    def as_rows(a):
+        """ View each row of a 2-d int64 array as one comparable value. """
+        a = numpy.ascontiguousarray(a)
+        return a.view(numpy.dtype((numpy.void, 8 * a.shape[1]))).ravel()
+
+    def __init__(self, index):
+        self.index = index
+        self.columns = []
+        self.codes = {}
+        column_of = {}
+        self.groups = []
+        for group in index.groups:
+            fields = ([(('exact', f), -1) for f in group.exact_fields] +
+                      [(('prefix', f), self.PRESENT | mask)
+                       for (f, _, mask) in group.prefix_fields])
+            for (f, _) in fields:
+                if not f in column_of:
+                    column_of[f] = len(self.columns)
+                    self.columns.append(f)
+                    if f[0] == 'exact':
+                        self.codes[f[1]] = {}
+            rows = []
+            for (key, pos) in group.table.iteritems():
+                row = []
+                for ((f, mask), v) in zip(fields, key):
+                    if f[0] == 'exact':
+                        codes = self.codes[f[1]]
+                        row.append(codes.setdefault(v, len(codes)))
+                    else:
+                        row.append(self.PRESENT | v)
+                rows.append((row, pos))
+            self.groups.append(self.Group([column_of[f] for (f, _) in fields],
+                                          [mask for (_, mask) in fields],
+                                          rows))
+
+    def pack(self, pkts):
+        """ One row of column values per packet. """
+        from pyretic.core import util
+        from pyretic.core.network import IPAddr
+        def code(codes, v):
+            try:
+                return codes.get(v, -1)
+            except TypeError:
+                return -1
+        def ip_int(v):
+            if isinstance(v, IPAddr):
+                return self.PRESENT | struct.unpack('!I', v.to_bytes())[0]
+            try:
+                return self.PRESENT | int(util.string_to_IP(v))
+            except Exception:
+                return 0
+        headers = [pkt.header for pkt in pkts]
+        packed = numpy.zeros((len(pkts), len(self.columns)), dtype=numpy.int64)
+        for (c, (kind, f)) in enumerate(self.columns):
+            if kind == 'exact':
+                codes = self.codes[f]
+                packed[:, c] = [code(codes, h.get(f)) for h in headers]
+            else:
+                packed[:, c] = [ip_int(h.get(f)) for h in headers]
+        return packed
+
+    def lookup(self, pkts):
+        """
+        Return the highest-priority rule matching each packet of pkts (None
+        for packets no rule matches), as RuleIndex.lookup would.
+        """
+        packed = self.pack(pkts)
+        none = len(self.index.rules)
+        best = numpy.full(len(pkts), none, dtype=numpy.int64)
+        for group in self.groups:
+            hit = group.probe(packed)
+            best = numpy.where((hit >= 0) & (hit < best), hit, best)
+
+        rules = self.index.rules
+        result = []
+        for (pkt, pos) in zip(pkts, best.tolist()):
+            if pos == none:
+                pos = None
+            for (lpos, rule) in self.index.linear:
+                if pos is not None and lpos >= pos:
+                    break
+                if rule.match.eval(pkt):
+                    pos = lpos
+                    break
+            result.append(None if pos is None else rules[pos])
+        return result
+
+
+class CoversIndex(object):
+    """
+    An index over a shadow-free list of rules that answers "is this rule
+    covered by some rule already in the index?" (cf. match.covers) without
+    comparing against every indexed rule.
+
+    Indexed matches are bucketed by shape: the non-IP fields they constrain
+    plus the prefix length of each srcip/dstip field.  A rule can only be
+    covered by a match whose fields are a subset of its own and whose IP
+    prefixes are no longer than its own, so only those buckets are probed,
+    each with a single hash lookup of the rule's values (IP values masked to
+    the bucket's prefix length).
+    """
+    ip_fields = ('srcip', 'dstip')
+
+    def __init__(self):
+        self.buckets = {}
+
+    def shape_of(self, m):
+        """
+        Return (shape, key) for a match, or None if m can't be indexed.
+        """
+        from pyretic.core.language import identity, match
+        if m is identity:
+            return (((), ()), ())
+        if not isinstance(m, match):
+            return None
+        exact = []
+        prefix = []
+        for f in sorted(m.map.keys()):
+            v = m.map[f]
+            if f in self.ip_fields:
+                try:
+                    prefix.append(((f, v.prefixlen), int(v.network)))
+                except AttributeError:
+                    return None
+            else:
+                exact.append((f, v))
+        key = tuple([v for (_, v) in exact] + [v for (_, v) in prefix])
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        shape = (tuple(f for (f, _) in exact), tuple(p for (p, _) in prefix))
+        return (shape, key)
+
+    def add(self, m, shaped):
+        """
+        Add the match of a rule that was kept, along with its shape_of.
+        """
+        from pyretic.core.language import drop
+        if m is drop:
+            return   # drop covers nothing
+        (shape, key) = shaped
+        self.buckets.setdefault(shape, set()).add(key)
+
+    def covers(self, m, shaped):
+        """
+        True if some indexed match covers m, whose shape_of is shaped.
+        """
+        from pyretic.core.language import drop
+        if m is drop:
+            return len(self.buckets) > 0
+        if ((), ()) in self.buckets:
+            return True
+        if shaped[0] == ((), ()):
+            return False
+        fmap = m.map
+        for ((exact, prefix), keys) in self.buckets.iteritems():
+            probe = []
+            for f in exact:
+                if not f in fmap:
+                    break
+                probe.append(fmap[f])
+            else:
+                for (f, plen) in prefix:
+                    v = fmap.get(f)
+                    if v is None or v.prefixlen < plen:
+                        break
+                    mask = (0xffffffff << (32 - plen)) & 0xffffffff
+                    probe.append(int(v.network) & mask)
+                else:
+                    if tuple(probe) in keys:
+                        return True
+        return False
+
+
 # Classifier -> match -> rule
 def get_rule_exact_match(classifier, mat):
     """ Get a rule from the classifier with a given match. """
@@ -115,6 +557,9 @@ class Classifier(object):
             self.rules = new_rules
         else:
             raise TypeError
+        self._index = None
+        self._covers_index = None
+        self._shadow_free = 0
 
     def __len__(self):
         return len(self.rules)
@@ -140,13 +585,43 @@ class Classifier(object):
         highest priority.  Return the set of packets resulting from applying
         the actions of the first rule that matches.
         """
-        for rule in self.rules:
-            pkts = rule.eval(in_pkt)
-            if pkts is not None:
-                return pkts
-        raise TypeError('Classifier is not total.')
+        rule = self.index().lookup(in_pkt)
+        if rule is None:
+            raise TypeError('Classifier is not total.')
+        return rule.apply_actions(in_pkt)
+
+    def eval_batch(self, in_pkts):
+        """
+        Evaluate each of a list of packets, as [self.eval(p) for p in
+        in_pkts] would.  With numpy, the first matching rule of every packet
+        is found at once, see BatchIndex.
+        """
+        index = self.index()
+        if numpy is None:
+            rules = [index.lookup(pkt) for pkt in in_pkts]
+        else:
+            if index.batch is None:
+                index.batch = BatchIndex(index)
+            rules = index.batch.lookup(in_pkts)
+        results = []
+        for (pkt, rule) in zip(in_pkts, rules):
+            if rule is None:
+                raise TypeError('Classifier is not total.')
+            results.append(rule.apply_actions(pkt))
+        return results
+
+    def index(self):
+        """
+        Return the RuleIndex for the current rules, (re)building it if the
+        rules have changed since it was last built.
+        """
+        if self._index is None or len(self._index) != len(self.rules):
+            self._index = RuleIndex(self.rules)
+        return self._index
 
     def prepend(self, item):
+        self._index = None
+        self._covers_index = None
         if isinstance(item, Rule):
             self.rules.appendleft(item)
         elif isinstance(item, Classifier):
@@ -155,6 +630,7 @@ class Classifier(object):
             raise TypeError            
 
     def append(self, item):
+        self._index = None
         if isinstance(item, Rule):
             self.rules.append(item)
         elif isinstance(item, Classifier):
@@ -163,7 +639,10 @@ class Classifier(object):
             raise TypeError
 
     def remove_last_rule(self):
+        self._index = None
         self.rules.pop()
+        if len(self.rules) < self._shadow_free:
+            self._covers_index = None
 
     def __copy__(self):
         copied_rules = map(copy.copy,self.rules)
@@ -175,16 +654,13 @@ class Classifier(object):
         from pyretic.core.language import identity
         new_rules = list()
         for r in self.rules:
-            r_new = copy.copy(r)
             if len(r.actions) == 0:
-                r_new.actions = {identity}
+                actions = {identity}
             elif r.actions == {identity}:
-                r_new.actions = set()
+                actions = set()
             else:
                 raise TypeError  # TODO MAKE A CompileError TYPE
-            r_new.parents = [r]
-            r_new.op = "negate"
-            new_rules.append(r_new)
+            new_rules.append(Rule(r.match, actions, [r], "negate"))
         c = Classifier(new_rules)
         return c
 
@@ -192,7 +668,7 @@ class Classifier(object):
     ### PARALLEL COMPOSITION
             
     def __add__(c1, c2):
-        from pyretic.core.language import drop, identity
+        from pyretic.core.language import drop, identity, match
         def _cross(r1,r2):
             intersection = r1.match.intersect(r2.match)
             if intersection != drop:
@@ -201,13 +677,65 @@ class Classifier(object):
             else:
                 return None
 
+        # the exact-match value of field f in rule r, or None if r doesn't
+        # constrain f (IP prefixes are never treated as exact)
+        def _exact_value(r, f):
+            if isinstance(r.match, match):
+                return r.match.map.get(f)
+            return None
+
+        # pick the field whose exact values rule out the most pairs
+        def _partition_field():
+            counts = {}
+            unusable = set(['srcip', 'dstip'])
+            for (i, c) in enumerate([c1, c2]):
+                for r in c.rules:
+                    if not isinstance(r.match, match):
+                        continue
+                    for f, v in r.match.map.iteritems():
+                        if f in unusable:
+                            continue
+                        try:
+                            hash(v)
+                        except TypeError:
+                            unusable.add(f)
+                            continue
+                        counts.setdefault(f, [0, 0])[i] += 1
+            best, best_pairs = None, 0
+            for f, (n1, n2) in counts.iteritems():
+                if f not in unusable and n1 * n2 > best_pairs:
+                    best, best_pairs = f, n1 * n2
+            return best
+
         # start with an empty set of rules for the output classifier
         c3 = Classifier()
         assert(not (c1 is None and c2 is None))
         # then cross all pairs of rules in the first and second classifiers
+        # that can overlap.  Rules of c2 are bucketed by their value on the
+        # partition field; a rule of c1 with value v on that field only
+        # needs crossing with c2's bucket for v and with the c2 rules that
+        # don't constrain the field.  Candidates are visited in c2's order so
+        # the output priorities are the same as for the full cross product.
+        rules2 = list(c2.rules)
+        field = _partition_field()
+        if field is not None:
+            buckets = {}
+            wild = []
+            for (pos, r2) in enumerate(rules2):
+                v = _exact_value(r2, field)
+                if v is not None:
+                    buckets.setdefault(v, []).append(pos)
+                elif r2.match != drop:
+                    wild.append(pos)
+        all_pos = range(len(rules2))
         for r1 in c1.rules:
-            for r2 in c2.rules:
-                crossed_r = _cross(r1,r2)
+            v = None if field is None else _exact_value(r1, field)
+            if v is None:
+                candidates = all_pos
+            else:
+                candidates = heapq.merge(buckets.get(v, []), wild)
+            for pos in candidates:
+                crossed_r = _cross(r1,rules2[pos])
                 if crossed_r:
                     c3.append(crossed_r)
         # if the classifier is empty, add a drop-all rule
@@ -276,9 +804,9 @@ class Classifier(object):
                     elif a2 == identity:
                         new_actions.add(a1)
                     elif isinstance(a2, modify):
-                        new_a1 = modify(**a1.map.copy())
-                        new_a1.map.update(a2.map)
-                        new_actions.add(new_a1)
+                        new_map = a1.map.copy()
+                        new_map.update(a2.map)
+                        new_actions.add(modify(**new_map))
                     else:
                         raise TypeError
                 return new_actions
@@ -352,6 +880,37 @@ class Classifier(object):
 
     def remove_shadowed_cover_single(self):
         # Eliminate every rule completely covered by some higher priority rule
+        #
+        # A classifier produced by this method keeps the CoversIndex of its
+        # rules.  Rules appended to it later (as __rshift__'s _cross does
+        # between repeated optimizations) are then checked against that
+        # index, and only the appended rules need to be examined; the index
+        # is handed over to the new classifier rather than shared.
+        index = self._covers_index
+        start = self._shadow_free if index is not None else 0
+        self._covers_index = None
+        if index is None:
+            index = CoversIndex()
+        from pyretic.core.language import drop
+        rules = list(self.rules)
+        shapes = []
+        for r in rules[start:]:
+            shaped = index.shape_of(r.match)
+            if shaped is None and not r.match is drop:
+                return self.remove_shadowed_cover_linear()
+            shapes.append(shaped)
+        opt_c = Classifier(rules[:start])
+        for (r, shaped) in zip(rules[start:], shapes):
+            if not index.covers(r.match, shaped):
+                index.add(r.match, shaped)
+                opt_c.rules.append(r)
+        opt_c._covers_index = index
+        opt_c._shadow_free = len(opt_c.rules)
+        return opt_c
+
+    def remove_shadowed_cover_linear(self):
+        # Eliminate every rule completely covered by some higher priority
+        # rule, comparing each rule against every rule kept so far
         opt_c = Classifier()
         for r in self.rules:
             if not reduce(lambda acc, new_r: acc or
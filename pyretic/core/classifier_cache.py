@@ -0,0 +1,330 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+An on-disk cache of compiled classifiers and of the concretized rule lists the
+runtime installs from them, so that a restarted controller running the same
+policy on the same topology can skip compilation.
+
+Entries are content-addressed: the key is a hash of the structure of the policy
+(see fingerprint), of the topology and of the compiler settings. Queries and
+buckets are live objects that cannot be stored, so they are written as their
+position in a depth-first walk of the policy and bound back to the buckets of
+the policy being loaded for.
+"""
+
+import hashlib
+import logging
+import os
+import cPickle as pickle
+import zlib
+
+import pyretic.core.language as language
+from pyretic.core.language import (identity, drop, Controller, match, modify,
+                                   Query, CombinatorPolicy, DerivedPolicy,
+                                   match_table)
+from pyretic.core.classifier import Rule, Classifier
+
+FORMAT = 1   # bump whenever the encoding below changes
+
+
+class Uncacheable(Exception):
+    """ The policy or classifier contains something the cache can't store. """
+    pass
+
+
+def fingerprint(policy, queries):
+    """
+    Structural hash of a policy. Two policies built the same way from the same
+    fields and values get the same fingerprint, whatever the identity of their
+    buckets; the buckets themselves are appended to queries in the order the
+    walk meets them.
+
+    :param policy: the policy to hash
+    :type policy: Policy
+    :param queries: list the policy's queries are appended to
+    :type queries: list
+    :rtype: string
+    """
+    h = hashlib.sha1()
+    positions = {}
+    def visit(p):
+        if p is identity or p is drop or p is Controller:
+            h.update(repr(p))
+        elif isinstance(p, Query):
+            if not id(p) in positions:
+                positions[id(p)] = len(queries)
+                queries.append(p)
+            h.update('%s#%d' % (p.__class__.__name__, positions[id(p)]))
+        elif isinstance(p, (match, modify)):
+            h.update('%s%r' % (p.__class__.__name__, sorted(p.map.items())))
+        elif isinstance(p, CombinatorPolicy):
+            h.update('%s(%d' % (p.__class__.__name__, len(p.policies)))
+            for sub_policy in p.policies:
+                visit(sub_policy)
+            h.update(')')
+        elif isinstance(p, match_table):
+            h.update('%s%r(%d' % (p.__class__.__name__, p.fields, len(p.table)))
+            for key in sorted(p.table, key=repr):
+                h.update(repr(key))
+                visit(p.table[key])
+            visit(p.default)
+            h.update(')')
+        elif isinstance(p, DerivedPolicy):
+            h.update('%s[' % p.__class__.__name__)
+            visit(p.policy)
+            h.update(']')
+        else:
+            raise Uncacheable(p.__class__.__name__)
+    visit(policy)
+    return h.hexdigest()
+
+def topology_fingerprint(network):
+    """
+    Hash of the switches of a network and of their ports, including the
+    location each port links to.
+    """
+    topology = network.topology
+    switches = sorted((s, sorted(repr(p) for p in attrs['ports'].values()))
+                      for s, attrs in topology.nodes(data=True))
+    return hashlib.sha1(repr(switches)).hexdigest()
+
+def settings_fingerprint():
+    """ The global settings that change what compilation produces. """
+    from pyretic.core.runtime import virtual_field
+    fields = sorted((name, f.values)
+                    for name, f in virtual_field.fields.items())
+    return repr((FORMAT, language.COMPILER, fields))
+
+
+### ENCODING
+
+def encode_action(act, positions):
+    if act is identity or act is Controller:
+        return (repr(act),)
+    elif isinstance(act, Query):
+        try:
+            return ('query', positions[id(act)])
+        except KeyError:
+            raise Uncacheable('query not in policy')
+    elif isinstance(act, modify):
+        return ('modify', dict(act.map))
+    raise Uncacheable(act.__class__.__name__)
+
+def decode_action(act, queries):
+    if act[0] == 'identity':
+        return identity
+    elif act[0] == 'Controller':
+        return Controller
+    elif act[0] == 'query':
+        return queries[act[1]]
+    return modify(**act[1])
+
+def encode_classifier(classifier, positions):
+    rules = []
+    for r in classifier.rules:
+        if r.match is identity:
+            m = None
+        elif r.match is drop:
+            m = False
+        elif isinstance(r.match, match):
+            m = dict(r.match.map)
+        else:
+            raise Uncacheable(r.match.__class__.__name__)
+        rules.append((m, [encode_action(a, positions) for a in r.actions]))
+    return rules
+
+def decode_classifier(rules, queries):
+    def decode_match(m):
+        if m is None:
+            return identity
+        elif m is False:
+            return drop
+        return match(**m)
+    return Classifier(Rule(decode_match(m),
+                           set(decode_action(a, queries) for a in actions))
+                      for (m, actions) in rules)
+
+def encode_switch_rules(rules, positions):
+    """
+    Concretized rules are (match dict, priority, actions) tuples, whose
+    actions are dicts of plain values except for the buckets.
+    """
+    def encode(act):
+        if isinstance(act, Query):
+            return encode_action(act, positions)
+        return act
+    return [(m, priority, [encode(a) for a in actions])
+            for (m, priority, actions) in rules]
+
+def decode_switch_rules(rules, queries):
+    def decode(act):
+        if isinstance(act, tuple):
+            return queries[act[1]]
+        return act
+    return [(m, priority, [decode(a) for a in actions])
+            for (m, priority, actions) in rules]
+
+
+class ClassifierCache(object):
+    """
+    A directory of compiled classifiers and concretized rule lists, with the
+    least recently used entries evicted once the directory grows over max_bytes.
+
+    :param directory: where the entries are kept, created if needed
+    :type directory: string
+    :param max_bytes: bound on the total size of the entries
+    :type max_bytes: int
+    """
+    SUFFIX = '.cache'
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.log = logging.getLogger('%s.ClassifierCache' % __name__)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def entry(self, policy, network):
+        """
+        The cache entry of a policy running on a network, or None if the
+        policy can't be cached.
+
+        :rtype: CacheEntry
+        """
+        queries = []
+        try:
+            key = hashlib.sha1('%s %s %s' % (fingerprint(policy, queries),
+                                             topology_fingerprint(network),
+                                             settings_fingerprint()))
+        except Uncacheable as e:
+            self.log.debug('policy not cacheable: %s' % e)
+            return None
+        return CacheEntry(self, key.hexdigest(), queries)
+
+    def path(self, name):
+        return os.path.join(self.directory, name + self.SUFFIX)
+
+    def load(self, name):
+        path = self.path(name)
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.loads(zlib.decompress(f.read()))
+            os.utime(path, None)
+            return data
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            # A truncated or stale entry is as good as a miss.
+            self.log.warn('dropping unreadable cache entry %s: %s' % (path, e))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def store(self, name, data):
+        path = self.path(name)
+        tmp = '%s.%d' % (path, os.getpid())
+        try:
+            blob = zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+            with open(tmp, 'wb') as f:
+                f.write(blob)
+            os.rename(tmp, path)
+            self.evict(keep=path)
+        except Exception as e:
+            # The cache only saves time: failing to fill it must not stop the
+            # policy from being installed.
+            self.log.warn('not caching %s: %s' % (path, e))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def evict(self, keep=None):
+        """ Remove the least recently used entries until under max_bytes. """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class CacheEntry(object):
+    """
+    The cached artifacts of one (policy, topology) pair: its classifier and
+    the rules the runtime derives from it for the switches.
+    """
+    def __init__(self, cache, key, queries):
+        self.cache = cache
+        self.key = key
+        self.queries = queries
+        self.positions = {id(q): i for (i, q) in enumerate(queries)}
+
+    def load_classifier(self):
+        rules = self.cache.load(self.key + '-classifier')
+        if rules is None:
+            return None
+        return decode_classifier(rules, self.queries)
+
+    def store_classifier(self, classifier):
+        try:
+            rules = encode_classifier(classifier, self.positions)
+        except Uncacheable as e:
+            self.cache.log.debug('classifier not cacheable: %s' % e)
+            return
+        self.cache.store(self.key + '-classifier', rules)
+
+    def load_switch_rules(self):
+        rules = self.cache.load(self.key + '-rules')
+        if rules is None:
+            return None
+        return decode_switch_rules(rules, self.queries)
+
+    def store_switch_rules(self, rules):
+        try:
+            rules = encode_switch_rules(rules, self.positions)
+        except Uncacheable as e:
+            self.cache.log.debug('rules not cacheable: %s' % e)
+            return
+        self.cache.store(self.key + '-rules', rules)
@@ -0,0 +1,275 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+Generation of one Python function evaluating a whole policy, for the packet
+interpreter.
+
+Policy.eval walks the policy objects for every packet.  generate() instead
+translates the policy once into the source of a function in continuation
+passing style: a match becomes an if on the header fields, a modify an
+assignment, a sequential composition the nesting of its members, and a
+parallel composition its members one after the other, each passing the packets
+it produces on to the same continuation.  Policies it doesn't know how to
+translate (queries, policies overriding eval, subtrees nested too deep) are
+evaluated by calling their eval from the generated code.
+
+The function starts by checking that every DynamicPolicy it went through
+still holds the policy it was generated for, and that no virtual field was
+registered since; if not, it returns None and evaluator() generates the code
+anew.
+"""
+
+import itertools
+import struct
+
+from pyretic.core import util
+from pyretic.core.network import IPAddr, EthAddr
+from pyretic.core.language import (identity, drop, Controller, match,
+                                   modify, _modify, Query, negate, parallel,
+                                   sequential, DerivedPolicy, DynamicPolicy,
+                                   if_, overrides_eval)
+
+MAX_DEPTH = 60   # deeper subtrees are evaluated by eval, see Generator.gen
+
+MISSING = object()   # value of the fields a packet lacks
+PLAIN_TYPES = (int, long, str, unicode, bool, EthAddr, IPAddr)
+
+
+def ip_int(v):
+    """ The integer value of an IP address header, -1 if it isn't one. """
+    if isinstance(v, IPAddr):
+        return struct.unpack('!I', v.to_bytes())[0]
+    try:
+        return int(util.string_to_IP(v))
+    except Exception:
+        return -1
+
+def equal(pattern, header, field):
+    try:
+        return not pattern != header[field]
+    except Exception:
+        return False
+
+
+class Generator(object):
+    def __init__(self):
+        self.lines = []
+        self.constants = []
+        self.guards = []
+        self.names = itertools.count()
+
+    def const(self, value):
+        self.constants.append(value)
+        return 'c%d' % (len(self.constants) - 1)
+
+    def name(self, prefix):
+        return '%s%d' % (prefix, next(self.names))
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def block(self, depth, f):
+        """ Emit the body of a block with f, which must emit something. """
+        start = len(self.lines)
+        f(depth)
+        if len(self.lines) == start:
+            self.emit(depth, 'pass')
+
+    def gen(self, policy, p, depth, k):
+        """
+        Emit code applying policy to the packet in variable p, then k(q,
+        depth) to each packet q it produces.
+        """
+        if depth > MAX_DEPTH:
+            self.gen_eval(policy, p, depth, k)
+        elif policy is identity:
+            k(p, depth)
+        elif policy is drop or policy is Controller:
+            pass
+        elif isinstance(policy, Query):
+            self.gen_eval(policy, p, depth, k)
+        elif isinstance(policy, match) and not overrides_eval(policy, match):
+            self.gen_match(policy, p, depth, k)
+        elif isinstance(policy, _modify) and not overrides_eval(policy, _modify):
+            self.gen_modify(policy.map, p, depth, k)
+        elif isinstance(policy, modify) and not overrides_eval(policy, modify):
+            self.gen_modify(_modify(**policy.map).map, p, depth, k)
+        elif isinstance(policy, negate) and not overrides_eval(policy, negate):
+            hit = self.gen_test(policy.policies[0], p, depth)
+            self.emit(depth, 'if not %s:' % hit)
+            self.block(depth + 1, lambda d: k(p, d))
+        elif isinstance(policy, parallel) and not overrides_eval(policy,
+                                                                 parallel):
+            self.gen_parallel(policy.policies, p, depth, k)
+        elif (isinstance(policy, sequential) and
+              not overrides_eval(policy, sequential)):
+            self.gen_sequential(policy.policies, p, depth, k)
+        elif isinstance(policy, if_) and not overrides_eval(policy, if_):
+            hit = self.gen_test(policy.pred, p, depth)
+            self.emit(depth, 'if %s:' % hit)
+            self.block(depth + 1,
+                       lambda d: self.gen(policy.t_branch, p, d, k))
+            self.emit(depth, 'else:')
+            self.block(depth + 1,
+                       lambda d: self.gen(policy.f_branch, p, d, k))
+        elif (isinstance(policy, DynamicPolicy) and
+              not overrides_eval(policy, DerivedPolicy)):
+            self.guards.append((self.const(policy), self.const(policy.policy)))
+            self.gen(policy.policy, p, depth, k)
+        elif (isinstance(policy, DerivedPolicy) and
+              not overrides_eval(policy, DerivedPolicy)):
+            self.gen(policy.policy, p, depth, k)
+        else:
+            self.gen_eval(policy, p, depth, k)
+
+    def gen_eval(self, policy, p, depth, k):
+        q = self.name('p')
+        self.emit(depth, 'for %s in %s.eval(%s):' % (q, self.const(policy), p))
+        self.block(depth + 1, lambda d: k(q, d))
+
+    def gen_modify(self, fields, p, depth, k):
+        q = self.name('p')
+        self.emit(depth, '%s = %s.modifymany(%s)' % (q, p, self.const(fields)))
+        k(q, depth)
+
+    def gen_match(self, policy, p, depth, k):
+        h = self.name('h')
+        self.emit(depth, '%s = %s.header' % (h, p))
+        tests = []
+        for field, pattern in sorted(policy.translated_map().iteritems()):
+            if field in ['srcip', 'dstip']:
+                ip = self.name('ip')
+                self.emit(depth, '%s = ip_int(%s.get(%r))' % (ip, h, field))
+                if pattern is None:
+                    tests.append('%s < 0' % ip)
+                else:
+                    tests.append('%s >= 0 and %s & %d == %d' %
+                                 (ip, ip, int(pattern.netmask),
+                                  int(pattern.network)))
+            elif pattern is None:
+                tests.append('not %r in %s' % (field, h))
+            elif type(pattern) in PLAIN_TYPES:
+                tests.append('%s == %s.get(%r, MISSING)' %
+                             (self.const(pattern), h, field))
+            else:
+                tests.append('equal(%s, %s, %r)' %
+                             (self.const(pattern), h, field))
+        if not tests:
+            k(p, depth)
+            return
+        self.emit(depth, 'if %s:' % ' and '.join('(%s)' % t for t in tests))
+        self.block(depth + 1, lambda d: k(p, d))
+
+    def gen_test(self, policy, p, depth):
+        """
+        Emit code evaluating the filter policy on p, and return the name of a
+        list that ends up non-empty if the policy let the packet through.
+        """
+        hit = self.name('hit')
+        self.emit(depth, '%s = []' % hit)
+        self.gen(policy, p, depth, lambda q, d: self.emit(d, '%s.append(%s)' %
+                                                          (hit, q)))
+        return hit
+
+    def gen_parallel(self, policies, p, depth, k):
+        if len(policies) > 1:
+            # share the continuation between the members, as a local function
+            # if it takes more than a line
+            start = len(self.lines)
+            k(p, depth)
+            body = self.lines[start:]
+            del self.lines[start:]
+            if len(body) > 1:
+                f = self.name('k')
+                q = self.name('p')
+                self.emit(depth, 'def %s(%s):' % (f, q))
+                self.block(depth + 1, lambda d: k(q, d))
+                k = lambda q, d: self.emit(d, '%s(%s)' % (f, q))
+        for policy in policies:
+            self.gen(policy, p, depth, k)
+
+    def gen_sequential(self, policies, p, depth, k):
+        if not policies:
+            k(p, depth)
+            return
+        rest = policies[1:]
+        self.gen(policies[0], p, depth,
+                 lambda q, d: self.gen_sequential(rest, q, d, k))
+
+
+def generate(policy):
+    """
+    Return the source of a function evaluate(pkt) equivalent to policy.eval,
+    returning None once the policy changed, and the constants it refers to.
+    """
+    g = Generator()
+    p = g.name('p')
+    g.gen(policy, p, 1, lambda q, d: g.emit(d, 'out.add(%s)' % q))
+    guards = ['match.generation != %d' % match.generation]
+    guards += ['%s._policy is not %s' % guard for guard in g.guards]
+    lines = ['def evaluate(%s):' % p,
+             '    if %s:' % ' or '.join(guards),
+             '        return None',
+             '    out = set()'] + g.lines + ['    return out']
+    return ('\n'.join(lines) + '\n', g.constants)
+
+def compile_eval(policy):
+    """
+    Compile the function generate() produces for policy.  Policies too large
+    for Python to compile (too deeply nested) get a function calling their
+    eval, which checks for changes the same way.
+    """
+    generation = match.generation
+    try:
+        (source, constants) = generate(policy)
+        env = {'c%d' % i : c for (i, c) in enumerate(constants)}
+        env.update(match=match, ip_int=ip_int, equal=equal, MISSING=MISSING)
+        exec compile(source, '<codegen %s>' % policy.name(), 'exec') in env
+        return env['evaluate']
+    except (RuntimeError, SyntaxError, MemoryError):
+        def evaluate(pkt):
+            if match.generation != generation:
+                return None
+            return policy.eval(pkt)
+        return evaluate
+
+def evaluator(policy):
+    """
+    Return a function evaluating packets as policy.eval does, with code
+    generated for the policy, and generated again whenever the policy
+    changes.
+    """
+    state = [None]
+    def evaluate(pkt):
+        if state[0] is not None:
+            output = state[0](pkt)
+            if output is not None:
+                return output
+        state[0] = compile_eval(policy)
+        return state[0](pkt)
+    return evaluate
@@ -0,0 +1,538 @@
+import weakref
+
+from pyretic.core import util
+from pyretic.core.classifier import Rule, Classifier
+from pyretic.core.language import (identity, drop,
+                                   Controller, match, _match, modify, _modify,
+                                   Query, FwdBucket, PathBucket, CountBucket,
+                                   negate, parallel, sequential, DerivedPolicy,
+                                   match_table)
+import pyretic.core.language as language
+
+###############################################################################
+# Forwarding decision diagrams
+# an alternative intermediate representation for proactive compilation.
+#
+# An FDD is a binary decision diagram whose inner nodes test a single header
+# field (field == value, or field within a prefix for srcip/dstip) and whose
+# leaves hold the actions applied to the packets that reach them.  Tests
+# appear in one global order along every path and nodes are hash-consed, so
+# equal sub-diagrams are shared and composing two FDDs only visits the pairs
+# of nodes that can actually meet, rather than the cross product of two rule
+# lists.  A compiled FDD is turned back into a Classifier for installation.
+
+ip_fields = ('srcip', 'dstip')
+
+# the order in which fields are tested.  Testing the location first keeps the
+# rules for each switch together, and prefixes come early since they are
+# commonly shared by many rules that then differ on other fields.
+field_order = ['switch', 'inport', 'srcip', 'dstip', 'ethtype', 'protocol',
+               'srcport', 'dstport', 'srcmac', 'dstmac', 'tos', 'vlan_id',
+               'vlan_pcp', 'outport']
+
+
+class Leaf(object):
+    """
+    A leaf of an FDD: the parallel composition of the modifications in mods
+    (frozendicts of field assignments, the empty one being identity) and of
+    the policies in sinks (Controller and query buckets), which consume the
+    packet.  Leaves are unique; build them with leaf().
+    """
+    __slots__ = ['mods', 'sinks', '__weakref__']
+
+    def __init__(self, mods, sinks):
+        self.mods = mods
+        self.sinks = sinks
+
+    def __repr__(self):
+        return 'Leaf(%s)' % ', '.join(map(repr, list(self.mods) +
+                                          list(self.sinks)))
+
+
+class Node(object):
+    """
+    An inner node of an FDD: packets passing test go to hi, the others to
+    lo.  A test is a (field, value) pair.  Nodes are unique; build them with
+    node().
+    """
+    __slots__ = ['test', 'hi', 'lo', '__weakref__']
+
+    def __init__(self, test, hi, lo):
+        self.test = test
+        self.hi = hi
+        self.lo = lo
+
+    def __repr__(self):
+        return 'Node(%s=%s)' % self.test
+
+
+# unique tables, holding only the diagrams still referenced from elsewhere
+_leaves = weakref.WeakValueDictionary()
+_nodes = weakref.WeakValueDictionary()
+
+def leaf(mods=(), sinks=()):
+    mods = frozenset(mods)
+    by_id = dict((id(s), s) for s in sinks)
+    key = (mods, frozenset(by_id))
+    l = _leaves.get(key)
+    if l is None:
+        l = Leaf(mods, tuple(by_id[i] for i in sorted(by_id)))
+        _leaves[key] = l
+    return l
+
+def node(test, hi, lo):
+    if hi is lo:
+        return hi
+    key = (test, id(hi), id(lo))
+    n = _nodes.get(key)
+    if n is None:
+        n = Node(test, hi, lo)
+        _nodes[key] = n
+    return n
+
+ID = leaf([util.frozendict()])
+DROP = leaf()
+
+
+### TEST ORDER
+
+# test_key is memoized; as the order only depends on the tests, the memo can
+# be emptied whenever it grows past this many tests
+TEST_KEYS_SIZE = 65536
+_test_keys = {}
+
+def test_key(test):
+    """
+    The position of test in the global test order.  Tests are grouped by
+    field, and srcip/dstip prefixes are ordered from shortest to longest so
+    that every prefix is tested before the prefixes nested inside it.  Tests
+    of a field are then ordered by value, so that the order, and with it the
+    shape of the diagrams, doesn't depend on the tests compiled before.
+    """
+    try:
+        return _test_keys[test]
+    except KeyError:
+        pass
+    (f, v) = test
+    try:
+        rank = field_order.index(f)
+    except ValueError:
+        rank = len(field_order)
+    if f in ip_fields:
+        if v is None:
+            k = (rank, f, -1, 0)
+        else:
+            k = (rank, f, v.prefixlen, int(v.network))
+    elif isinstance(v, (int, long)):
+        k = (rank, f, 0, v)
+    else:
+        # MACs, for one, are told apart by their repr
+        k = (rank, f, 1, repr(v))
+    if len(_test_keys) >= TEST_KEYS_SIZE:
+        _test_keys.clear()
+    _test_keys[test] = k
+    return k
+
+def _implies(t, b, u):
+    """
+    Given that test t evaluated to b, return the value of test u on the same
+    field, or None if it could go either way.
+    """
+    v = t[1]
+    w = u[1]
+    if t[0] in ip_fields and v is not None and w is not None:
+        if b:
+            if v in w:
+                return True
+            elif w in v:
+                return None
+            else:
+                return False
+        else:
+            if w in v:
+                return False
+            return None
+    if b:
+        return v == w
+    elif v == w:
+        return False
+    return None
+
+def _holds(test, value):
+    """ Evaluate test on a header whose value is known to be value. """
+    (f, v) = test
+    if f in ip_fields and v is not None:
+        if value is None:
+            return False
+        return util.string_to_IP(value) in v
+    return v == value
+
+
+### LEAF OPERATIONS
+
+def _leaf_union(l1, l2):
+    if l1 is DROP:
+        return l2
+    elif l2 is DROP:
+        return l1
+    return leaf(l1.mods | l2.mods, l1.sinks + l2.sinks)
+
+def _leaf_guard(f, l):
+    # f is the leaf of a filter: ID lets l through, DROP doesn't
+    if f is ID:
+        return l
+    return DROP
+
+def _leaf_negate(l):
+    if l is DROP:
+        return ID
+    elif l is ID:
+        return DROP
+    else:
+        raise TypeError  # only filters can be negated
+
+
+### DIAGRAM OPERATIONS
+
+class _Apply(object):
+    """
+    A binary operation on FDDs, lifted from an operation on leaves.  Results
+    are memoized over the pairs of nodes visited, so an instance should only
+    be used for the duration of one top-level call.
+    """
+    def __init__(self, op):
+        self.op = op
+        self.memo = {}
+        self.restricted = {}
+
+    def __call__(self, d1, d2):
+        key = (id(d1), id(d2))
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        if isinstance(d1, Leaf):
+            if isinstance(d2, Leaf):
+                r = self.op(d1, d2)
+                self.memo[key] = r
+                return r
+            t = d2.test
+        elif isinstance(d2, Leaf):
+            t = d1.test
+        elif test_key(d1.test) <= test_key(d2.test):
+            t = d1.test
+        else:
+            t = d2.test
+        r = node(t,
+                 self(self.restrict(d1, t, True), self.restrict(d2, t, True)),
+                 self(self.restrict(d1, t, False), self.restrict(d2, t, False)))
+        self.memo[key] = r
+        return r
+
+    def restrict(self, d, t, b):
+        """
+        The part of d seen by packets on which test t evaluates to b.  t must
+        not come after the root test of d.
+        """
+        if isinstance(d, Leaf):
+            return d
+        u = d.test
+        if u == t:
+            return d.hi if b else d.lo
+        if u[0] != t[0]:
+            # every test below d is on a later field than t
+            return d
+        key = (id(d), t, b)
+        try:
+            return self.restricted[key]
+        except KeyError:
+            pass
+        implied = _implies(t, b, u)
+        if implied is True:
+            r = self.restrict(d.hi, t, b)
+        elif implied is False:
+            r = self.restrict(d.lo, t, b)
+        else:
+            r = node(u, self.restrict(d.hi, t, b), self.restrict(d.lo, t, b))
+        self.restricted[key] = r
+        return r
+
+def union(d1, d2):
+    """ Parallel composition of two FDDs. """
+    return _Apply(_leaf_union)(d1, d2)
+
+def _map_leaves(fn, d, memo):
+    try:
+        return memo[id(d)]
+    except KeyError:
+        pass
+    if isinstance(d, Leaf):
+        r = fn(d)
+    else:
+        r = node(d.test, _map_leaves(fn, d.hi, memo),
+                 _map_leaves(fn, d.lo, memo))
+    memo[id(d)] = r
+    return r
+
+def negation(d):
+    """ Negation of an FDD whose leaves are all ID or DROP. """
+    return _map_leaves(_leaf_negate, d, {})
+
+def _after(t, d):
+    # True if no test in d can depend on t, i.e. d may sit below t as is
+    return (isinstance(d, Leaf) or
+            (d.test[0] != t[0] and test_key(t) < test_key(d.test)))
+
+def guard(f, d):
+    """ d restricted to the packets passed by the filter FDD f. """
+    return _Apply(_leaf_guard)(f, d)
+
+def cond(t, hi, lo):
+    """ The FDD that behaves as hi where test t holds, and as lo elsewhere. """
+    if hi is lo:
+        return hi
+    if _after(t, hi) and _after(t, lo):
+        return node(t, hi, lo)
+    return union(guard(node(t, ID, DROP), hi), guard(node(t, DROP, ID), lo))
+
+
+class _Sequence(object):
+    """
+    Sequential composition of FDDs with a fixed right-hand side d2, memoized
+    over the nodes of the left-hand side.
+    """
+    def __init__(self, d2):
+        self.d2 = d2
+        self.memo = {}
+        self.specialized = {}
+
+    def __call__(self, d1):
+        try:
+            return self.memo[id(d1)]
+        except KeyError:
+            pass
+        if isinstance(d1, Leaf):
+            r = leaf((), d1.sinks)
+            for m in d1.mods:
+                r = union(r, self.specialize(m, self.d2))
+        else:
+            r = cond(d1.test, self(d1.hi), self(d1.lo))
+        self.memo[id(d1)] = r
+        return r
+
+    def specialize(self, m, d):
+        """ d applied after the modification m. """
+        key = (m, id(d))
+        try:
+            return self.specialized[key]
+        except KeyError:
+            pass
+        if isinstance(d, Leaf):
+            r = leaf([m.update(m2) for m2 in d.mods], d.sinks)
+        else:
+            f = d.test[0]
+            if f in m:
+                if _holds(d.test, m[f]):
+                    r = self.specialize(m, d.hi)
+                else:
+                    r = self.specialize(m, d.lo)
+            else:
+                r = node(d.test, self.specialize(m, d.hi),
+                         self.specialize(m, d.lo))
+        self.specialized[key] = r
+        return r
+
+def sequence(d1, d2):
+    """ Sequential composition of two FDDs. """
+    return _Sequence(d2)(d1)
+
+
+### POLICY -> FDD
+
+def from_match(m):
+    """ The filter FDD for a match with virtual fields already translated. """
+    tests = []
+    for (f, v) in m.map.iteritems():
+        tests.append((f, v))
+    tests.sort(key=test_key, reverse=True)
+    d = ID
+    for t in tests:
+        d = node(t, d, DROP)
+    return d
+
+def from_actions(actions):
+    """ The leaf for a set of classifier actions. """
+    mods = []
+    sinks = []
+    for act in actions:
+        while isinstance(act, DerivedPolicy):
+            act = act.policy
+        if act is identity:
+            mods.append(util.frozendict())
+        elif isinstance(act, modify):
+            if not isinstance(act, _modify):
+                act = _modify(**act.map)
+            mods.append(util.frozendict(act.map))
+        elif isinstance(act, FwdBucket) and not isinstance(act, PathBucket):
+            sinks.append(Controller)
+        elif (act is Controller or isinstance(act, CountBucket) or
+              isinstance(act, PathBucket)):
+            sinks.append(act)
+        else:
+            raise TypeError
+    return leaf(mods, sinks)
+
+def from_classifier(c):
+    """ The FDD equivalent to a (total) classifier. """
+    d = DROP
+    for r in reversed(c.rules):
+        if r.match is drop:
+            continue
+        actions = from_actions(r.actions)
+        if r.match is identity:
+            d = actions
+        elif isinstance(r.match, match):
+            f = from_match(_match(**r.match.map))
+            d = union(guard(f, actions), guard(negation(f), d))
+        else:
+            raise TypeError
+    return d
+
+def from_policy(policy):
+    """
+    Compile a policy to an FDD.  Sub-policies cache their FDD alongside their
+    classifier (see Policy.invalidate_classifier); nodes this module doesn't
+    know about are compiled to a classifier and converted.
+    """
+    d = getattr(policy, '_fdd', None)
+    if d is not None and not language.NO_CACHE:
+        return d
+    if policy is identity:
+        d = ID
+    elif policy is drop:
+        d = DROP
+    elif policy is Controller:
+        d = leaf((), [Controller])
+    elif isinstance(policy, match):
+        if not isinstance(policy, _match):
+            policy = _match(**policy.map)
+        d = from_match(policy)
+    elif isinstance(policy, modify):
+        d = from_actions([policy])
+    elif isinstance(policy, Query):
+        d = from_actions([policy])
+    elif isinstance(policy, negate):
+        d = negation(from_policy(policy.policies[0]))
+    elif isinstance(policy, parallel):
+        d = util.tree_reduce(union, map(from_policy, policy.policies))
+    elif isinstance(policy, sequential):
+        d = util.tree_reduce(sequence, map(from_policy, policy.policies))
+    elif isinstance(policy, match_table):
+        d = from_classifier(policy.generate_classifier())
+    elif isinstance(policy, DerivedPolicy):
+        d = from_policy(policy.policy)
+    else:
+        d = from_classifier(policy.generate_classifier())
+    try:
+        policy._fdd = d
+    except AttributeError:
+        pass
+    return d
+
+
+### FDD -> CLASSIFIER
+
+def to_classifier(d, policy=None):
+    """
+    The classifier for an FDD, with one rule per path to a leaf.  Paths are
+    emitted with the hi branch first, so a rule only has to match the tests
+    that passed along its path: packets failing any of them were caught by
+    an earlier rule.
+
+    A path's rule is left out when the packets matching it would get the
+    same actions from the rules after it anyway.  Those rules start with
+    the ones for the lo branch of the last node where the path went hi,
+    which give any packet matching the path the actions of that branch.
+    Rules dropped there let their packets fall through further, which is
+    why only the tests the rule matches on can be relied upon, not the
+    tests its path failed.
+    """
+    actions = {}
+    rules = []
+    stack = [(d, {}, None)]
+    while stack:
+        (d, path, fallback) = stack.pop()
+        if isinstance(d, Leaf):
+            if fallback is not None and _always(fallback, path, d):
+                continue
+            try:
+                acts = actions[d]
+            except KeyError:
+                acts = actions[d] = list(to_actions(d))
+            if path:
+                m = match(**path)
+            else:
+                m = identity
+            rules.append(Rule(m, set(acts), [policy]))
+        else:
+            (f, v) = d.test
+            hi_path = dict(path)
+            hi_path[f] = v  # nested prefixes: the last one is the narrowest
+            stack.append((d.lo, path, fallback))
+            stack.append((d.hi, hi_path, d.lo))
+    return Classifier(rules).optimize()
+
+def _always(d, path, l):
+    """
+    True if every packet passing the tests in path (a map from field to
+    value) reaches leaf l in d.
+    """
+    seen = set()
+    stack = [d]
+    while stack:
+        d = stack.pop()
+        if id(d) in seen:
+            continue
+        seen.add(id(d))
+        if isinstance(d, Leaf):
+            if d is not l:
+                return False
+            continue
+        f = d.test[0]
+        if f in path:
+            outcome = _implies((f, path[f]), True, d.test)
+        else:
+            outcome = None
+        if outcome is not False:
+            stack.append(d.hi)
+        if outcome is not True:
+            stack.append(d.lo)
+    return True
+
+def to_actions(l):
+    """ The classifier actions for a leaf. """
+    for m in l.mods:
+        if len(m) == 0:
+            yield identity
+        else:
+            yield modify(**dict(m.items()))
+    for s in l.sinks:
+        yield s
+
+def size(d):
+    """ The number of distinct nodes and leaves in an FDD. """
+    seen = set()
+    stack = [d]
+    while stack:
+        d = stack.pop()
+        if id(d) in seen:
+            continue
+        seen.add(id(d))
+        if isinstance(d, Node):
+            stack.append(d.hi)
+            stack.append(d.lo)
+    return len(seen)
+
+def compile_policy(policy):
+    """ Compile a policy to a classifier through its FDD. """
+    return to_classifier(from_policy(policy), policy)
@@ -34,6 +34,7 @@ import functools
 import itertools
 import struct
 import time
+import weakref
 from ipaddr import IPv4Network
 from bitarray import bitarray
 import logging
@@ -47,6 +48,10 @@ from multiprocessing import Lock, Condition
 import copy
 
 NO_CACHE=False
+COMPILER='classifier'   # or 'fdd', see Policy.backend_classifier
+PARALLEL_BY_SIZE=False  # compose the smallest parallel members first
+INCREMENTAL=False       # recompose only the members whose classifier changed
+INTERN=True             # share structurally equal match/modify/fwd, see Interned
 
 basic_headers = ["srcmac", "dstmac", "srcip", "dstip", "tos", "srcport", "dstport",
                  "ethtype", "protocol"]
@@ -60,6 +65,48 @@ content_headers = [ "raw", "header_len", "payload_len"]
 # Policy Language                                                              #
 ################################################################################
 
+def overrides_eval(policy, cls):
+    """ Whether policy evaluates packets otherwise than cls does. """
+    return type(policy).eval.im_func is not cls.eval.im_func
+
+
+def intern_items(*args, **kwargs):
+    """
+    The field values of a match or modify call as an intern key: equal
+    values of different types (1, 1L, True) build different policies.
+    """
+    return frozenset((f, type(v), v)
+                     for (f, v) in dict(*args, **kwargs).iteritems())
+
+
+class Interned(type):
+    """
+    Metaclass of the leaf policies that never change once built (match,
+    modify, fwd): building one structurally equal to a live instance returns
+    that instance, and so its classifier, instead of a new object.  Policies
+    thereby become DAGs sharing their equal leaves.  Classes name the
+    structure of a call with intern_key, which returns None for calls that
+    shouldn't be shared.  Interned policies must not be mutated.
+    """
+    table = weakref.WeakValueDictionary()
+
+    def __call__(cls, *args, **kwargs):
+        key = None
+        if INTERN:
+            try:
+                key = cls.intern_key(*args, **kwargs)
+                if key is not None:
+                    policy = Interned.table.get(key)
+                    if policy is not None:
+                        return policy
+            except TypeError:   # unhashable field values
+                key = None
+        policy = super(Interned, cls).__call__(*args, **kwargs)
+        if key is not None:
+            Interned.table[key] = policy
+        return policy
+
+
 class Policy(object):
     """
     Top-level abstract class for policies.
@@ -78,8 +125,19 @@ class Policy(object):
         """
         raise NotImplementedError
 
+    def eval_batch(self, pkts):
+        """
+        evaluate this policy on each of a list of packets
+
+        :param pkts: the packets on which to be evaluated
+        :type pkts: list Packet
+        :rtype: list (set Packet), the output of each packet in order
+        """
+        return [self.eval(pkt) for pkt in pkts]
+
     def invalidate_classifier(self):
         self._classifier = None
+        self._fdd = None
 
     def compile(self):
         """
@@ -91,6 +149,19 @@ class Policy(object):
             self._classifier = self.generate_classifier()
         return self._classifier
 
+    def backend_classifier(self):
+        """
+        Generate a Classifier for this policy with the compiler selected by
+        COMPILER: 'classifier' composes the rule lists of the sub-policies,
+        'fdd' goes through a forwarding decision diagram (pyretic.core.fdd).
+
+        :rtype: Classifier
+        """
+        if COMPILER == 'fdd':
+            from pyretic.core import fdd
+            return fdd.compile_policy(self)
+        return self.generate_classifier()
+
     def __add__(self, pol):
         """
         The parallel composition operator.
@@ -125,6 +196,19 @@ class Policy(object):
         """Syntactic inequality."""
         return not (self == other)
 
+    _hash = None   # (hash, dynamic), see hash_entry
+
+    def hash_entry(self):
+        """
+        The structural hash of this policy, consistent with ==, and whether
+        it depends on the current policy of some DynamicPolicy.  Combinators
+        and derived policies compute theirs from the hashes of their
+        sub-policies and cache it, until a DynamicPolicy they contain changes.
+
+        :rtype: (int, bool)
+        """
+        return (hash(self), False)
+
     def name(self):
         return self.__class__.__name__
 
@@ -240,6 +324,9 @@ class identity(Singleton):
         """
         return {pkt}
 
+    def eval_batch(self, pkts):
+        return [{pkt} for pkt in pkts]
+
     def intersect(self, other):
         return other
 
@@ -250,6 +337,10 @@ class identity(Singleton):
         return ( id(self) == id(other)
             or ( isinstance(other, match) and len(other.map) == 0) )
 
+    def __hash__(self):
+        # equal to match(), see match.__hash__
+        return hash(util.frozendict())
+
     def __repr__(self):
         return "identity"
 
@@ -271,6 +362,9 @@ class drop(Singleton):
         """
         return set()
 
+    def eval_batch(self, pkts):
+        return [set() for pkt in pkts]
+
     def generate_classifier(self):
         return Classifier([Rule(identity,set(),[self])])
 
@@ -310,6 +404,17 @@ class match(Filter):
     :param *args: field matches in argument format
     :param **kwargs: field matches in keyword-argument format
     """
+    __metaclass__ = Interned
+
+    # Bumped whenever a virtual field is registered, which changes how matches
+    # on virtual fields translate, to have every match recompile its evaluator.
+    generation = 0
+    _evaluator = None
+
+    @classmethod
+    def intern_key(cls, *args, **kwargs):
+        return (cls, match.generation, intern_items(*args, **kwargs))
+
     def __init__(self, *args, **kwargs):
 
         def _get_processed_map(*args, **kwargs):
@@ -334,7 +439,80 @@ class match(Filter):
         :type pkt: Packet
         :rtype: set Packet
         """
-        return _match(**self.map).eval(pkt)
+        return self.evaluator()(pkt)
+
+    def eval_batch(self, pkts):
+        if overrides_eval(self, match):
+            return super(match, self).eval_batch(pkts)
+        evaluate = self.evaluator()
+        return [evaluate(pkt) for pkt in pkts]
+
+    def evaluator(self):
+        """ The function compile_eval returned, for the current fields. """
+        evaluator = self._evaluator
+        if evaluator is None or evaluator[0] != match.generation:
+            evaluator = self._evaluator = (match.generation,
+                                           self.compile_eval())
+        return evaluator[1]
+
+    def translated_map(self):
+        """ The fields matched on, with virtual fields mapped to VLAN tags. """
+        return _match(**self.map).map
+
+    def compile_eval(self):
+        """
+        Return a function evaluating this match on a packet, with the virtual
+        fields translated and the IP prefixes parsed to integer network/mask
+        pairs once, rather than on every packet.
+        """
+        equal = []
+        absent = []
+        prefixes = []
+        ip_absent = []
+        for field, pattern in self.translated_map().iteritems():
+            if field in ['srcip', 'dstip']:
+                if pattern is None:
+                    ip_absent.append(field)
+                else:
+                    prefixes.append((field, int(pattern.network),
+                                     int(pattern.netmask)))
+            elif pattern is None:
+                absent.append(field)
+            else:
+                equal.append((field, pattern))
+
+        def ip_int(v):
+            if isinstance(v, IPAddr):
+                return struct.unpack('!I', v.to_bytes())[0]
+            return int(util.string_to_IP(v))
+
+        def evaluate(pkt):
+            header = pkt.header
+            for (field, pattern) in equal:
+                try:
+                    if pattern != header[field]:
+                        return set()
+                except Exception:
+                    return set()
+            for field in absent:
+                if field in header:
+                    return set()
+            for (field, network, mask) in prefixes:
+                try:
+                    if ip_int(header[field]) & mask != network:
+                        return set()
+                except Exception:
+                    return set()
+            for field in ip_absent:
+                # Like a missing field, a value that isn't an IP address
+                # matches None.
+                try:
+                    ip_int(header[field])
+                    return set()
+                except Exception:
+                    pass
+            return {pkt}
+        return evaluate
 
     def generate_classifier(self):
         return _match(**self.map).generate_classifier()
@@ -429,6 +607,10 @@ class match(Filter):
         return "match: %s" % ' '.join(map(str,self.map.items()))
 
 class _match(match):
+    @classmethod
+    def intern_key(cls, *args, **kwargs):
+        return None
+
     def __init__(self, *args, **kwargs):
         super(_match,self).__init__(*args, **kwargs)
 
@@ -439,21 +621,8 @@ class _match(match):
         r2 = Rule(identity,set(),[None])
         return Classifier([r1, r2])
 
-    def eval(self,pkt):
-        for field, pattern in self.map.iteritems():
-            try:
-                v = pkt[field]
-                if not field in ['srcip', 'dstip']:
-                    if pattern is None or pattern != v:
-                        return set()
-                else:
-                    v = util.string_to_IP(v)
-                    if pattern is None or not v in pattern:
-                        return set()
-            except Exception, e:
-                if pattern is not None:
-                    return set()
-        return {pkt}
+    def translated_map(self):
+        return self.map
 
     def translate_virtual_fields(self):
         from pyretic.core.runtime import virtual_field
@@ -479,6 +648,13 @@ class modify(Policy):
     :param *args: field assignments in argument format
     :param **kwargs: field assignments in keyword-argument format
     """
+    __metaclass__ = Interned
+    _map_hash = None
+
+    @classmethod
+    def intern_key(cls, *args, **kwargs):
+        return (cls, match.generation, intern_items(*args, **kwargs))
+
     ### init : List (String * FieldVal) -> List KeywordArg -> unit
     def __init__(self, *args, **kwargs):
         #TODO(Josh, Cole): why this check is here?
@@ -503,6 +679,11 @@ class modify(Policy):
         """
         return _modify(**self.map).eval(pkt)
 
+    def eval_batch(self, pkts):
+        if overrides_eval(self, modify):
+            return super(modify, self).eval_batch(pkts)
+        return _modify(**self.map).eval_batch(pkts)
+
     def generate_classifier(self):
         return _modify(**self.map).generate_classifier()
 
@@ -513,11 +694,29 @@ class modify(Policy):
         return ( isinstance(other, modify)
            and (self.map == other.map) )
 
+    def __hash__(self):
+        if self._map_hash is None:
+            try:
+                self._map_hash = hash(frozenset(self.map.iteritems()))
+            except TypeError:   # unhashable field values
+                self._map_hash = hash('modify')
+        return self._map_hash
+
+    def __deepcopy__(self, memo):
+        # Built anew: copying the classifier would hash the copy, which holds
+        # it in a set of actions, before its map is copied.
+        return self.__class__(**self.map)
+
 class _modify(modify):
+    @classmethod
+    def intern_key(cls, *args, **kwargs):
+        return None
+
     def __init__(self, *args, **kwargs):
         super(_modify,self).__init__(*args, **kwargs)
         # Translate virtual-fields
         self.map = self.translate_virtual_fields()
+        self._map_hash = None
 
     def generate_classifier(self):
         r = Rule(identity,{self},[self])
@@ -526,6 +725,11 @@ class _modify(modify):
     def eval(self,pkt):
         return {pkt.modifymany(self.map)}
 
+    def eval_batch(self, pkts):
+        if overrides_eval(self, _modify):
+            return super(_modify, self).eval_batch(pkts)
+        return [{pkt.modifymany(self.map)} for pkt in pkts]
+
     def translate_virtual_fields(self):
         from pyretic.core.runtime import virtual_field
         _map = {}
@@ -1091,6 +1295,18 @@ class CountBucket(Query):
         # be on names.
         return id(self) == id(other)
 
+
+def combined_hash_entry(cls, policies):
+    """ The hash entry of a policy of class cls over the given sub-policies. """
+    hashes = [cls.__name__]
+    dynamic = False
+    for policy in policies:
+        (h, d) = policy.hash_entry()
+        hashes.append(h)
+        dynamic = dynamic or d
+    return (hash(tuple(hashes)), dynamic)
+
+
 ################################################################################
 # Combinator Policies                                                          #
 ################################################################################
@@ -1106,6 +1322,9 @@ class CombinatorPolicy(Policy):
     def __init__(self, policies=[]):
         self.policies = list(policies)
         self._classifier = None
+        self._reduction = None
+        self._hash = combined_hash_entry(self.__class__, self.policies)
+        self._hash_generation = DynamicPolicy.generation
         super(CombinatorPolicy,self).__init__()
 
     def compile(self):
@@ -1115,17 +1334,68 @@ class CombinatorPolicy(Policy):
         :rtype: Classifier
         """
         if NO_CACHE: 
-            self._classifier = self.generate_classifier()
+            self._classifier = self.backend_classifier()
         if not self._classifier:
-            self._classifier = self.generate_classifier()
+            self._classifier = self.backend_classifier()
         return self._classifier
 
+    def reduce_classifiers(self, f, classifiers):
+        """
+        Combine the classifiers of the members pairwise with f.  In
+        INCREMENTAL mode the intermediate classifiers are kept (they survive
+        invalidate_classifier), so that after a member changes only the
+        combinations it takes part in are recomputed.
+        """
+        if not INCREMENTAL:
+            return util.tree_reduce(f, classifiers)
+        if self._reduction is None:
+            self._reduction = util.ReductionTree(f)
+        return self._reduction.reduce(classifiers)
+
+    def adopt_reductions(self, other):
+        """
+        Reuse the intermediate classifiers kept by other, a policy this one
+        replaces, along with those of members in the same positions.
+        """
+        if self.__class__ != other.__class__:
+            return
+        if self._reduction is None:
+            self._reduction = other._reduction
+        if len(self.policies) == len(other.policies):
+            for (p, q) in zip(self.policies, other.policies):
+                if p is not q and isinstance(p, CombinatorPolicy):
+                    p.adopt_reductions(q)
+
     def __repr__(self):
         return "%s:\n%s" % (self.name(),util.repr_plus(self.policies))
 
+    def hash_entry(self):
+        entry = self._hash
+        if entry is None or (entry[1] and
+                             self._hash_generation != DynamicPolicy.generation):
+            entry = self._hash = combined_hash_entry(self.__class__,
+                                                     self.policies)
+            self._hash_generation = DynamicPolicy.generation
+        return entry
+
+    def __hash__(self):
+        if isinstance(self, Filter):
+            # Filters keep hashing their repr: path compilation iterates
+            # over sets of them, and its output order follows the hash.
+            return Filter.__hash__(self)
+        return self.hash_entry()[0]
+
     def __eq__(self, other):
-        return ( self.__class__ == other.__class__
-           and   self.policies == other.policies )
+        if self is other:
+            return True
+        if self.__class__ != other.__class__:
+            return False
+        # Different hashes computed at construction prove the policies
+        # different, unless a DynamicPolicy below either changed since.
+        (h1, h2) = (self._hash, other._hash)
+        if h1 != h2 and h1 and h2 and not (h1[1] or h2[1]):
+            return False
+        return self.policies == other.policies
 
 
 class negate(CombinatorPolicy,Filter):
@@ -1148,6 +1418,12 @@ class negate(CombinatorPolicy,Filter):
         else:
             return {pkt}
 
+    def eval_batch(self, pkts):
+        if overrides_eval(self, negate):
+            return super(negate, self).eval_batch(pkts)
+        return [set() if hit else {pkt}
+                for (pkt, hit) in zip(pkts, self.policies[0].eval_batch(pkts))]
+
     def generate_classifier(self):
         inner_classifier = self.policies[0].compile()
         return ~inner_classifier
@@ -1194,11 +1470,22 @@ class parallel(CombinatorPolicy):
             output |= policy.eval(pkt)
         return output
 
+    def eval_batch(self, pkts):
+        if overrides_eval(self, parallel):
+            return super(parallel, self).eval_batch(pkts)
+        outputs = [set() for pkt in pkts]
+        for policy in self.policies:
+            for (output, out) in zip(outputs, policy.eval_batch(pkts)):
+                output |= out
+        return outputs
+
     def generate_classifier(self):
         if len(self.policies) == 0:  # EMPTY PARALLEL IS A DROP
             return drop.compile()
         classifiers = map(lambda p: p.compile(), self.policies)
-        return reduce(lambda acc, c: acc + c, classifiers)
+        if PARALLEL_BY_SIZE:
+            classifiers.sort(key=len)
+        return self.reduce_classifiers(lambda c1, c2: c1 + c2, classifiers)
 
 
 class union(parallel,Filter):
@@ -1285,12 +1572,43 @@ class sequential(CombinatorPolicy):
             prev_output = output
         return output
 
+    def eval_batch(self, pkts):
+        """
+        Evaluate each policy once on all the packets the previous one output,
+        each remembering the input packet it descends from.
+        """
+        if overrides_eval(self, sequential):
+            return super(sequential, self).eval_batch(pkts)
+        outputs = None
+        for policy in self.policies:
+            if policy == identity:
+                continue
+            if policy == drop:
+                return [set() for pkt in pkts]
+            if outputs is None:
+                outputs = policy.eval_batch(pkts)
+                continue
+            origins = []
+            batch = []
+            for (i, output) in enumerate(outputs):
+                if output:
+                    origins.extend([i] * len(output))
+                    batch.extend(output)
+            outputs = [set() for pkt in pkts]
+            if not batch:
+                break
+            for (i, out) in zip(origins, policy.eval_batch(batch)):
+                outputs[i] |= out
+        if outputs is None:
+            return [{pkt} for pkt in pkts]
+        return outputs
+
     def generate_classifier(self):
         assert(len(self.policies) > 0)
         classifiers = map(lambda p: p.compile(),self.policies)
         for c in classifiers:
             assert(c is not None)
-        return reduce(lambda acc, c: acc >> c, classifiers)
+        return self.reduce_classifiers(lambda c1, c2: c1 >> c2, classifiers)
         
 
 class intersection(sequential,Filter):
@@ -1338,6 +1656,8 @@ class DerivedPolicy(Policy):
     def __init__(self, policy=identity):
         self.policy = policy
         self._classifier = None
+        self._hash = combined_hash_entry(self.__class__, [policy])
+        self._hash_generation = DynamicPolicy.generation
         super(DerivedPolicy,self).__init__()
 
     def eval(self, pkt):
@@ -1350,6 +1670,11 @@ class DerivedPolicy(Policy):
         """
         return self.policy.eval(pkt)
 
+    def eval_batch(self, pkts):
+        if overrides_eval(self, DerivedPolicy):
+            return super(DerivedPolicy, self).eval_batch(pkts)
+        return self.policy.eval_batch(pkts)
+
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -1357,9 +1682,9 @@ class DerivedPolicy(Policy):
         :rtype: Classifier
         """
         if NO_CACHE: 
-            self._classifier = self.generate_classifier()
+            self._classifier = self.backend_classifier()
         if not self._classifier:
-            self._classifier = self.generate_classifier()
+            self._classifier = self.backend_classifier()
         return self._classifier
 
     def generate_classifier(self):
@@ -1368,9 +1693,29 @@ class DerivedPolicy(Policy):
     def __repr__(self):
         return "[DerivedPolicy]\n%s" % repr(self.policy)
 
+    def hash_entry(self):
+        entry = self._hash
+        if entry is None or (entry[1] and
+                             self._hash_generation != DynamicPolicy.generation):
+            entry = self._hash = combined_hash_entry(self.__class__,
+                                                     [self.policy])
+            self._hash_generation = DynamicPolicy.generation
+        return entry
+
+    def __hash__(self):
+        if isinstance(self, Filter):
+            return Filter.__hash__(self)   # see CombinatorPolicy.__hash__
+        return self.hash_entry()[0]
+
     def __eq__(self, other):
-        return ( self.__class__ == other.__class__
-           and ( self.policy == other.policy ) )
+        if self is other:
+            return True
+        if self.__class__ != other.__class__:
+            return False
+        (h1, h2) = (self._hash, other._hash)   # see CombinatorPolicy
+        if h1 != h2 and h1 and h2 and not (h1[1] or h2[1]):
+            return False
+        return self.policy == other.policy
 
 
 class difference(DerivedPolicy,Filter):
@@ -1415,6 +1760,22 @@ class if_(DerivedPolicy):
         else:
             return self.f_branch.eval(pkt)
 
+    def eval_batch(self, pkts):
+        """ Split the packets on pred once, and evaluate each branch once. """
+        if overrides_eval(self, if_):
+            return super(if_, self).eval_batch(pkts)
+        hits = self.pred.eval_batch(pkts)
+        t_index = [i for (i, hit) in enumerate(hits) if hit]
+        f_index = [i for (i, hit) in enumerate(hits) if not hit]
+        outputs = [None] * len(pkts)
+        for (branch, index) in [(self.t_branch, t_index),
+                                (self.f_branch, f_index)]:
+            if index:
+                out = branch.eval_batch([pkts[i] for i in index])
+                for (i, output) in zip(index, out):
+                    outputs[i] = output
+        return outputs
+
     def __repr__(self):
         return "if\n%s\nthen\n%s\nelse\n%s" % (util.repr_plus([self.pred]),
                                                util.repr_plus([self.t_branch]),
@@ -1428,6 +1789,12 @@ class fwd(DerivedPolicy):
     :param outport: the port on which to forward.
     :type outport: int
     """
+    __metaclass__ = Interned
+
+    @classmethod
+    def intern_key(cls, outport):
+        return (cls, match.generation, type(outport), outport)
+
     def __init__(self, outport):
         self.outport = outport
         super(fwd,self).__init__(modify(outport=self.outport))
@@ -1461,6 +1828,10 @@ class DynamicPolicy(DerivedPolicy):
     Abstact class for dynamic policies.
     The behavior of a dynamic policy changes each time self.policy is reassigned.
     """
+    # Bumped whenever the policy of a DynamicPolicy is reassigned, which
+    # invalidates the cached hashes of the policies containing one.
+    generation = 0
+
     ### init : unit -> unit
     def __init__(self,policy=drop):
         self._policy = policy
@@ -1489,8 +1860,19 @@ class DynamicPolicy(DerivedPolicy):
     def policy(self, policy):
         prev_policy = self._policy
         self._policy = policy
+        DynamicPolicy.generation += 1
+        if INCREMENTAL and isinstance(policy, CombinatorPolicy):
+            policy.adopt_reductions(prev_policy)
         self.changed()
 
+    def hash_entry(self):
+        (h, _) = self.policy.hash_entry()
+        return (hash((self.__class__.__name__, h)), True)
+
+    def __hash__(self):
+        # Dynamic policies are kept in sets while they change.
+        return id(self)
+
     def __repr__(self):
         return "[DynamicPolicy]\n%s" % repr(self.policy)
 
@@ -1556,6 +1938,260 @@ class flood(DynamicPolicy):
             return "flood"
 
 
+class match_table(DynamicPolicy):
+    """
+    A table of policies keyed on the values of some header fields: packets
+    whose values for the fields are a key of the table go to the policy of
+    that entry, all others to the default policy.  Evaluation is a dictionary
+    lookup, and the classifier has the rules of each entry restricted to its
+    key followed by the rules of the default, without the cross products of
+    the equivalent if_ chain.  Entries are added and removed in place.
+
+    :param fields: the header fields of the keys, e.g. ['switch', 'dstmac']
+    :type fields: list string
+    :param default: the policy for packets matching no entry
+    :type default: Policy
+    :param entries: initial entries, from key (tuple of field values, as
+        packets carry them) to policy
+    :type entries: dict
+    """
+    def __init__(self, fields, default=drop, entries={}):
+        self.fields = tuple(fields)
+        self.default = default
+        self.table = dict(entries)
+        self._entry_rules = {}   # key -> (classifier, rules), see entry_rules
+        self.changed_entries = None
+        super(match_table,self).__init__(None)   # policy built on demand
+
+    def add(self, key, policy):
+        """ Send the packets with field values key to policy. """
+        replaced = [self.table[key]] if key in self.table else []
+        self.table[key] = policy
+        self._entry_rules.pop(key, None)
+        self.table_changed([policy], replaced)
+
+    def remove(self, key):
+        """ Send the packets with field values key to the default policy. """
+        policy = self.table.pop(key)
+        self._entry_rules.pop(key, None)
+        self.table_changed([], [policy])
+
+    def table_changed(self, added=None, removed=None):
+        """
+        Note a change of the table.  changed_entries is set to the entry
+        policies it added and removed, or to None if it replaced the table.
+        """
+        if added is None:
+            self.changed_entries = None
+        else:
+            self.changed_entries = (added, removed)
+        self._policy = None
+        DynamicPolicy.generation += 1
+        self.invalidate_classifier()
+        self.changed()
+
+    def key_match(self, key):
+        return match(**dict(zip(self.fields, key)))
+
+    def sub_policies(self):
+        """ The policies of the entries, in table order, then the default. """
+        return self.table.values() + [self.default]
+
+    @property
+    def policy(self):
+        """ The equivalent policy, built on demand and kept until changed. """
+        if self._policy is None:
+            self._policy = self.build_policy()
+        return self._policy
+
+    @policy.setter
+    def policy(self, policy):
+        """ Empty the table, sending all packets to policy. """
+        self.default = policy
+        self.clear_entries()
+        self.table_changed()
+
+    def clear_entries(self):
+        self.table.clear()
+        self._entry_rules.clear()
+
+    def build_policy(self):
+        if not self.table:
+            return self.default
+        keys = [self.key_match(key) for key in self.table]
+        return parallel([m >> p for (m, p) in zip(keys, self.table.values())] +
+                        [negate([union(keys)]) >> self.default])
+
+    def lookup(self, pkt):
+        try:
+            key = tuple(pkt[field] for field in self.fields)
+            return self.table.get(key, self.default)
+        except (KeyError, TypeError):   # missing or unhashable field values
+            return self.default
+
+    def eval(self, pkt):
+        """
+        evaluate this policy on a single packet
+
+        :param pkt: the packet on which to be evaluated
+        :type pkt: Packet
+        :rtype: set Packet
+        """
+        return self.lookup(pkt).eval(pkt)
+
+    def eval_batch(self, pkts):
+        """ Evaluate each entry's policy once, on all the packets it gets. """
+        if overrides_eval(self, match_table):
+            return super(match_table, self).eval_batch(pkts)
+        groups = {}
+        for (i, pkt) in enumerate(pkts):
+            groups.setdefault(id(self.lookup(pkt)), []).append(i)
+        outputs = [None] * len(pkts)
+        for index in groups.itervalues():
+            policy = self.lookup(pkts[index[0]])
+            for (i, output) in zip(index, policy.eval_batch([pkts[i]
+                                                            for i in index])):
+                outputs[i] = output
+        return outputs
+
+    def entry_rules(self, key):
+        """
+        The rules of the entry for key: those of its policy's classifier,
+        restricted to the key.  Kept until the entry or its classifier
+        changes.
+        """
+        c = self.table[key].compile()
+        cached = self._entry_rules.get(key)
+        if cached is not None and cached[0] is c:
+            return cached[1]
+        key_match = self.key_match(key)
+        rules = []
+        for r in c.rules:
+            m = key_match.intersect(r.match)
+            if m is not drop:
+                rules.append(Rule(m, r.actions, [r], "sequential"))
+        self._entry_rules[key] = (c, rules)
+        return rules
+
+    def ordered_keys(self):
+        """ The keys in the order their rules go in the classifier. """
+        return self.table.iterkeys()
+
+    def generate_classifier(self):
+        rules = []
+        for key in self.ordered_keys():
+            rules += self.entry_rules(key)
+        return Classifier(rules + list(self.default.compile().rules))
+
+    def hash_entry(self):
+        (h, _) = self.default.hash_entry()
+        return (hash(('match_table', self.fields, h, len(self.table))), True)
+
+    def __eq__(self, other):
+        # Tables change in place, so are only equal to themselves, as their
+        # id hash (see DynamicPolicy.__hash__) has it.
+        return self is other
+
+    def __repr__(self):
+        return "match_table on %s: %d entries, default:\n%s" % (
+            ', '.join(self.fields), len(self.table),
+            util.repr_plus([self.default]))
+
+
+class lpm_table(match_table):
+    """
+    A routing table: packets go to the policy of the longest prefix in the
+    table containing their address in field, and to the default policy if
+    there is none.  Evaluation is a lookup in a prefix trie, and the
+    classifier has the rules of each entry restricted to its prefix, longest
+    prefixes first, so that no rule needs to be shadowed or intersected with
+    those of the other entries.  Adding or removing a prefix only computes
+    the rules of that entry.
+
+    :param field: the IP address field routed on
+    :type field: string
+    :param default: the policy for packets matching no prefix
+    :type default: Policy
+    :param routes: initial entries, from prefix (e.g. '10.0.0.0/8') to policy
+    :type routes: dict
+    """
+    def __init__(self, field='dstip', default=drop, routes={}):
+        self.field = field
+        self.trie = util.PrefixTrie()
+        self.lengths = [set() for _ in range(33)]   # the keys of each length
+        super(lpm_table,self).__init__([field], default)
+        for (prefix, policy) in routes.iteritems():
+            self.insert(prefix, policy)
+
+    @staticmethod
+    def prefix_network(prefix):
+        """ The network of prefix, with the host bits cleared. """
+        return util.string_to_network(str(prefix)).masked()
+
+    def insert(self, prefix, policy):
+        """ Add the route for prefix, returning the policies it replaced. """
+        net = self.prefix_network(prefix)
+        key = str(net)   # the canonical 'network/length' form
+        replaced = [self.table[key]] if key in self.table else []
+        self.table[key] = policy
+        self.trie.insert(int(net.network), net.prefixlen, policy)
+        self.lengths[net.prefixlen].add(key)
+        self._entry_rules.pop(key, None)
+        self._policy = None
+        return replaced
+
+    def add(self, prefix, policy):
+        """ Send the packets whose longest matching prefix is prefix to policy. """
+        replaced = self.insert(prefix, policy)
+        self.table_changed([policy], replaced)
+
+    def remove(self, prefix):
+        """ Remove the route for prefix, raising KeyError if there is none. """
+        net = self.prefix_network(prefix)
+        key = str(net)
+        policy = self.table.pop(key)
+        self.trie.remove(int(net.network), net.prefixlen)
+        self.lengths[net.prefixlen].discard(key)
+        self._entry_rules.pop(key, None)
+        self.table_changed([], [policy])
+
+    def clear_entries(self):
+        super(lpm_table, self).clear_entries()
+        self.trie = util.PrefixTrie()
+        self.lengths = [set() for _ in range(33)]
+
+    def key_match(self, key):
+        return match(**{self.field : key})
+
+    def ordered_keys(self):
+        """ The prefixes, longest first. """
+        for length in range(32, -1, -1):
+            for key in self.lengths[length]:
+                yield key
+
+    def build_policy(self):
+        """ The equivalent if_ chain. """
+        policy = self.default
+        for key in reversed(list(self.ordered_keys())):
+            policy = if_(self.key_match(key), self.table[key], policy)
+        return policy
+
+    def lookup(self, pkt):
+        try:
+            v = pkt[self.field]
+            if isinstance(v, IPAddr):
+                addr = struct.unpack('!I', v.to_bytes())[0]
+            else:
+                addr = int(util.string_to_IP(v))
+        except Exception:   # missing field, or not an IP address
+            return self.default
+        return self.trie.lookup(addr, self.default)
+
+    def __repr__(self):
+        return "lpm_table on %s: %d prefixes, default:\n%s" % (
+            self.field, len(self.table), util.repr_plus([self.default]))
+
+
 class ingress_network(DynamicFilter):
     """
     Returns True if a packet is located at a (switch,inport) pair entering
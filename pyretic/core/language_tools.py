@@ -1,4 +1,6 @@
 from pyretic.core.language import *
+from pyretic.core import util
+from pyretic.core.packet import Packet
 
 ###############################################################################
 # Class hierarchy syntax tree traversal
@@ -41,6 +43,12 @@ def default_mapper(parent, children):
         return if_(parent.pred, parent.t_branch, parent.f_branch)
     elif isinstance(parent, fwd) or isinstance(parent,xfwd):
         return (type(parent))(parent.outport)
+    elif isinstance(parent,lpm_table):
+        return lpm_table(parent.field, children[-1],
+                         dict(zip(parent.table.keys(), children[:-1])))
+    elif isinstance(parent,match_table):
+        return match_table(parent.fields, children[-1],
+                           dict(zip(parent.table.keys(), children[:-1])))
     elif isinstance(parent,query.packets):
         # The packets() constructor doesn't store data required to re-create the
         # object *exactly*. But if we're only concerned about the AST for eval()
@@ -53,6 +61,61 @@ def default_mapper(parent, children):
     else:
         raise NotImplementedError
 
+# Kinds of nodes, for the traversals below
+LEAF, COMBINATOR, TABLE, DERIVED = range(4)
+
+def node_kind(cls):
+    """
+    The kind of the policies of class cls, as ast_map and ast_fold treat them:
+    LEAF, COMBINATOR (children in policies), TABLE (children in
+    sub_policies()), DERIVED (child in policy), or None if unknown.
+    """
+    import pyretic.lib.query as query
+    if (  cls is type(identity) or
+          cls is type(drop) or
+          issubclass(cls,match) or
+          issubclass(cls,modify) or
+          cls is type(Controller) or
+          issubclass(cls,Query)):
+        return LEAF
+    elif (issubclass(cls,negate) or
+          issubclass(cls,parallel) or
+          issubclass(cls,union) or
+          issubclass(cls,sequential) or
+          issubclass(cls,intersection)):
+        return COMBINATOR
+    elif issubclass(cls,match_table):
+        return TABLE
+    elif (issubclass(cls,difference) or
+          issubclass(cls,if_) or
+          issubclass(cls,fwd) or
+          issubclass(cls,xfwd) or
+          issubclass(cls,DynamicPolicy) or
+          issubclass(cls,query.packets)):
+        return DERIVED
+    else:
+        return None
+
+node_kinds = {}   # class -> node_kind(class)
+
+def ast_children(policy):
+    """ The children of policy, for ast_map and ast_fold. """
+    cls = type(policy)
+    try:
+        kind = node_kinds[cls]
+    except KeyError:
+        kind = node_kinds[cls] = node_kind(cls)
+    if kind is LEAF:
+        return ()
+    elif kind is COMBINATOR:
+        return policy.policies
+    elif kind is TABLE:
+        return policy.sub_policies()
+    elif kind is DERIVED:
+        return (policy.policy,)
+    else:
+        raise NotImplementedError
+
 def ast_map(fun, policy):
     """
     Apply the function fun to each node, including putting together the results
@@ -70,62 +133,34 @@ def ast_map(fun, policy):
     It produces a new transformed policy that represents the entire tree rooted
     at the policy argument to this function.
     """
-    import pyretic.lib.query as query
-    children_pols = []
-    if (  policy == identity or
-          policy == drop or
-          isinstance(policy,match) or
-          isinstance(policy,modify) or
-          policy == Controller or
-          isinstance(policy,Query)):
-        children_pols = []
-    elif (isinstance(policy,negate) or
-          isinstance(policy,parallel) or
-          isinstance(policy,union) or
-          isinstance(policy,sequential) or
-          isinstance(policy,intersection)):
-        for sub_policy in policy.policies:
-            children_pols.append(ast_map(fun, sub_policy))
-    elif (isinstance(policy,difference) or
-          isinstance(policy,if_) or
-          isinstance(policy,fwd) or
-          isinstance(policy,xfwd) or
-          isinstance(policy,DynamicPolicy) or
-          isinstance(policy,query.packets)):
-        children_pols.append(ast_map(fun, policy.policy))
-    else:
-        raise NotImplementedError
-    return fun(policy, children_pols)
+    # Nodes are pushed once to visit their children, then again paired with
+    # their number of children, by which time the results of the children are
+    # the last ones on results.
+    results = []
+    stack = [policy]
+    while stack:
+        item = stack.pop()
+        if type(item) is tuple:
+            (policy, count) = item
+            start = len(results) - count
+            children_pols = results[start:]
+            del results[start:]
+            results.append(fun(policy, children_pols))
+        else:
+            children = ast_children(item)
+            stack.append((item, len(children)))
+            stack.extend(reversed(children))
+    return results[0]
 
 def ast_fold(fun, acc, policy):
-    import pyretic.lib.query as query
-    if (  policy == identity or
-          policy == drop or
-          isinstance(policy,match) or
-          isinstance(policy,modify) or
-          policy == Controller or
-          isinstance(policy,Query)):
-        return fun(acc,policy)
-    elif (isinstance(policy,negate) or
-          isinstance(policy,parallel) or
-          isinstance(policy,union) or
-          isinstance(policy,sequential) or
-          isinstance(policy,intersection)):
+    stack = [policy]
+    while stack:
+        policy = stack.pop()
+        children = ast_children(policy)
         acc = fun(acc,policy)
-        for sub_policy in policy.policies:
-            acc = ast_fold(fun,acc,sub_policy)
-        return acc
-    elif (isinstance(policy,difference) or
-          isinstance(policy,if_) or
-          isinstance(policy,fwd) or
-          isinstance(policy,xfwd) or
-          isinstance(policy,DynamicPolicy) or
-          isinstance(policy,query.packets)):
-        acc = fun(acc,policy)
-        return ast_fold(fun,acc,policy.policy)
-    else:
-        raise NotImplementedError
-    
+        stack.extend(reversed(children))
+    return acc
+
 def add_dynamic_sub_pols(acc, policy):
     if isinstance(policy,DynamicPolicy):
         return acc + [policy]
@@ -143,39 +178,341 @@ def add_query_sub_pols(acc, policy):
 def add_all_sub_pols(acc, policy):
     return acc | {policy}
 
+def add_eval_fields(acc, policy):
+    from pyretic.core.language import _modify
+    if isinstance(policy,match):
+        return acc | set(policy.translated_map().keys())
+    elif isinstance(policy,match_table):
+        return acc | set(policy.fields)
+    elif isinstance(policy,modify):
+        return acc | set(_modify(**policy.map).map.keys())
+    cls = type(policy)
+    try:
+        kind = eval_kinds[cls]
+    except KeyError:
+        kind = eval_kinds[cls] = eval_kind(cls)
+    if kind is EVAL_OVERRIDDEN:
+        # its eval may look at fields its policy doesn't
+        raise NotImplementedError
+    return acc
+
+def eval_fields(policy):
+    """
+    The header fields the policy matches on or modifies, which are all that
+    policy.eval looks at or changes in a packet; None if the policy contains
+    policies ast_fold doesn't know, or that evaluate otherwise than their
+    policy does.
+    """
+    try:
+        return ast_fold(add_eval_fields, set(), policy)
+    except NotImplementedError:
+        return None
+
+# Kinds of nodes, for queries_in_eval
+EVAL_DROP, EVAL_IDENTITY, EVAL_EVAL, EVAL_QUERY, EVAL_TABLE, EVAL_IF, \
+    EVAL_OVERRIDDEN, EVAL_DERIVED, EVAL_PARALLEL, EVAL_SEQUENTIAL, \
+    EVAL_OTHER = range(11)
+
+def eval_kind(cls):
+    if cls is type(drop):
+        return EVAL_DROP
+    elif cls is type(identity):
+        return EVAL_IDENTITY
+    elif (issubclass(cls,match) or
+          issubclass(cls,modify) or
+          issubclass(cls,negate)):
+        return EVAL_EVAL
+    elif issubclass(cls,Query):
+        return EVAL_QUERY
+    elif issubclass(cls,match_table):
+        return EVAL_TABLE
+    elif issubclass(cls,if_) and cls.eval.im_func is if_.eval.im_func:
+        return EVAL_IF
+    elif (issubclass(cls,DerivedPolicy) and
+          cls.eval.im_func is not DerivedPolicy.eval.im_func):
+        return EVAL_OVERRIDDEN
+    elif issubclass(cls,DerivedPolicy):
+        return EVAL_DERIVED
+    elif issubclass(cls,parallel):
+        return EVAL_PARALLEL
+    elif issubclass(cls,sequential):
+        return EVAL_SEQUENTIAL
+    else:
+        return EVAL_OTHER
+
+eval_kinds = {}   # class -> eval_kind(class)
+
 def queries_in_eval(acc, policy):
-    res,pkts = acc
-    if policy == drop:
-        acc = (res,set())
-    elif policy == identity:
-        pass
-    elif (isinstance(policy,match) or 
-          isinstance(policy,modify) or 
-          isinstance(policy,negate)):
-        new_pkts = set()
-        for pkt in pkts:
-            new_pkts |= policy.eval(pkt)
-        acc = (res,new_pkts)
-    elif isinstance(policy,Query):
-        acc = (res | {policy}, set())
-    elif isinstance(policy,DerivedPolicy):
-        acc = queries_in_eval(acc,policy.policy)
-    elif isinstance(policy,parallel):
-        parallel_res = set()
-        parallel_pkts = set()
-        for sub_pol in policy.policies:
-            new_res,new_pkts = queries_in_eval((res,pkts),sub_pol)
-            parallel_res |= new_res
-            parallel_pkts |= new_pkts
-        acc = (parallel_res,parallel_pkts)
-    elif isinstance(policy,sequential):
-        for sub_pol in policy.policies:
-            acc = queries_in_eval(acc,sub_pol)
-            if not acc[1]:
-                break
+    """
+    The queries policy.eval would apply packets to, and the packets it would
+    produce, starting from acc, a (queries, packets) pair.
+    """
+    return walk_eval(acc, policy, False)
+
+def eval_with_queries(policy, pkt):
+    """
+    Evaluate policy on pkt, as policy.eval does, and find the queries it
+    applies packets to, in a single walk of the policy.
+
+    :rtype: (set Query, set Packet)
+    """
+    return walk_eval((set(),{pkt}), policy, True)
+
+def walk_eval(acc, policy, evaluate):
+    """
+    Walk the policy as queries_in_eval does.  With evaluate set, also
+    evaluate the queries, and the policies the walk doesn't look into, as
+    policy.eval would, so that the packets produced are its output.
+    """
+    # Work items on the stack are either a policy to evaluate on acc, or the
+    # state of a composition in the middle of evaluating its members, as a
+    # list:
+    # [EVAL_PARALLEL, members, next member, input acc, queries, packets]
+    # [EVAL_SEQUENTIAL, members, next member]
+    # [EVAL_TABLE, table, packets, next packet, input queries, queries, packets]
+    # [EVAL_IF, if_, packets (then those pred drops), stage, queries, packets]
+    stack = [policy]
+    while stack:
+        item = stack.pop()
+        if type(item) is list:
+            kind = item[0]
+            if kind == EVAL_SEQUENTIAL:
+                (_, members, i) = item
+                if i < len(members) and (i == 0 or acc[1]):
+                    item[2] = i + 1
+                    stack.append(item)
+                    stack.append(members[i])
+            elif kind == EVAL_PARALLEL:
+                (_, members, i, start, res, pkts) = item
+                if i > 0:
+                    res |= acc[0]
+                    pkts |= acc[1]
+                if i < len(members):
+                    item[2] = i + 1
+                    acc = start
+                    stack.append(item)
+                    stack.append(members[i])
+                else:
+                    acc = (res, pkts)
+            elif kind == EVAL_TABLE:
+                (_, table, table_pkts, i, start, res, pkts) = item
+                if i > 0:
+                    res |= acc[0]
+                    pkts |= acc[1]
+                if i < len(table_pkts):
+                    item[3] = i + 1
+                    pkt = table_pkts[i]
+                    acc = (start, {pkt})
+                    stack.append(item)
+                    stack.append(table.lookup(pkt))
+                else:
+                    acc = (res, pkts)
+            else:
+                # pred >> t_branch, then ~pred >> f_branch
+                (_, policy, pkts, stage, res, out) = item
+                if stage == 0:
+                    hits = acc[1]
+                    item[2] = pkts - hits
+                    item[3] = 1
+                    item[4] = set(acc[0])
+                    stack.append(item)
+                    if hits:
+                        stack.append(policy.t_branch)
+                    else:
+                        acc = (acc[0], set())
+                else:
+                    res |= acc[0]
+                    out |= acc[1]
+                    if stage == 1:
+                        item[3] = 2
+                        stack.append(item)
+                        if pkts:
+                            acc = (res, pkts)
+                            stack.append(policy.f_branch)
+                        else:
+                            acc = (res, set())
+                    else:
+                        acc = (res, out)
+            continue
+
+        policy = item
+        cls = type(policy)
+        try:
+            kind = eval_kinds[cls]
+        except KeyError:
+            kind = eval_kinds[cls] = eval_kind(cls)
+        res,pkts = acc
+        if kind == EVAL_DROP:
+            acc = (res,set())
+        elif kind == EVAL_IDENTITY:
+            pass
+        elif kind == EVAL_EVAL:
+            new_pkts = set()
+            for pkt in pkts:
+                new_pkts |= policy.eval(pkt)
+            acc = (res,new_pkts)
+        elif kind == EVAL_QUERY:
+            new_pkts = set()
+            if evaluate:
+                for pkt in pkts:
+                    new_pkts |= policy.eval(pkt)
+            acc = (res | {policy}, new_pkts)
+        elif kind == EVAL_TABLE:
+            stack.append([EVAL_TABLE, policy, list(pkts), 0, res, set(), set()])
+        elif kind == EVAL_IF:
+            stack.append([EVAL_IF, policy, pkts, 0, None, set()])
+            stack.append(policy.pred)
+        elif kind == EVAL_OVERRIDDEN and evaluate:
+            # the walk can't follow what the policy's eval does: find its
+            # queries separately
+            new_pkts = set()
+            for pkt in pkts:
+                new_pkts |= policy.eval(pkt)
+            acc = (walk_eval(acc,policy.policy,False)[0], new_pkts)
+        elif kind == EVAL_DERIVED or kind == EVAL_OVERRIDDEN:
+            stack.append(policy.policy)
+        elif kind == EVAL_PARALLEL:
+            stack.append([EVAL_PARALLEL, policy.policies, 0, acc, set(), set()])
+        elif kind == EVAL_SEQUENTIAL:
+            stack.append([EVAL_SEQUENTIAL, policy.policies, 0])
+        elif evaluate:
+            new_pkts = set()
+            for pkt in pkts:
+                new_pkts |= policy.eval(pkt)
+            acc = (res,new_pkts)
     return acc
 
 
+class TracedHeader(util.frozendict):
+    """
+    A packet header recording, in sets it shares with the headers derived
+    from it, which of its fields are looked at and which are written.  Fields
+    written on the way to a header aren't recorded as looked at in it: their
+    values don't come from the traced packet.
+    """
+    __slots__ = ['reads', 'writes', 'written']
+
+    def __init__(self, new_dict=None, reads=None, writes=None,
+                 written=frozenset()):
+        super(TracedHeader, self).__init__(new_dict)
+        self.reads = set() if reads is None else reads
+        self.writes = set() if writes is None else writes
+        self.written = written
+
+    def derive(self, d, written):
+        self.writes.update(written)
+        return TracedHeader(d, self.reads, self.writes, self.written | written)
+
+    def read(self, key):
+        if not key in self.written:
+            self.reads.add(key)
+
+    def read_all(self):
+        for key in self._dict:
+            self.read(key)
+
+    def update(self, new_dict=None, **kwargs):
+        d = self._dict.copy()
+        written = set(kwargs)
+        if new_dict is not None:
+            d.update(new_dict)
+            written.update(new_dict)
+        d.update(kwargs)
+        return self.derive(d, written)
+
+    def remove(self, ks):
+        ks = list(ks)
+        d = self._dict.copy()
+        for k in ks:
+            d.pop(k, None)
+        return self.derive(d, set(ks))
+
+    def __getitem__(self, key):
+        self.read(key)
+        return self._dict[key]
+
+    def get(self, key, default=None):
+        self.read(key)
+        return self._dict.get(key, default)
+
+    def __contains__(self, key):
+        self.read(key)
+        return key in self._dict
+
+    def __iter__(self):
+        self.read_all()
+        return iter(self._dict)
+
+    def keys(self):
+        self.read_all()
+        return self._dict.keys()
+
+    def values(self):
+        self.read_all()
+        return self._dict.values()
+
+    def items(self):
+        self.read_all()
+        return self._dict.items()
+
+    def iterkeys(self):
+        self.read_all()
+        return self._dict.iterkeys()
+
+    def itervalues(self):
+        self.read_all()
+        return self._dict.itervalues()
+
+    def iteritems(self):
+        self.read_all()
+        return self._dict.iteritems()
+
+def untrace(pkt):
+    """ pkt, with a plain header if it has a TracedHeader. """
+    if isinstance(pkt.header, TracedHeader):
+        return Packet(pkt.header._dict)
+    return pkt
+
+def eval_with_trace(policy, pkt):
+    """
+    Evaluate policy on pkt, finding both the queries it reached (see
+    eval_with_queries) and the header fields of pkt the evaluation looked
+    at and wrote.  Any packet with the same values for both gets the same
+    changes: the fields written are needed too, as the output of two paths
+    through the policy, one writing a field and the other not, is one packet
+    or two depending on the value the field had.  The packets put in the
+    buckets of the queries reached are left untraced.
+
+    :rtype: (set Query, set Packet, set string, set string), the queries
+        reached, the output, and the fields read and written; the fields are
+        None if some policy made packets of its own
+    """
+    header = TracedHeader(pkt.header)
+    (queries,output) = eval_with_queries(policy, Packet(header))
+    for q in queries:
+        with q.bucket_lock:
+            traced = [p for p in q.bucket if isinstance(p.header, TracedHeader)]
+            q.bucket.difference_update(traced)
+            q.bucket.update(map(untrace, traced))
+    (reads, writes) = (set(header.reads), set(header.writes))
+    if not all(isinstance(out.header, TracedHeader) for out in output):
+        (reads, writes) = (None, None)
+    return (queries, set(map(untrace, output)), reads, writes)
+
+def eval_with_reads(policy, pkt):
+    """
+    Evaluate policy on pkt, finding the header fields of pkt the evaluation
+    looked at, and the fields it wrote (see eval_with_trace).
+
+    :rtype: (set Packet, set string, set string), the output, and the fields
+        read and written; None if some policy made packets of its own
+    """
+    (queries, output, reads, writes) = eval_with_trace(policy, pkt)
+    if reads is None:
+        return None
+    return (output, reads, writes)
+
+
 def on_recompile_path_set(acc,pol_id,policy):
     if (  policy == identity or
           policy == drop or
@@ -199,6 +536,14 @@ def on_recompile_path_set(acc,pol_id,policy):
     elif isinstance(policy,DerivedPolicy):
         if id(policy) == pol_id:
             return acc | {policy}
+        elif isinstance(policy,match_table):
+            sub_acc = set()
+            for sub_policy in policy.sub_policies():
+                sub_acc |= on_recompile_path_set(sub_acc,pol_id,sub_policy)
+            if sub_acc:
+                return acc | {policy} | sub_acc
+            else:
+                return set()
         else:
             sub_acc = on_recompile_path_set(set(),pol_id,policy.policy)
             if sub_acc:
@@ -231,6 +576,14 @@ def on_recompile_path_list(pol_id,policy):
     elif isinstance(policy,DerivedPolicy):
         if id(policy) == pol_id:
             return [policy]
+        elif isinstance(policy,match_table):
+            sub_acc = list()
+            for sub_policy in policy.sub_policies():
+                sub_acc += on_recompile_path_list(pol_id,sub_policy)
+            if sub_acc:
+                return [policy] + sub_acc
+            else:
+                return list()
         else:
             sub_acc = on_recompile_path_list(pol_id,policy.policy)
             if sub_acc:
@@ -239,3 +592,160 @@ def on_recompile_path_list(pol_id,policy):
                 return list()
     else:
         raise NotImplementedError
+
+
+def sub_policies(policy):
+    """
+    The children of policy in its syntax tree, as on_recompile_path_list sees
+    them, None for the policies that can't have any.
+    """
+    if (  policy is identity or
+          policy is drop or
+          isinstance(policy,match) or
+          isinstance(policy,modify) or
+          policy is Controller or
+          isinstance(policy,Query)):
+        return None
+    elif (isinstance(policy,negate) or
+          isinstance(policy,parallel) or
+          isinstance(policy,union) or
+          isinstance(policy,sequential) or
+          isinstance(policy,intersection)):
+        return list(policy.policies)
+    elif isinstance(policy,match_table):
+        return policy.sub_policies()
+    elif isinstance(policy,DerivedPolicy):
+        return [policy.policy]
+    else:
+        raise NotImplementedError
+
+
+class PolicyIndex(object):
+    """
+    The parents of each compound sub-policy of a policy, kept up to date as its
+    dynamic sub-policies change (see update), so that the policies containing
+    a changed one are found without walking the whole policy.
+
+    Sub-policies shared by several parents, or appearing several times in one,
+    are indexed once, with a count per parent; they leave the index with their
+    last parent.  Sub-policies are told apart by identity, as structurally
+    equal ones are still distinct nodes to invalidate.  A match_table's change
+    reindexes only the entries it added and removed (see
+    match_table.changed_entries), so learning one more entry costs the same
+    whatever the size of the table.
+
+    :param root: the policy to index
+    :type root: Policy
+    :param on_add: called with each dynamic sub-policy entering the index,
+        before its children are indexed
+    :type on_add: DynamicPolicy -> unit
+    :param on_remove: called with each dynamic sub-policy leaving the index
+    :type on_remove: DynamicPolicy -> unit
+    """
+    def __init__(self, root, on_add=None, on_remove=None):
+        self.root = root
+        self.on_add = on_add
+        self.on_remove = on_remove
+        self.parents = {}    # id(policy) -> {id(parent) : count}
+        self.children = {}   # id(policy) -> {id(child) : [child, count]}
+        self.policies = {}   # id(policy) -> policy
+        self.add(root, None)
+
+    def add(self, policy, parent):
+        """ Index policy as a child of parent, and its new sub-policies. """
+        stack = [(policy, parent)]
+        while stack:
+            (policy, parent) = stack.pop()
+            if sub_policies(policy) is None:
+                continue
+            counts = self.parents.get(id(policy))
+            new = counts is None
+            if new:
+                counts = self.parents[id(policy)] = {}
+                self.policies[id(policy)] = policy
+            if parent is not None:
+                counts[id(parent)] = counts.get(id(parent), 0) + 1
+            if new:
+                if isinstance(policy,DynamicPolicy) and self.on_add:
+                    self.on_add(policy)
+                children = sub_policies(policy)
+                self.children[id(policy)] = self.child_counts(children)
+                stack.extend((child, policy) for child in children)
+
+    def remove(self, policy, parent):
+        """
+        Unindex policy as a child of parent, and the sub-policies left without
+        parents.
+        """
+        stack = [(policy, parent)]
+        while stack:
+            (policy, parent) = stack.pop()
+            counts = self.parents.get(id(policy))
+            if counts is None:
+                continue
+            count = counts.pop(id(parent)) - 1
+            if count:
+                counts[id(parent)] = count
+            if counts or policy is self.root:
+                continue
+            del self.parents[id(policy)]
+            del self.policies[id(policy)]
+            if isinstance(policy,DynamicPolicy) and self.on_remove:
+                self.on_remove(policy)
+            for (child, count) in self.children.pop(id(policy)).itervalues():
+                stack.extend([(child, policy)] * count)
+
+    @staticmethod
+    def child_counts(children):
+        counts = {}
+        for child in children:
+            counts.setdefault(id(child), [child, 0])[1] += 1
+        return counts
+
+    def update(self, policy):
+        """ Reindex the children of policy, after it changed. """
+        if not id(policy) in self.parents:
+            return
+        children = self.children[id(policy)]
+        if (isinstance(policy,match_table) and
+            policy.changed_entries is not None):
+            (added, removed) = policy.changed_entries
+            for child in added:
+                children.setdefault(id(child), [child, 0])[1] += 1
+            for child in removed:
+                counted = children[id(child)]
+                counted[1] -= 1
+                if not counted[1]:
+                    del children[id(child)]
+        else:
+            added = sub_policies(policy)
+            removed = [child for (child, count) in children.itervalues()
+                       for _ in range(count)]
+            self.children[id(policy)] = self.child_counts(added)
+        # add before removing, so that children policy keeps stay indexed
+        for child in added:
+            self.add(child, policy)
+        for child in removed:
+            self.remove(child, policy)
+
+    def ancestors(self, policy):
+        """ policy and the policies containing it, up to the root. """
+        found = {}
+        stack = [id(policy)]
+        while stack:
+            i = stack.pop()
+            if i in found or not i in self.parents:
+                continue
+            found[i] = self.policies[i]
+            stack.extend(self.parents[i])
+        return found.values()
+
+    def dynamic_sub_pols(self):
+        return [p for p in self.policies.itervalues()
+                if isinstance(p,DynamicPolicy)]
+
+    def __contains__(self, policy):
+        return id(policy) in self.parents
+
+    def __len__(self):
+        return len(self.parents)
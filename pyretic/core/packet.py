@@ -490,7 +490,10 @@ class Packet(object):
     __slots__ = ["header"]
     
     def __init__(self, state={}):
-        self.header = util.frozendict(state)
+        if isinstance(state, util.frozendict):
+            self.header = state
+        else:
+            self.header = util.frozendict(state)
 
     def available_fields(self):
         return self.header.keys()
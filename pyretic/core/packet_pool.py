@@ -0,0 +1,262 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+Evaluation of packet-ins by a pool of worker processes.
+
+Each worker is forked from the runtime, and so holds a copy of the policy as
+it was at that time, which it only reads: it unpacks the packet-ins it is
+given, evaluates them (see Runtime.interpret) and sends back the packet and
+the output, as packets and as the concrete packets to send.  A thread of the
+runtime process applies the results one at a time (see
+Runtime.finish_packet_in), so that the policy only ever changes in the
+runtime.  Packet-ins reaching a query, whose evaluation may keep state in
+the query, and those a worker fails to evaluate are sent back unevaluated,
+for the runtime to handle itself (see Runtime.process_packet_in).
+
+Packet-ins are sent to a worker by a hash of their flow, and each worker
+handles its packets in order, so the packets of a flow come out in the order
+they came in.  Once the policy changes, the workers send their packets back
+unevaluated until a new set of workers is forked from the new policy, off
+the thread handing out packet-ins and at most once every refork_interval
+seconds.  The new workers' results are applied once the old ones are done.
+"""
+
+import logging
+import signal
+import threading
+import time
+from multiprocessing import Process, Queue
+
+from pyretic.core.language import match, DynamicPolicy
+
+VLAN_TYPES = ('\x81\x00', '\x88\xa8')
+PORT_PROTOCOLS = ('\x06', '\x11')   # TCP, UDP
+REFORK_INTERVAL_SEC = 1
+
+
+def flow_hash(concrete_pkt):
+    """
+    Hash of the flow of a packet-in: its switch and input port, and the
+    Ethernet, IPv4 and TCP/UDP addresses found in its raw bytes.
+    """
+    raw = concrete_pkt['raw']
+    start = 12
+    while raw[start:start+2] in VLAN_TYPES:
+        start += 4
+    key = raw[:12] + raw[start:start+2]
+    if raw[start:start+2] == '\x08\x00' and len(raw) >= start + 22:
+        ip = start + 2
+        protocol = raw[ip+9]
+        key += protocol + raw[ip+12:ip+20]
+        if protocol in PORT_PROTOCOLS:
+            ports = ip + (ord(raw[ip]) & 0xf) * 4
+            key += raw[ports:ports+4]
+    return hash((concrete_pkt['switch'], concrete_pkt['inport'], key))
+
+
+def work(runtime, jobs, results):
+    """
+    The loop of a worker: evaluate the packet-ins in jobs until given None.
+    Jobs are (packet-in, whether to evaluate it) pairs; results are
+    ('evaluated', packet, output, concrete output, fields read and written)
+    or ('returned', packet-in) tuples, the latter for the runtime to evaluate
+    the packet-in itself.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The workers are forked holding the policy lock, with the policy whole
+    # (see PacketInPool.start), and nothing changes it here.  The other
+    # locks the worker may take could have been held by other threads.
+    runtime.transaction_depth = 0
+    runtime.in_network_update = False
+    runtime.swap_lock = threading.RLock()
+    runtime.snapshot_lock = threading.Lock()
+    runtime.clear_eval_cache()
+    trace = runtime.mode == 'reactive0'   # for the rule to install
+    while True:
+        job = jobs.get()
+        if job is None:
+            results.put(None)
+            return
+        (concrete_pkt, evaluate) = job
+        if evaluate:
+            try:
+                pyretic_pkt = runtime.concrete2pyretic(concrete_pkt)
+                fields = None
+                if trace:
+                    (reached, output, fields) = runtime.interpret(pyretic_pkt,
+                                                                  trace)
+                else:
+                    (reached, output) = runtime.interpret(pyretic_pkt)
+                if not reached:
+                    concrete_output = map(runtime.pyretic2concrete, output)
+                    results.put(('evaluated', pyretic_pkt, output,
+                                 concrete_output, fields))
+                    continue
+                for q in reached:
+                    q.bucket.clear()
+            except Exception:
+                pass   # the runtime reports it, evaluating the packet-in
+        results.put(('returned', concrete_pkt))
+
+
+class PacketInPool(object):
+    """
+    Worker processes evaluating the packet-ins of a runtime.
+
+    :param runtime: the runtime the workers are forked from
+    :type runtime: Runtime
+    :param size: the number of workers
+    :type size: int
+    """
+    def __init__(self, runtime, size):
+        self.runtime = runtime
+        self.size = size
+        self.refork_interval = REFORK_INTERVAL_SEC
+        self.log = logging.getLogger('%s.PacketInPool' % __name__)
+        self.lock = threading.Lock()
+        self.workers = []       # (Process, job Queue), by flow hash
+        self.collector = None
+        self.version = None
+        self.started = None     # when the workers were last forked
+        self.timer = None       # the pending fork, if any
+        self.forks = 0
+
+    def policy_version(self):
+        """ Changes whenever the policy the workers evaluate does. """
+        return (DynamicPolicy.generation, match.generation)
+
+    def submit(self, concrete_pkt):
+        """
+        Have the packet-in evaluated by the worker of its flow, or returned
+        by it if the policy changed since it was forked.  Until there are
+        workers, packet-ins are handled at once.
+        """
+        with self.lock:
+            if not self.workers:
+                self.schedule_start()
+                jobs = None
+            else:
+                current = self.version == self.policy_version()
+                if not current:
+                    self.schedule_start()
+                (_, jobs) = self.workers[flow_hash(concrete_pkt) % self.size]
+                jobs.put((concrete_pkt, current))
+        if jobs is None:
+            self.runtime.process_packet_in(concrete_pkt)
+
+    def schedule_start(self):
+        """ Fork new workers in a thread, refork_interval after the last. """
+        if self.timer is not None:
+            return
+        delay = 0
+        if self.started is not None:
+            delay = max(0, self.started + self.refork_interval - time.time())
+        timer = threading.Timer(delay, lambda: self.start(timer))
+        timer.daemon = True
+        self.timer = timer
+        timer.start()
+
+    def start(self, timer=None):
+        """
+        Fork workers from the current policy, to replace the current ones
+        once these are done with the packets they were given.  A fork
+        scheduled by timer is dropped if the pool was stopped, or started,
+        since.
+        """
+        with self.runtime.policy_lock:
+            version = self.policy_version()
+            results = Queue()
+            workers = []
+            for i in range(self.size):
+                jobs = Queue()
+                worker = Process(target=work,
+                                 args=(self.runtime, jobs, results))
+                worker.daemon = True
+                worker.start()
+                workers.append((worker, jobs))
+        with self.lock:
+            if timer is not None and timer is not self.timer:
+                (old, workers) = (workers, None)
+            else:
+                self.timer = None
+                (old, previous) = (self.workers, self.collector)
+                self.workers = workers
+                self.version = version
+                self.started = time.time()
+                self.forks += 1
+                self.collector = threading.Thread(
+                    target=self.collect, args=(results, previous))
+                self.collector.daemon = True
+                self.collector.start()
+            for (_, jobs) in old:
+                jobs.put(None)
+        for (worker, _) in old:
+            worker.join()
+        if workers is not None:
+            self.log.debug('started %d workers for policy version %s'
+                           % (self.size, version))
+
+    def stop(self):
+        """ Wait for the workers to finish the packets they were given. """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            (workers, collector) = (self.workers, self.collector)
+            for (_, jobs) in workers:
+                jobs.put(None)
+            self.workers = []
+            self.collector = None
+            self.version = None
+        if collector is not None:
+            collector.join()
+        for (worker, _) in workers:
+            worker.join()
+
+    def collect(self, results, previous):
+        """
+        Apply the results of the workers, until they all stopped, after
+        those of the workers they replace.
+        """
+        if previous is not None:
+            previous.join()
+        running = self.size
+        while running:
+            result = results.get()
+            if result is None:
+                running -= 1
+                continue
+            try:
+                if result[0] == 'returned':
+                    self.runtime.process_packet_in(result[1])
+                else:
+                    (_, pyretic_pkt, output, concrete_output, fields) = result
+                    self.runtime.finish_packet_in(pyretic_pkt, set(), output,
+                                                  concrete_output, fields)
+            except Exception:
+                self.log.exception('error handling packet-in')
@@ -37,14 +37,48 @@ from pyretic.core.classifier import get_rule_exact_match
 from pyretic.core.classifier import get_rule_derivation_tree
 
 from multiprocessing import Process, Manager, RLock, Lock, Value, Queue, Condition
-import logging, sys, time
+import logging, sys, time, threading
+from contextlib import contextmanager
 from datetime import datetime
 import copy
+import itertools
 
 TABLE_MISS_PRIORITY = 0
 TABLE_START_PRIORITY = 60000
 STATS_REQUERY_THRESHOLD_SEC = 10
+INFLIGHT_TIMEOUT_SEC = 1   # how long a reactive install is awaited at most
 NUM_PATH_TAGS=1022
+MISSING = object()   # value of the fields a packet lacks, in eval cache keys
+# OpenFlow only matches on these once the ethtype, and for transport ports the
+# protocol, are matched on too
+NETWORK_HEADERS = set(['srcip', 'dstip', 'tos', 'protocol'])
+TRANSPORT_HEADERS = set(['srcport', 'dstport'])
+
+
+class PolicySnapshot(object):
+    """
+    The state the packet interpreter keeps for a version of the policy: the
+    version number and the evaluation cache of that version.  Snapshots are
+    never changed once published (see Runtime.publish), except for filling
+    their evaluation cache and the fields it is keyed on, so that packet-ins
+    read them without locking.  The policy itself isn't copied: packet-ins
+    evaluate the live policy, holding Runtime.swap_lock (see interpret).
+    """
+    __slots__ = ['version', 'eval_cache', 'eval_cache_fields', 'generation']
+
+    def __init__(self, version, eval_cache, eval_cache_fields, generation):
+        self.version = version
+        self.eval_cache = eval_cache
+        self.eval_cache_fields = eval_cache_fields   # computed on first use
+        self.generation = generation   # match.generation of eval_cache
+
+    def replace(self, **changes):
+        """ A new snapshot, of the next version, with changes. """
+        fields = dict((f, getattr(self, f)) for f in self.__slots__)
+        fields['version'] = self.version + 1
+        fields.update(changes)
+        return PolicySnapshot(**fields)
+
 
 class Runtime(object):
     """
@@ -61,9 +95,26 @@ class Runtime(object):
     :type mode: string
     :param verbosity: one of low, normal, high, please-make-it-stop
     :type verbosity: string
+    :param classifier_cache: where proactive modes look up and keep compiled
+        classifiers, None to always compile
+    :type classifier_cache: ClassifierCache
+    :param eval_cache_size: how many flows the packet interpreter remembers
+        the evaluation of, 0 to evaluate every packet
+    :type eval_cache_size: int
+    :param codegen: whether the packet interpreter evaluates the policy with
+        generated code (see pyretic.core.codegen) instead of Policy.eval
+    :type codegen: bool
+    :param update_delay: seconds to wait, after a policy change, for more
+        changes to install together, 0 to install each change at once
+    :type update_delay: float
+    :param workers: how many processes evaluate packet-ins (see
+        pyretic.core.packet_pool), 0 to evaluate them in this one
+    :type workers: int
     """
     def __init__(self, backend, main, path_main, kwargs, mode='interpreted',
-                 verbosity='normal'):
+                 verbosity='normal', classifier_cache=None,
+                 eval_cache_size=10000, codegen=False, update_delay=0,
+                 workers=0):
         self.verbosity = self.verbosity_numeric(verbosity)
         self.log = logging.getLogger('%s.Runtime' % __name__)
         self.network = ConcreteNetwork(self)
@@ -93,19 +144,36 @@ class Runtime(object):
                            (virtual_tag >> out_capture))
 
         self.mode = mode
+        self.evaluate = None   # None to walk the policy with eval_with_queries
+        if codegen:
+            from pyretic.core.codegen import evaluator
+            self.evaluate = evaluator(self.policy)
+        self.classifier_cache = classifier_cache
+        self.eval_cache_size = eval_cache_size
+        self.snapshot = PolicySnapshot(0, self.new_eval_cache(), None,
+                                       match.generation)
+        self.snapshot_lock = Lock()
         self.backend = backend
         self.backend.runtime = self
         self.policy_lock = RLock()
+        # held while several policies are swapped at once, and by packet-ins
+        # while they evaluate the policy, but never while compiling
+        self.swap_lock = RLock()
         self.network_lock = Lock()
         self.switch_lock = Lock()
         self.vlan_to_extended_values_db = {}
         self.extended_values_to_vlan_db = {}
         self.extended_values_lock = RLock()
         self.dynamic_sub_pols = set()
+        self.policy_index = None
         self.in_network_update = False
         self.in_bucket_apply = False
         self.network_triggered_policy_update = False
         self.bucket_triggered_policy_update = False
+        self.transaction_depth = 0
+        self.transaction_policy_update = False
+        self.update_delay = update_delay
+        self.update_timer = None
         self.global_outstanding_queries_lock = Lock()
         self.global_outstanding_queries = {}
         self.last_queried_time_lock = Lock()
@@ -125,6 +193,17 @@ class Runtime(object):
         self.num_packet_ins = 0
         self.update_dynamic_sub_pols()
         self.total_packets_removed = 0 # pkt count from flow removed messages
+        self.megaflows = True   # False to install microflows in reactive0
+        # reactive installs not known to be on their switch yet, by switch:
+        # (barrier xid, predicate, header deltas, policy version, deadline)
+        self.inflight = {}
+        self.inflight_lock = Lock()
+        self.inflight_timeout = INFLIGHT_TIMEOUT_SEC   # 0 not to track them
+        self.barrier_xids = itertools.count(1)
+        self.packet_pool = None
+        if workers > 0:
+            from pyretic.core.packet_pool import PacketInPool
+            self.packet_pool = PacketInPool(self, workers)
 
     def verbosity_numeric(self,verbosity_option):
         numeric_map = { 'low': 1,
@@ -145,44 +224,174 @@ class Runtime(object):
         :param concrete_packet: the packet to be interpreted.
         :type limit: payload of an OpenFlow packet_in message.
         """
-        start_time = time.time()
         self.num_packet_ins += 1
-        with self.policy_lock:
-            pyretic_pkt = self.concrete2pyretic(concrete_pkt)
-
-            # find the queries, if any in the policy, that will be evaluated
-            queries,pkts = queries_in_eval((set(),{pyretic_pkt}),self.policy)
-
-            # evaluate the policy
-            output = self.policy.eval(pyretic_pkt)
+        if self.packet_pool is not None:
+            self.packet_pool.submit(concrete_pkt)
+            return
 
-            # apply the queries whose buckets have received new packets
-            self.in_bucket_apply = True
-            for q in queries:
-                if isinstance(q, PathBucket):
-                    q.apply(pyretic_pkt)
-                else:
-                    q.apply()
-            self.in_bucket_apply = False
-            
-            # if the query changed the policy, update the controller and switch state
-            if self.bucket_triggered_policy_update:
-                self.update_dynamic_sub_pols()
-                self.update_switch_classifiers()
-                self.bucket_triggered_policy_update = False
-                    
-        # send output of evaluation into the network
-        concrete_output = map(self.pyretic2concrete,output)
-        map(self.send_packet,concrete_output)
+        start_time = time.time()
+        self.process_packet_in(concrete_pkt)
 
         self.packet_in_time += (time.time() - start_time)
         self.log.debug("handle_packet_in cumulative: %f %d"
                        % (self.packet_in_time, self.num_packet_ins))
+        eval_cache = self.snapshot.eval_cache
+        if eval_cache is not None:
+            self.log.debug("eval cache hits: %d misses: %d"
+                           % (eval_cache.hits, eval_cache.misses))
+
+    def process_packet_in(self, concrete_pkt):
+        """ Evaluate a packet-in, and apply the results. """
+        pyretic_pkt = self.concrete2pyretic(concrete_pkt)
+        deltas = None
+        if self.mode == 'reactive0':
+            # packets arriving before the rule installed for their flow got
+            # to the switch are handled as the rule will
+            deltas = self.inflight_install(pyretic_pkt)
+        trace = None
+        if deltas is not None:
+            queries = set()
+            output = {pyretic_pkt.modifymany(d) for d in deltas}
+        elif self.mode == 'reactive0':
+            queries,output,trace = self.interpret(pyretic_pkt, True)
+        else:
+            queries,output = self.interpret(pyretic_pkt)
+        self.finish_packet_in(pyretic_pkt, queries, output, trace=trace,
+                              inflight=deltas is not None)
+
+    def finish_packet_in(self, pyretic_pkt, queries, output,
+                         concrete_output=None, trace=None, inflight=None):
+        """
+        Apply the queries a packet-in reached, and send the output of its
+        evaluation into the network, converted to concrete packets unless
+        given as concrete_output.  In reactive0 mode, install a rule for the
+        packets evaluated the same way, the fields the evaluation read and
+        wrote given as trace (see interpret), unless inflight tells an
+        install on its way already matches the packet; None if not looked up.
+        """
+        if queries:
+            with self.policy_lock:
+                # apply the queries whose buckets have received new packets
+                self.in_bucket_apply = True
+                with self.swap_lock:
+                    for q in queries:
+                        if isinstance(q, PathBucket):
+                            q.apply(pyretic_pkt)
+                        else:
+                            q.apply()
+                self.in_bucket_apply = False
+
+                # if the query changed the policy, update the controller and
+                # switch state
+                if self.bucket_triggered_policy_update:
+                    self.update_policy()
+                    self.bucket_triggered_policy_update = False
 
-        # if in reactive mode and no packets are forwarded to buckets, install microflow
+        # send output of evaluation into the network
+        if concrete_output is None:
+            concrete_output = map(self.pyretic2concrete,output)
+        map(self.send_packet,concrete_output)
+
+        # if in reactive mode and no packets are forwarded to buckets, install a rule
         # Note: lack of forwarding to bucket implies no bucket-trigger update could have occured
         if self.mode == 'reactive0' and not queries:
-            self.reactive0_install(pyretic_pkt,output)
+            self.reactive0_install(pyretic_pkt,output,trace,inflight)
+
+
+    def interpret(self, pyretic_pkt, trace=False):
+        """
+        Evaluate the policy on a packet, without waiting for compilation.
+        With trace, also find the header fields the evaluation looked at and
+        wrote (see eval_with_trace).
+
+        :rtype: (set Query, set Packet), the queries the packet reached and
+            the output of the policy, and with trace the (read, written)
+            fields, None if they aren't known
+        """
+        # Evaluation doesn't wait for the policy lock, which compilation
+        # holds, only for transactions, network updates and bucket callbacks
+        # to finish swapping policies.  A single DynamicPolicy assignment
+        # and a single table entry change are atomic for eval.
+        with self.swap_lock:
+            snapshot = self.snapshot
+
+            # packets of a flow evaluated before, which reached no query, get
+            # the same modifications
+            key = self.eval_cache_key(pyretic_pkt, snapshot)
+            cached = None
+            if key is not None:
+                cached = snapshot.eval_cache.get(key)
+            if cached is not None:
+                queries = set()
+                (deltas, fields) = cached
+                output = {pyretic_pkt.modifymany(d) for d in deltas}
+            else:
+                # evaluate the policy, finding the queries, if any in the
+                # policy, that it applies the packet to
+                fields = None
+                if trace:
+                    (queries,output,reads,written) = \
+                        eval_with_trace(self.policy, pyretic_pkt)
+                    if reads is not None:
+                        fields = (reads, written)
+                elif self.evaluate is None:
+                    queries,output = eval_with_queries(self.policy, pyretic_pkt)
+                else:
+                    queries,pkts = queries_in_eval((set(),{pyretic_pkt}),
+                                                   self.policy)
+                    output = self.evaluate(pyretic_pkt)
+
+                if key is not None and not queries:
+                    snapshot.eval_cache.put(key, (header_deltas(pyretic_pkt,
+                                                                output),
+                                                  fields))
+            if trace:
+                return (queries, output, fields)
+            return (queries, output)
+
+    def eval_cache_key(self, pkt, snapshot):
+        """
+        The key of pkt in the evaluation cache of snapshot: its values for the
+        fields self.policy matches on or modifies. None if the cache is off,
+        the policy can't be analysed, or a value isn't hashable.
+        """
+        if snapshot.eval_cache is None:
+            return None
+        if snapshot.generation != match.generation:
+            # virtual fields translate to other fields now
+            self.clear_eval_cache()
+            return None
+        if snapshot.eval_cache_fields is None:
+            fields = eval_fields(self.policy)
+            snapshot.eval_cache_fields = (False if fields is None
+                                          else sorted(fields))
+        if snapshot.eval_cache_fields is False:
+            return None
+        header = pkt.header
+        key = tuple(header.get(f, MISSING) for f in snapshot.eval_cache_fields)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def new_eval_cache(self):
+        if self.eval_cache_size > 0:
+            return util.LRUCache(self.eval_cache_size)
+        return None
+
+    def clear_eval_cache(self):
+        """
+        Publish a snapshot with an empty evaluation cache.  Packet-ins still
+        evaluating with the previous one fill its cache, not the new one.
+        """
+        self.publish(eval_cache=self.new_eval_cache(), eval_cache_fields=None,
+                     generation=match.generation)
+
+    def publish(self, **changes):
+        """ Replace the snapshot packet-ins read by one with changes. """
+        with self.snapshot_lock:
+            self.snapshot = self.snapshot.replace(**changes)
 
 
 #############
@@ -197,9 +406,12 @@ class Runtime(object):
         with self.policy_lock:
 
             # tag stale classifiers as invalid
-            recompile_list = on_recompile_path_list(id(sub_pol),
-                                                    self.policy)
+            recompile_list = self.policy_index.ancestors(sub_pol)
             map(lambda p: p.invalidate_classifier(), recompile_list)
+            self.clear_eval_cache()
+
+            # track the dynamic sub-policies sub_pol gained or lost
+            self.policy_index.update(sub_pol)
 
             # if change was driven by a network update, flag
             if self.in_network_update:
@@ -211,8 +423,60 @@ class Runtime(object):
 
             # otherwise, update controller and switches accordingly
             else:
-                self.update_dynamic_sub_pols()
-                self.update_switch_classifiers()
+                self.update_policy()
+
+    @contextmanager
+    def policy_transaction(self):
+        """
+        Context in which policy changes are only applied, all at once, when
+        it is left:
+
+            with runtime.policy_transaction():
+                routing.policy = new_routing
+                firewall.policy = new_firewall
+
+        Transactions may be nested; the changes are applied when the outermost
+        one ends, even if it ends with an exception.
+        """
+        with self.policy_lock:
+            self.transaction_depth += 1
+            try:
+                with self.swap_lock:
+                    yield
+            finally:
+                self.transaction_depth -= 1
+                if (self.transaction_depth == 0 and
+                    self.transaction_policy_update):
+                    self.transaction_policy_update = False
+                    self.update_policy()
+
+    def update_policy(self):
+        """
+        Updates the controller and switches after a policy change: at once,
+        or if update_delay is set, update_delay seconds after the first of a
+        burst of changes, once for the whole burst.  Inside a transaction,
+        only once the transaction ends.
+        """
+        if self.transaction_depth:
+            self.transaction_policy_update = True
+        elif self.update_delay <= 0:
+            self.update_dynamic_sub_pols()
+            self.update_switch_classifiers()
+        elif self.update_timer is None:
+            self.update_timer = threading.Timer(self.update_delay,
+                                                self.flush_policy_update)
+            self.update_timer.daemon = True
+            self.update_timer.start()
+
+    def flush_policy_update(self):
+        """ Applies the policy changes update_policy delayed, if any. """
+        with self.policy_lock:
+            if self.update_timer is None:
+                return
+            self.update_timer.cancel()
+            self.update_timer = None
+            self.update_dynamic_sub_pols()
+            self.update_switch_classifiers()
 
 
     def handle_network_change(self):
@@ -232,18 +496,19 @@ class Runtime(object):
 
             # update the policy w/ the new network object
             with self.policy_lock:
-                for policy in self.dynamic_sub_pols:
-                    policy.set_network(self.network)
-                for (sub_pol, full_pol) in self.dynamic_path_preds:
-                    sub_pol.set_network(self.network)
+                with self.swap_lock:
+                    for policy in list(self.dynamic_sub_pols):
+                        policy.set_network(self.network)
+                    for (sub_pol, full_pol) in self.dynamic_path_preds:
+                        sub_pol.set_network(self.network)
+                    self.clear_eval_cache()
 
                 # FIXME(joshreich) :-)
                 # This is a temporary fix. We need to specialize the check below
                 # instead of removing it completely, but will let @joshreich
                 # take care of it. -- ngsrinivas
                 # if self.network_triggered_policy_update:
-                self.update_dynamic_sub_pols()
-                self.update_switch_classifiers()
+                self.update_policy()
                 self.network_triggered_policy_update = False
 
             self.in_network_update = False
@@ -259,48 +524,54 @@ class Runtime(object):
             self.clear_all() 
 
         elif self.mode == 'proactive0' or self.mode == 'proactive1':
-            classifier = self.policy.compile()
+            cache_entry = None
+            classifier = None
+            if self.classifier_cache is not None:
+                cache_entry = self.classifier_cache.entry(self.policy,
+                                                          self.network)
+            if cache_entry is not None:
+                classifier = cache_entry.load_classifier()
+            if classifier is None:
+                classifier = self.policy.compile()
+                if cache_entry is not None:
+                    cache_entry.store_classifier(classifier)
+            else:
+                self.policy._classifier = classifier
             self.log.debug(
                 '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
                                               "generate classifier",
                                               "policy=\n"+repr(self.policy),
                                               "classifier=\n"+repr(classifier)))
-            self.install_classifier(classifier)
+            self.install_classifier(classifier, cache_entry)
 
 
     def update_dynamic_sub_pols(self):
         """
-        Updates the set of active dynamic sub-policies in self.policy
+        Updates the set of active dynamic sub-policies in self.policy.  The
+        policy index keeps it up to date as sub-policies change (see
+        handle_policy_change), so only a new self.policy is walked again.
         """
-        def list_diff_by_f(list1, list2, f):
-            list_diff = []
-            for i in list1:
-                found_i = False
-                for j in list2:
-                    if f(i) == f(j):
-                        found_i = True
-                        break
-                if not found_i:
-                    list_diff.append(i)
-            return list_diff
-
-        def old_but_not_new(old, new):
-            return list_diff_by_f(old, new, id)
-
-        def new_but_not_old(old, new):
-            return list_diff_by_f(new, old, id)
-
-        import copy
-        old_dynamic_sub_pols = copy.copy(self.dynamic_sub_pols)
-        self.dynamic_sub_pols = ast_fold(add_dynamic_sub_pols, list(), self.policy)
-        old = old_dynamic_sub_pols
-        new = self.dynamic_sub_pols
-        for p in old_but_not_new(old, new):
+        if (self.policy_index is not None and
+            self.policy_index.root is self.policy):
+            return
+        old = self.dynamic_sub_pols
+        self.dynamic_sub_pols = set()
+        self.policy_index = PolicyIndex(self.policy,
+                                        self.add_dynamic_sub_pol,
+                                        self.remove_dynamic_sub_pol)
+        for p in old - self.dynamic_sub_pols:
             p.detach()
-        for p in new_but_not_old(old, new):
+
+    def add_dynamic_sub_pol(self, p):
+        if not p in self.dynamic_sub_pols:
+            self.dynamic_sub_pols.add(p)
             p.set_network(self.network)
             p.attach(self.handle_policy_change)
 
+    def remove_dynamic_sub_pol(self, p):
+        self.dynamic_sub_pols.discard(p)
+        p.detach()
+
 
     def handle_path_change(self):
         """ When a dynamic path policy updates its path_policy, initiate
@@ -311,6 +582,7 @@ class Runtime(object):
     def handle_path_change_dyn_pred(self, sub_pol, full_pol):
         recompile_list = on_recompile_path_list(id(sub_pol), full_pol)
         map(lambda p: p.invalidate_classifier(), recompile_list)
+        self.clear_eval_cache()
         self.handle_path_change()
 
     def update_dynamic_sub_path_pols(self, path_pol):
@@ -355,24 +627,96 @@ class Runtime(object):
 # REACTIVE COMPILATION
 #######################
 
-    def reactive0_install(self,in_pkt,out_pkts):
+    def reactive0_install(self,in_pkt,out_pkts,trace=None,inflight=None):
         """
-        Reactively installs switch table entries based on a given policy evaluation.
+        Reactively installs switch table entries based on a given policy
+        evaluation: a megaflow if the fields the evaluation read and wrote
+        are known, else a microflow.
 
         :param in_pkt: the input on which the policy was evaluated
         :type in_pkt: Packet
         :param out_pkts: the output of the evaluation
         :type out_pkts: set Packet
+        :param trace: the fields the evaluation read and wrote, if known
+        :type trace: (set string, set string)
+        :param inflight: whether an install on its way matches in_pkt (see
+            inflight_install), None to look it up
+        :type inflight: bool
         """
-        rule_tuple = self.match_on_all_fields_rule_tuple(in_pkt,out_pkts)
+        if inflight is None:
+            inflight = self.inflight_install(in_pkt) is not None
+        if inflight:
+            # the same rule is already on its way
+            return
+        rule_tuple = None
+        if self.megaflows and trace is not None:
+            rule_tuple = self.megaflow_rule_tuple(in_pkt, out_pkts, trace)
+        if rule_tuple is None:
+            rule_tuple = self.match_on_all_fields_rule_tuple(in_pkt,out_pkts)
         if rule_tuple:
             self.install_rule(rule_tuple)
+            self.add_inflight_install(rule_tuple[0],
+                                      header_deltas(in_pkt, out_pkts))
             self.log.debug(
                 '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
                                               " | install rule",
                                               rule_tuple[0],
                                               'actions='+repr(rule_tuple[2])))
 
+    def inflight_install(self, pkt):
+        """
+        The changes made to pkt by a reactive install on its way to pkt's
+        switch that matches it, as header deltas; None if there is none.
+        """
+        now = time.time()
+        with self.inflight_lock:
+            pending = self.inflight.get(pkt.header.get('switch'))
+            if not pending:
+                return None
+            # installs are awaited in the order they were sent
+            expired = 0
+            while expired < len(pending) and pending[expired][4] <= now:
+                expired += 1
+            del pending[:expired]
+            if not pending:
+                return None
+            pending = list(pending)
+        # rules match on the concrete packet
+        header = self.pyretic2concrete(pkt)
+        version = self.snapshot.version
+        for (xid, pred, deltas, v, deadline) in pending:
+            if v == version and all(header.get(f, MISSING) == val
+                                    for (f, val) in pred.iteritems()):
+                return deltas
+        return None
+
+    def add_inflight_install(self, pred, deltas):
+        """
+        Await the reactive install of a rule matching pred, until the switch
+        answers the barrier sent after it or inflight_timeout seconds pass.
+        """
+        if self.inflight_timeout <= 0:
+            return
+        switch = pred['switch']
+        xid = next(self.barrier_xids)
+        with self.inflight_lock:
+            self.inflight.setdefault(switch, []).append(
+                (xid, pred, deltas, self.snapshot.version,
+                 time.time() + self.inflight_timeout))
+        self.send_barrier(switch, xid)
+
+    def handle_barrier_reply(self, switch, xid):
+        """
+        The switch processed all messages sent before the barrier xid, so
+        the installs awaited up to it are on the switch.
+        """
+        with self.inflight_lock:
+            pending = self.inflight.get(switch, [])
+            for (i, entry) in enumerate(pending):
+                if entry[0] == xid:
+                    del pending[:i + 1]
+                    break
+
     def match_on_all_fields(self, pkt):
         """
         Produces a concrete predicate exactly matching a given packet.
@@ -402,6 +746,45 @@ class Runtime(object):
         """        
         concrete_pkt_in = self.pyretic2concrete(pkt_in)
         concrete_pred = self.match_on_all_fields(concrete_pkt_in)
+        return self.rule_tuple(concrete_pred, pkt_in, concrete_pkt_in, pkts_out)
+
+    def megaflow_rule_tuple(self, pkt_in, pkts_out, trace):
+        """
+        Produces a rule tuple matching the packets the policy evaluates as it
+        does a given packet: those with its values for the header fields the
+        policy looked at, or wrote, while evaluating it (see eval_with_trace).
+
+        :param pkt_in: the input packet
+        :type pkt_in: Packet
+        :param pkts_out: the output of the evaluation
+        :type pkts_out: set Packet
+        :param trace: the fields the evaluation read and wrote
+        :type trace: (set string, set string)
+        :returns: a megaflow rule, None if the policy looked at fields a rule
+            can't match on
+        :rtype: (dict of strings to values, int, list int)
+        """
+        (reads, written) = trace
+        # no packet-in has an outport
+        fields = reads | (written - {'outport'}) | {'switch', 'inport'}
+        if fields & (NETWORK_HEADERS | TRANSPORT_HEADERS):
+            fields.add('ethtype')
+        if fields & TRANSPORT_HEADERS:
+            fields.add('protocol')
+        concrete_pkt_in = self.pyretic2concrete(pkt_in)
+        exact = self.match_on_all_fields(concrete_pkt_in)
+        if not fields <= set(exact):
+            return None
+        concrete_pred = { f : exact[f] for f in fields }
+        return self.rule_tuple(concrete_pred, pkt_in, concrete_pkt_in, pkts_out)
+
+    def rule_tuple(self, concrete_pred, pkt_in, concrete_pkt_in, pkts_out):
+        """
+        Produces a rule tuple matching concrete_pred and changing the input
+        packet into the given set of packets.
+
+        :rtype: (dict of strings to values, int, list int)
+        """
         action_list = []
         
         ### IF NO PKTS OUT THEN INSTALL DROP (EMPTY ACTION LIST)
@@ -460,12 +843,15 @@ class Runtime(object):
                            self.default_cookie,
                            False))
 
-    def install_classifier(self, classifier):
+    def install_classifier(self, classifier, cache_entry=None):
         """
         Proactively installs switch table entries based on the input classifier
 
         :param classifier: the input classifer
         :type classifier: Classifier
+        :param cache_entry: where the switch rules derived from the classifier
+            are looked up and kept, if any
+        :type cache_entry: CacheEntry
         """
         if classifier is None:
             return
@@ -913,13 +1299,19 @@ class Runtime(object):
                     new_rules.append(r + (version,))
                 return new_rules
 
-            switches = self.network.switch_list()
-
-            classifier = switchify(classifier,switches)
-            classifier = concretize(classifier)
-            classifier = check_OF_rules(classifier)
-            classifier = OF_inportize(classifier)
-            new_rules = prioritize(classifier)
+            new_rules = None
+            if cache_entry is not None:
+                new_rules = cache_entry.load_switch_rules()
+            if new_rules is None:
+                switches = self.network.switch_list()
+
+                classifier = switchify(classifier,switches)
+                classifier = concretize(classifier)
+                classifier = check_OF_rules(classifier)
+                classifier = OF_inportize(classifier)
+                new_rules = prioritize(classifier)
+                if cache_entry is not None:
+                    cache_entry.store_switch_rules(new_rules)
             new_rules = add_version(new_rules, curr_classifier_no)
             return new_rules
 
@@ -1268,13 +1660,15 @@ class Runtime(object):
     def delete_rule(self,(concrete_pred,priority)):
         self.backend.send_delete(concrete_pred,priority)
 
-    def send_barrier(self,switch):
-        self.backend.send_barrier(switch)
+    def send_barrier(self,switch,xid=None):
+        self.backend.send_barrier(switch,xid)
 
     def send_clear(self,switch):
         self.backend.send_clear(switch)
 
     def clear_all(self):
+        with self.inflight_lock:
+            self.inflight.clear()
         def f():
             switches = self.network.switch_list()
             for s in switches:
@@ -1301,6 +1695,8 @@ class Runtime(object):
         self.network.handle_switch_join(switch_id)
 
     def handle_switch_part(self,switch_id):
+        with self.inflight_lock:
+            self.inflight.pop(switch_id, None)
         self.network.handle_switch_part(switch_id)
 
     def handle_port_join(self,switch_id,port_id,conf_up,stat_up,port_type):
@@ -1473,6 +1869,22 @@ class Runtime(object):
             assert extended_values is not None, "use of vlan that pyretic didn't allocate! not allowed."
             return extended_values
 
+def header_deltas(pkt, output):
+    """
+    The changes that made each packet of output from pkt, as dicts that
+    Packet.modifymany applies (None for a removed field).
+    """
+    header = pkt.header
+    deltas = []
+    for out in output:
+        delta = {f : v for (f, v) in out.header.iteritems()
+                 if not f in header or header[f] != v}
+        for f in header:
+            if not f in out.header:
+                delta[f] = None
+        deltas.append(delta)
+    return deltas
+
 @util.cached
 def extended_values_from(packet):
     extended_values = {}
@@ -1685,6 +2097,7 @@ class virtual_field:
         self.cardinality = len(values) + 1
         self.type   = type
         virtual_field.fields[name] = self
+        match.generation += 1
 
     def index(self,key):
         try:
@@ -31,6 +31,7 @@
 # Utility functions                                                            #
 ################################################################################
 
+from collections import OrderedDict
 from functools import wraps
 
 from multiprocessing import Lock
@@ -53,6 +54,207 @@ def cached(f):
     wrapper.cache = {}
     return wrapper
 
+def tree_reduce(f, items):
+    """
+    Like reduce(f, items), but combines the items pairwise, then the results
+    pairwise, and so on, so intermediate results stay balanced in size.  f
+    must be associative.
+    """
+    items = list(items)
+    if not items:
+        raise TypeError('tree_reduce() of empty sequence')
+    while len(items) > 1:
+        paired = [f(items[i], items[i+1]) for i in range(0, len(items)-1, 2)]
+        if len(items) % 2:
+            paired.append(items[-1])
+        items = paired
+    return items[0]
+
+class ReductionTree(object):
+    """
+    Computes tree_reduce(f, items) while keeping the intermediate results, so
+    that a later reduce() over a list in which only some items were replaced
+    or appended (items are compared by identity) only recombines the results
+    on the paths from those items to the root.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.levels = [[]]
+
+    def reduce(self, items):
+        items = list(items)
+        if not items:
+            raise TypeError('reduce() of empty sequence')
+        old = self.levels
+        resized = len(items) != len(old[0])
+        m = min(len(items), len(old[0]))
+        dirty = set(i for i in range(m) if items[i] is not old[0][i])
+        dirty.update(range(m, len(items)))
+        levels = [items]
+        while len(levels[-1]) > 1:
+            below = levels[-1]
+            k = len(levels)
+            prev = old[k] if k < len(old) else []
+            dirty = set(i // 2 for i in dirty)
+            if resized:
+                # results over a range of items that ran past m are stale
+                dirty.update(range(m >> k, (len(below) + 1) // 2))
+            level = []
+            for i in range((len(below) + 1) // 2):
+                if i < len(prev) and not i in dirty:
+                    level.append(prev[i])
+                elif 2*i + 1 < len(below):
+                    level.append(self.f(below[2*i], below[2*i + 1]))
+                else:
+                    level.append(below[2*i])
+            levels.append(level)
+        self.levels = levels
+        return levels[-1][0]
+
+class LRUCache(object):
+    """
+    A mapping holding at most size entries, which evicts the least recently
+    used entry to make room and counts the hits and misses of get().
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class PrefixTrie(object):
+    """
+    A map from IPv4 prefixes, given as (network, length) pairs of integers, to
+    values, with longest-prefix-match lookup of addresses.  Chains of nodes
+    with a single child and no value are compressed into one (a Patricia
+    trie), so a lookup visits at most one node per distinct prefix length on
+    the path to the address.
+    """
+    class Node(object):
+        __slots__ = ['net', 'length', 'value', 'children']
+
+        def __init__(self, net, length, value):
+            self.net = net
+            self.length = length
+            self.value = value
+            self.children = [None, None]
+
+    EMPTY = object()   # value of the nodes only there to branch
+
+    def __init__(self):
+        self.root = PrefixTrie.Node(0, 0, PrefixTrie.EMPTY)
+        self.size = 0
+
+    @staticmethod
+    def bit(net, i):
+        """ Bit i of net, counting from the most significant. """
+        return (net >> (31 - i)) & 1
+
+    @staticmethod
+    def common_length(net1, net2, length):
+        """ The length of the longest common prefix of two nets, up to length. """
+        diff = (net1 ^ net2) >> (32 - length) if length else 0
+        if diff == 0:
+            return length
+        return length - diff.bit_length()
+
+    def insert(self, net, length, value):
+        """ Map the prefix to value, replacing any previous value. """
+        net &= (0xffffffff << (32 - length)) & 0xffffffff
+        node = self.root
+        while True:
+            if node.length == length:
+                if node.value is PrefixTrie.EMPTY:
+                    self.size += 1
+                node.value = value
+                return
+            b = PrefixTrie.bit(net, node.length)
+            child = node.children[b]
+            if child is None:
+                node.children[b] = PrefixTrie.Node(net, length, value)
+                self.size += 1
+                return
+            common = PrefixTrie.common_length(child.net, net,
+                                              min(child.length, length))
+            if common == child.length:
+                node = child
+                continue
+            # the new prefix, or a branching node for it, goes between node
+            # and child
+            if common == length:
+                middle = PrefixTrie.Node(net, length, value)
+            else:
+                mask = (0xffffffff << (32 - common)) & 0xffffffff
+                middle = PrefixTrie.Node(net & mask, common, PrefixTrie.EMPTY)
+                middle.children[PrefixTrie.bit(net, common)] = \
+                    PrefixTrie.Node(net, length, value)
+            middle.children[PrefixTrie.bit(child.net, common)] = child
+            node.children[b] = middle
+            self.size += 1
+            return
+
+    def remove(self, net, length):
+        """ Unmap the prefix, raising KeyError if it isn't mapped. """
+        net &= (0xffffffff << (32 - length)) & 0xffffffff
+        path = []
+        node = self.root
+        while node is not None and node.length < length:
+            path.append(node)
+            node = node.children[PrefixTrie.bit(net, node.length)]
+        if (node is None or node.length != length or node.net != net or
+            node.value is PrefixTrie.EMPTY):
+            raise KeyError((net, length))
+        node.value = PrefixTrie.EMPTY
+        self.size -= 1
+        # splice out the nodes left without a value and with at most a child
+        while path and node.value is PrefixTrie.EMPTY:
+            children = [c for c in node.children if c is not None]
+            if len(children) > 1:
+                break
+            parent = path.pop()
+            i = parent.children.index(node)
+            parent.children[i] = children[0] if children else None
+            node = parent
+
+    def lookup(self, addr, default=None):
+        """ The value of the longest prefix containing addr. """
+        value = default
+        node = self.root
+        while node is not None:
+            if node.length and (addr ^ node.net) >> (32 - node.length):
+                break
+            if node.value is not PrefixTrie.EMPTY:
+                value = node.value
+            if node.length == 32:
+                break
+            node = node.children[(addr >> (31 - node.length)) & 1]
+        return value
+
+    def __len__(self):
+        return self.size
+
 class frozendict(object):
     __slots__ = ["_dict", "_cached_hash"]
 
@@ -0,0 +1,155 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+################################################################################
+# SETUP                                                                        #
+# -------------------------------------------------------------------          #
+# python -m pyretic.evaluations.compile_bench [--switches=N] [--hosts=N]       #
+# python -m pyretic.evaluations.compile_bench --members=10,100,400             #
+#                                                                              #
+# Compiles the same policies with each compiler backend (see COMPILER in       #
+# pyretic.core.language) and each provenance setting given with --provenance   #
+# (see PROVENANCE in pyretic.core.classifier), each in a fresh process, and    #
+# reports compile time, peak memory, the memory still in use once the policy   #
+# is compiled, and the number of rules produced.                               #
+# With --members, instead times composing the classifiers of a flood-like      #
+# parallel policy of N members left to right, pairwise, and pairwise with the  #
+# smallest members first (see parallel.generate_classifier).                   #
+################################################################################
+
+import gc
+import os
+import resource
+import time
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+
+import pyretic.core.classifier as classifier
+import pyretic.core.language as language
+from pyretic.core.language import *
+from pyretic.core.network import *
+from pyretic.core import util
+
+
+def mac_forwarding(switches, hosts):
+    """ One rule per (switch, destination MAC), as a learned MAC table. """
+    return parallel([match(switch=s, dstmac=MAC('00:00:00:00:%02x:%02x' %
+                                                (h / 256, h % 256))) >> fwd(h)
+                     for s in range(1, switches + 1)
+                     for h in range(1, hosts + 1)])
+
+def port_monitor(switches, ports):
+    """ Tag every packet with the port it came in on. """
+    return parallel([match(switch=s, inport=p) >> modify(vlan_id=p)
+                     for s in range(1, switches + 1)
+                     for p in range(1, ports + 1)])
+
+def firewall(hosts):
+    """ Block a few source addresses, pass everything else. """
+    blocked = union([match(srcip='10.0.%d.0/24' % h)
+                     for h in range(1, hosts / 10 + 2)])
+    return if_(blocked, drop, identity)
+
+def policies(switches, hosts):
+    routing = mac_forwarding(switches, hosts)
+    monitor = port_monitor(switches, 8)
+    return [('routing', lambda: routing),
+            ('routing + monitor', lambda: routing + monitor),
+            ('firewall >> routing', lambda: firewall(hosts) >> routing)]
+
+def flood_like(members):
+    """ A spanning-tree flood on one switch with the given number of ports. """
+    ports = range(1, members + 1)
+    return [match(switch=1, inport=p) >>
+            parallel([fwd(q) for q in ports[:p % 8 + 1] if q != p])
+            for p in ports]
+
+def members_sweep(sizes):
+    add = lambda c1, c2: c1 + c2
+    by_size = lambda cs: util.tree_reduce(add, sorted(cs, key=len))
+    strategies = [('fold', lambda cs: reduce(add, cs)),
+                  ('pairwise', lambda cs: util.tree_reduce(add, cs)),
+                  ('pairwise, by size', by_size)]
+    print '%-8s %-18s %10s %8s' % ('members', 'composition', 'time (s)',
+                                   'rules')
+    for n in sizes:
+        classifiers = [p.compile() for p in flood_like(n)]
+        for (name, compose) in strategies:
+            start = time.time()
+            c = compose(classifiers)
+            print '%-8d %-18s %10.3f %8d' % (n, name, time.time() - start,
+                                             len(c))
+
+def resident_kb():
+    """ Current resident set size of this process, in kB (Linux only). """
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+def run(backend, provenance, make_policy, results):
+    language.COMPILER = backend
+    classifier.PROVENANCE = provenance
+    policy = make_policy()
+    start = time.time()
+    compiled = policy.compile()
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    gc.collect()
+    results.put((elapsed, peak, resident_kb(), len(compiled)))
+
+def main():
+    op = OptionParser()
+    op.add_option('--switches', type='int', default=4)
+    op.add_option('--hosts', type='int', default=50)
+    op.add_option('--backends', default='classifier,fdd')
+    op.add_option('--provenance', default='off',
+                  help='comma-separated provenance settings: off,ids,full')
+    op.add_option('--members', default=None,
+                  help='comma-separated parallel sizes to sweep')
+    (options, args) = op.parse_args()
+
+    if options.members:
+        members_sweep(map(int, options.members.split(',')))
+        return
+
+    print '%-22s %-10s %-5s %10s %12s %12s %8s' % (
+        'policy', 'backend', 'prov', 'time (s)', 'maxrss (kB)', 'rss (kB)',
+        'rules')
+    for (name, make_policy) in policies(options.switches, options.hosts):
+        for backend in options.backends.split(','):
+            for provenance in options.provenance.split(','):
+                results = Queue()
+                p = Process(target=run,
+                            args=(backend, provenance, make_policy, results))
+                p.start()
+                (elapsed, peak, rss, rules) = results.get()
+                p.join()
+                print '%-22s %-10s %-5s %10.3f %12d %12d %8d' % (
+                    name, backend, provenance, elapsed, peak, rss, rules)
+
+if __name__ == '__main__':
+    main()
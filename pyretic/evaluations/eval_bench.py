@@ -0,0 +1,239 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+################################################################################
+# SETUP                                                                        #
+# -------------------------------------------------------------------          #
+# python -m pyretic.evaluations.eval_bench [--rules=1000,10000,100000]         #
+#                                          [--packets=N]                       #
+#                                                                              #
+# python -m pyretic.evaluations.eval_bench --codegen [--packets=N]             #
+# python -m pyretic.evaluations.eval_bench --lpm=1000,100000,500000            #
+#                                                                              #
+# Evaluates the same packets on synthetic classifiers of the given sizes, one  #
+# packet at a time (Classifier.eval) and as a batch (Classifier.eval_batch),   #
+# checks that both agree, and reports the packets evaluated per second.        #
+# With --codegen, instead evaluates synthetic policies with Policy.eval,       #
+# Policy.eval_batch and the code pyretic.core.codegen generates for them.      #
+# With --lpm, instead builds routing tables of the given numbers of prefixes   #
+# as lpm_tables, and reports the time to build and compile them, the lookups   #
+# per second, and the time to add a prefix and recompile; tables of up to      #
+# 1000 prefixes are also evaluated as the equivalent parallel of matches.      #
+################################################################################
+
+import random
+import time
+from optparse import OptionParser
+
+from pyretic.core import codegen
+from pyretic.core.classifier import Rule, Classifier
+from pyretic.core.language import *
+from pyretic.core.network import *
+from pyretic.core.packet import Packet
+
+
+def synthetic_classifier(size, seed=0):
+    """
+    Routing-table-like rules: per-switch /24 and /32 destination prefixes,
+    some pinned to an input port, over a default rule sending to the
+    controller.
+    """
+    rnd = random.Random(seed)
+    rules = []
+    for i in range(size - 1):
+        s = rnd.randint(1, 16)
+        if rnd.random() < 0.5:
+            dstip = '10.%d.%d.0/24' % (i / 256 % 256, i % 256)
+        else:
+            dstip = '10.%d.%d.%d' % (i / 65536 % 256, i / 256 % 256, i % 256)
+        if rnd.random() < 0.2:
+            m = match(switch=s, inport=rnd.randint(1, 8), dstip=dstip)
+        else:
+            m = match(switch=s, dstip=dstip)
+        rules.append(Rule(m, [modify(outport=rnd.randint(1, 8))]))
+    rules.append(Rule(identity, [Controller]))
+    return Classifier(rules)
+
+def synthetic_packets(size, count, seed=1):
+    rnd = random.Random(seed)
+    return [Packet({'switch': rnd.randint(1, 16),
+                    'inport': rnd.randint(1, 8),
+                    'dstip': IPAddr('10.%d.%d.%d' % (rnd.randint(0, 2),
+                                                     rnd.randint(0, 255),
+                                                     rnd.randint(0, 255)))})
+            for i in range(count)]
+
+def synthetic_policies():
+    """ Policies shaped like the ones interpreted mode runs. """
+    hosts = range(1, 33)
+    routing = parallel([match(dstip='10.0.0.%d' % h) >> fwd(h % 8 + 1)
+                        for h in hosts])
+    blocked = union([match(srcip='10.0.0.%d' % h, dstport=22)
+                     for h in hosts[:8]])
+    firewall = if_(blocked, drop, identity)
+    monitor = parallel([match(switch=s) >> modify(vlan_id=s)
+                        for s in range(1, 17)])
+    return [('routing', routing),
+             ('firewall >> routing', firewall >> routing),
+             ('firewall >> (routing + monitor)',
+              firewall >> DynamicPolicy(routing + monitor))]
+
+def codegen_sweep(count):
+    rnd = random.Random(2)
+    pkts = [Packet({'switch': rnd.randint(1, 16),
+                    'inport': rnd.randint(1, 8),
+                    'srcip': IPAddr('10.0.0.%d' % rnd.randint(1, 40)),
+                    'dstip': IPAddr('10.0.0.%d' % rnd.randint(1, 40)),
+                    'dstport': rnd.choice([22, 80])})
+            for i in range(count)]
+    print '%-34s %14s %14s %14s' % ('policy', 'eval (pkt/s)', 'batch (pkt/s)',
+                                    'codegen (pkt/s)')
+    for (name, policy) in synthetic_policies():
+        evaluate = codegen.evaluator(policy)
+        evaluate(pkts[0])       # generate the code outside the timings
+
+        start = time.time()
+        walked = [policy.eval(pkt) for pkt in pkts]
+        tree = time.time() - start
+
+        start = time.time()
+        batched = policy.eval_batch(pkts)
+        batch = time.time() - start
+
+        start = time.time()
+        generated = [evaluate(pkt) for pkt in pkts]
+        gen = time.time() - start
+
+        assert walked == batched == generated
+        print '%-34s %14.0f %14.0f %14.0f' % (name, len(pkts) / tree,
+                                              len(pkts) / batch,
+                                              len(pkts) / gen)
+
+def synthetic_routes(size, seed=3):
+    """
+    Prefixes distributed over lengths like those of a full routing table:
+    mostly /24s, then /22s and /23s, a few shorter ones.
+    """
+    rnd = random.Random(seed)
+    lengths = [24] * 60 + [23] * 10 + [22] * 12 + [21] * 5 + [20] * 5 + \
+              [19] * 4 + [16] * 3 + [12] + [8]
+    routes = {}
+    while len(routes) < size:
+        length = rnd.choice(lengths)
+        net = rnd.getrandbits(length) << (32 - length)
+        prefix = '%d.%d.%d.%d/%d' % (net >> 24, net >> 16 & 255, net >> 8 & 255,
+                                     net & 255, length)
+        routes[prefix] = fwd(rnd.randint(1, 8))
+    return routes
+
+def lpm_sweep(sizes, count):
+    rnd = random.Random(4)
+    pkts = [Packet({'switch': 1, 'inport': 1,
+                    'dstip': IPAddr('%d.%d.%d.%d' % tuple(rnd.randint(0, 255)
+                                                         for i in range(4)))})
+            for i in range(count)]
+    print '%-8s %10s %12s %14s %14s %12s' % ('prefixes', 'build (s)',
+                                             'compile (s)', 'lpm (pkt/s)',
+                                             'match (pkt/s)', 'update (s)')
+    for size in sizes:
+        routes = synthetic_routes(size)
+        start = time.time()
+        table = lpm_table('dstip', Controller, routes)
+        build = time.time() - start
+
+        start = time.time()
+        c = table.compile()
+        compile_time = time.time() - start
+
+        start = time.time()
+        found = [table.eval(pkt) for pkt in pkts]
+        lpm = len(pkts) / (time.time() - start)
+
+        # the parallel of matches only agrees with the table where no two
+        # prefixes overlap, so it is only timed, not checked
+        linear = float('nan')
+        if size <= 1000:
+            flat = parallel([match(dstip=prefix) >> pol
+                             for (prefix, pol) in routes.iteritems()])
+            start = time.time()
+            for pkt in pkts:
+                flat.eval(pkt)
+            linear = len(pkts) / (time.time() - start)
+
+        assert [c.eval(pkt) for pkt in pkts[:200]] == found[:200]
+
+        start = time.time()
+        table.add('203.0.113.0/24', fwd(1))
+        c = table.compile()
+        update = time.time() - start
+        assert len(c) == size + 2
+
+        print '%-8d %10.3f %12.3f %14.0f %14.0f %12.3f' % (
+            size, build, compile_time, lpm, linear, update)
+
+def main():
+    op = OptionParser()
+    op.add_option('--rules', default='1000,10000,100000',
+                  help='comma-separated classifier sizes')
+    op.add_option('--packets', type='int', default=2000)
+    op.add_option('--codegen', action='store_true', default=False,
+                  help='compare Policy.eval with generated code instead')
+    op.add_option('--lpm', default=None,
+                  help='comma-separated routing table sizes to sweep instead')
+    (options, args) = op.parse_args()
+
+    if options.lpm:
+        lpm_sweep(map(int, options.lpm.split(',')), options.packets)
+        return
+
+    if options.codegen:
+        codegen_sweep(options.packets)
+        return
+
+    print '%-8s %-8s %14s %14s' % ('rules', 'packets', 'eval (pkt/s)',
+                                   'batch (pkt/s)')
+    for size in map(int, options.rules.split(',')):
+        c = synthetic_classifier(size)
+        pkts = synthetic_packets(size, options.packets)
+        c.eval(pkts[0])
+        c.eval_batch(pkts[:1])    # build the indexes outside the timings
+
+        start = time.time()
+        one_by_one = [c.eval(pkt) for pkt in pkts]
+        single = time.time() - start
+
+        start = time.time()
+        batch = c.eval_batch(pkts)
+        batched = time.time() - start
+
+        assert one_by_one == batch
+        print '%-8d %-8d %14.0f %14.0f' % (size, len(pkts),
+                                           len(pkts) / single,
+                                           len(pkts) / batched)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+################################################################################
+# SETUP                                                                        #
+# -------------------------------------------------------------------          #
+# python -m pyretic.evaluations.packet_in_bench [--workers=1,2,4]              #
+#                                               [--packets=N] [--flows=N]      #
+#                                                                              #
+# Feeds the same packet-ins to an interpreted-mode runtime with no switches,   #
+# evaluating them itself and with each number of worker processes given (see  #
+# pyretic.core.packet_pool), checks that the packets of each flow are sent     #
+# out in the order they came in, and reports the packet-ins handled per        #
+# second.  The evaluation cache is off unless --eval-cache-size is given, so   #
+# that every packet is evaluated.                                              #
+#                                                                              #
+# python -m pyretic.evaluations.packet_in_bench --reactive [--connections=N]   #
+#                                                                              #
+# Instead runs a reactive0 runtime against a simulated switch, which only      #
+# sends the packets no installed rule matches to the controller, once          #
+# installing exact-match microflows and once megaflows, and reports the        #
+# packet-ins and rules each needed for short TCP connections to a few servers. #
+# The switch applies the rules and answers the barriers it is sent --delay     #
+# packets after getting them, and the packet-ins, the policy evaluations and   #
+# the flow-mods are also counted with the runtime not tracking the installs    #
+# still on their way (see Runtime.inflight_install).                           #
+################################################################################
+
+import random
+import threading
+import time
+from optparse import OptionParser
+
+from pyretic.core.language import *
+from pyretic.core.network import *
+from pyretic.core.packet import get_packet_processor
+from pyretic.core.runtime import Runtime
+
+
+class Backend(object):
+    """ Counts the packets the runtime sends, and keeps their flows. """
+    def __init__(self, expected):
+        self.expected = expected
+        self.sent = []
+        self.done = threading.Event()
+
+    def send_packet(self, concrete_pkt):
+        self.sent.append(concrete_pkt['raw'])
+        if len(self.sent) == self.expected:
+            self.done.set()
+
+def synthetic_policy(hosts):
+    blocked = union([match(srcip='10.0.%d.1' % h, dstport=22)
+                     for h in range(hosts / 4)])
+    routing = parallel([match(dstip='10.0.%d.1' % h) >> fwd(h % 8 + 1)
+                        for h in range(hosts)])
+    mirror = parallel([match(switch=s) >> fwd(s % 8 + 1)
+                       for s in range(1, 17)])
+    return if_(blocked, drop, identity) >> (routing + mirror)
+
+def synthetic_packet_ins(count, flows, hosts, seed=5):
+    """
+    Packet-ins of the given number of TCP flows between the hosts.  The TOS
+    field of each packet numbers it within its flow, so that the order the
+    packets of a flow are sent out in can be checked.
+    """
+    rnd = random.Random(seed)
+    pack = get_packet_processor().pack
+    flow_headers = []
+    for i in range(flows):
+        flow_headers.append((rnd.randint(1, 16),
+                             {'raw': '', 'ethtype': 0x800, 'protocol': 6,
+                              'srcmac': MAC('00:00:00:00:00:01'),
+                              'dstmac': MAC('00:00:00:00:00:02'),
+                              'srcip': IP('10.0.%d.1' % rnd.randint(0, hosts)),
+                              'dstip': IP('10.0.%d.1' % rnd.randint(0, hosts)),
+                              'srcport': rnd.randint(1024, 65535),
+                              'dstport': rnd.choice([22, 80])}))
+    sent = [0] * flows
+    pkts = []
+    for i in range(count):
+        f = rnd.randrange(flows)
+        (switch, headers) = flow_headers[f]
+        raw = pack(dict(headers, tos=sent[f] % 256))
+        sent[f] += 1
+        pkts.append({'switch': switch, 'inport': 1, 'raw': raw})
+    return pkts
+
+def flows_in_order(sent):
+    """ Whether the packets of each flow were sent in the order received. """
+    unpack = get_packet_processor().unpack
+    numbers = {}
+    for raw in sent:
+        h = unpack(raw)
+        flow = (h['srcip'], h['dstip'], h['srcport'], h['dstport'])
+        seen = numbers.setdefault(flow, [])
+        # a packet is sent once per output port, one after the other
+        if not seen or seen[-1] != h['tos']:
+            seen.append(h['tos'])
+    return all(seen == [i % 256 for i in range(len(seen))]
+               for seen in numbers.values())
+
+def run(policy, pkts, workers, eval_cache_size, expected):
+    """
+    Time the handling of pkts by a runtime with the given number of workers,
+    until it sent the expected number of packets.
+    """
+    backend = Backend(expected)
+    runtime = Runtime(backend, lambda: policy, None, {}, mode='interpreted',
+                      eval_cache_size=eval_cache_size, workers=workers)
+    if runtime.packet_pool is not None:
+        runtime.packet_pool.start()   # fork the workers outside the timings
+    start = time.time()
+    for pkt in pkts:
+        runtime.handle_packet_in(pkt)
+    if runtime.packet_pool is not None:
+        backend.done.wait()
+    elapsed = time.time() - start
+    if runtime.packet_pool is not None:
+        runtime.packet_pool.stop()
+    return (elapsed, backend.sent)
+
+class Switch(object):
+    """
+    A backend keeping the rules installed, in a table per switch, and
+    counting the packets sent.  Rules are indexed by the fields they match
+    on, so that matching a packet costs a lookup per set of fields.
+
+    The rules and barriers sent take effect, in order, once delay more
+    packets arrived (see arrive).
+    """
+    def __init__(self, delay=0):
+        self.tables = {}
+        self.sent = 0
+        self.flow_mods = 0
+        self.delay = delay
+        self.arrived = 0
+        self.messages = []    # (arrival due, function, arguments)
+        self.runtime = None
+
+    def send_packet(self, concrete_pkt):
+        self.sent += 1
+
+    def send_install(self, pred, priority, action_list, cookie, notify=False):
+        self.flow_mods += 1
+        self.messages.append((self.arrived + self.delay, self.install, pred))
+
+    def install(self, pred):
+        fields = tuple(sorted(pred))
+        table = self.tables.setdefault(pred['switch'], {})
+        table.setdefault(fields, set()).add(tuple(pred[f] for f in fields))
+
+    def send_barrier(self, switch, xid=None):
+        self.messages.append((self.arrived + self.delay, self.barrier_reply,
+                              (switch, xid)))
+
+    def barrier_reply(self, (switch, xid)):
+        self.runtime.handle_barrier_reply(switch, xid)
+
+    def send_clear(self, switch):
+        self.tables.pop(switch, None)
+
+    def arrive(self):
+        """ A packet arrives: apply the messages now due. """
+        self.arrived += 1
+        due = 0
+        while (due < len(self.messages) and
+               self.messages[due][0] <= self.arrived):
+            (_, f, args) = self.messages[due]
+            f(args)
+            due += 1
+        del self.messages[:due]
+
+    def matches(self, header):
+        for (fields, values) in self.tables.get(header['switch'], {}).items():
+            if tuple(header.get(f) for f in fields) in values:
+                return True
+        return False
+
+    def rules(self):
+        return sum(len(values) for table in self.tables.values()
+                   for values in table.values())
+
+def connections(count, servers, packets, seed=6):
+    """
+    Packet-ins of count TCP connections from random clients to a few web
+    and SSH servers, each of the given number of packets.
+    """
+    rnd = random.Random(seed)
+    pack = get_packet_processor().pack
+    pkts = []
+    for i in range(count):
+        headers = {'raw': '', 'ethtype': 0x800, 'protocol': 6, 'tos': 0,
+                   'srcmac': MAC('00:00:00:00:01:%02x' % rnd.randint(1, 255)),
+                   'dstmac': MAC('00:00:00:00:00:01'),
+                   'srcip': IP('10.1.%d.%d' % (rnd.randint(0, 255),
+                                               rnd.randint(1, 254))),
+                   'dstip': IP('10.0.0.%d' % rnd.randint(1, servers)),
+                   'srcport': rnd.randint(1024, 65535),
+                   'dstport': rnd.choice([22, 80, 80, 80])}
+        raw = pack(headers)
+        pkts.extend([{'switch': 1, 'inport': 1, 'raw': raw}] * packets)
+    return pkts
+
+def reactive(pkts, servers, megaflows, delay=0, inflight=True):
+    """
+    The packet-ins, policy evaluations, flow-mods and rules reactive0 needs
+    for pkts, with rules taking delay packets to reach the switch.
+    """
+    web = parallel([match(dstip='10.0.0.%d' % h) >> fwd(h % 8 + 2)
+                    for h in range(1, servers + 1)])
+    policy = if_(match(dstport=22), drop, web)
+    switch = Switch(delay)
+    runtime = Runtime(switch, lambda: policy, None, {}, mode='reactive0')
+    switch.runtime = runtime
+    runtime.megaflows = megaflows
+    if not inflight:
+        runtime.inflight_timeout = 0
+    evaluations = [0]
+    interpret = runtime.interpret
+    def counted(pyretic_pkt, *args):
+        evaluations[0] += 1
+        return interpret(pyretic_pkt, *args)
+    runtime.interpret = counted
+    unpack = get_packet_processor().unpack
+    headers = {}
+    packet_ins = 0
+    start = time.time()
+    for pkt in pkts:
+        switch.arrive()
+        if not pkt['raw'] in headers:
+            header = dict(unpack(pkt['raw']), switch=pkt['switch'],
+                          inport=pkt['inport'])
+            for field in ['srcip', 'dstip']:
+                header[field] = IP(header[field])
+            for field in ['srcmac', 'dstmac']:
+                header[field] = MAC(header[field])
+            headers[pkt['raw']] = header
+        if not switch.matches(headers[pkt['raw']]):
+            packet_ins += 1
+            runtime.handle_packet_in(pkt)
+    elapsed = time.time() - start
+    return (packet_ins, evaluations[0], switch.flow_mods, switch.rules(),
+            elapsed)
+
+def reactive_sweep(count, servers, packets, delay):
+    pkts = connections(count, servers, packets)
+    print '%-12s %-9s %8s %11s %12s %10s %7s %9s' % (
+        'installing', 'in-flight', 'packets', 'packet-ins', 'evaluations',
+        'flow-mods', 'rules', 'time (s)')
+    for (name, megaflows) in [('microflows', False), ('megaflows', True)]:
+        for inflight in [False, True]:
+            (packet_ins, evaluations, flow_mods, rules, elapsed) = \
+                reactive(pkts, servers, megaflows, delay, inflight)
+            print '%-12s %-9s %8d %11d %12d %10d %7d %9.3f' % (
+                name, 'tracked' if inflight else 'ignored', len(pkts),
+                packet_ins, evaluations, flow_mods, rules, elapsed)
+
+def main():
+    op = OptionParser()
+    op.add_option('--workers', default='1,2,4',
+                  help='comma-separated numbers of worker processes')
+    op.add_option('--packets', type='int', default=5000)
+    op.add_option('--flows', type='int', default=200)
+    op.add_option('--hosts', type='int', default=64)
+    op.add_option('--eval-cache-size', dest='eval_cache_size', type='int',
+                  default=0)
+    op.add_option('--reactive', action='store_true', default=False,
+                  help='count the packet-ins and rules of reactive0 instead')
+    op.add_option('--connections', type='int', default=2000)
+    op.add_option('--servers', type='int', default=8)
+    op.add_option('--delay', type='int', default=20,
+                  help='packets arriving before a rule is on the switch')
+    (options, args) = op.parse_args()
+
+    if options.reactive:
+        reactive_sweep(options.connections, options.servers, 5,
+                       options.delay)
+        return
+
+    policy = synthetic_policy(options.hosts)
+    pkts = synthetic_packet_ins(options.packets, options.flows, options.hosts)
+    print '%-8s %10s %14s %8s' % ('workers', 'time (s)', 'packet-ins/s',
+                                  'ordered')
+    (elapsed, serial) = run(policy, pkts, 0, options.eval_cache_size, None)
+    print '%-8d %10.3f %14.0f %8s' % (0, elapsed, len(pkts) / elapsed,
+                                      flows_in_order(serial))
+    for workers in map(int, options.workers.split(',')):
+        (elapsed, sent) = run(policy, pkts, workers, options.eval_cache_size,
+                              len(serial))
+        assert sorted(sent) == sorted(serial)
+        print '%-8d %10.3f %14.0f %8s' % (workers, elapsed,
+                                          len(pkts) / elapsed,
+                                          flows_in_order(sent))
+
+if __name__ == '__main__':
+    main()
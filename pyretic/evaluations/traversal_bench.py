@@ -0,0 +1,92 @@
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+################################################################################
+# SETUP                                                                        #
+# -------------------------------------------------------------------          #
+# python -m pyretic.evaluations.traversal_bench [--nodes=100000]               #
+#                                                                              #
+# Walks a wide policy (a parallel composition of forwarding rules) and a deep  #
+# one (if_ and DynamicPolicy nested in each other) of about the given number   #
+# of nodes with ast_fold, ast_map and queries_in_eval, and reports the time    #
+# each takes, or that it ran into the recursion limit.                         #
+################################################################################
+
+import time
+from optparse import OptionParser
+
+from pyretic.core.language import *
+from pyretic.core.language_tools import ast_fold, ast_map, queries_in_eval
+from pyretic.core.packet import Packet
+
+
+def wide_policy(nodes):
+    """ match >> fwd rules in parallel, each four nodes. """
+    return parallel([match(switch=i % 16, inport=i) >> fwd(i % 8 + 1)
+                     for i in range(nodes / 4)])
+
+def deep_policy(nodes):
+    """
+    if_ and DynamicPolicy alternately wrapping each other, the if_ letting
+    the packets of main() through.
+    """
+    policy = fwd(1)
+    for i in range(nodes / 4):
+        if i % 2:
+            policy = if_(match(inport=1), policy, drop)
+        else:
+            policy = DynamicPolicy(policy)
+    return policy
+
+def timed(f):
+    start = time.time()
+    try:
+        f()
+    except RuntimeError:
+        return 'recursion limit'
+    return '%.3f' % (time.time() - start)
+
+def main():
+    op = OptionParser()
+    op.add_option('--nodes', type='int', default=100000)
+    (options, args) = op.parse_args()
+
+    pkt = Packet({'switch': 1, 'inport': 1})
+    print '%-6s %8s %16s %16s %16s' % ('policy', 'nodes', 'ast_fold (s)',
+                                       'ast_map (s)', 'queries (s)')
+    for (name, make_policy) in [('wide', wide_policy), ('deep', deep_policy)]:
+        policy = make_policy(options.nodes)
+        count = [0]
+        def fold():
+            count[0] = ast_fold(lambda acc, p: acc + 1, 0, policy)
+        folded = timed(fold)
+        mapped = timed(lambda: ast_map(lambda p, children: p, policy))
+        queried = timed(lambda: queries_in_eval((set(), {pkt}), policy))
+        print '%-6s %8d %16s %16s %16s' % (name, count[0], folded, mapped,
+                                           queried)
+
+if __name__ == '__main__':
+    main()
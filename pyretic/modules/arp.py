@@ -76,10 +76,8 @@ def send_arp(msg_type,network,switch,outport,srcip,srcmac,dstip,dstmac):
 
 def translate(mac_of={}):
     """Translate dstmac based on input IP/MAC mapping"""
-    known_ip = parallel([ match(dstip=ip) >> modify(dstmac=mac) 
-                          for (ip,mac) in mac_of.iteritems() ])
-    unknown_ip = ~dstip_in(mac_of.keys())
-    return known_ip + unknown_ip
+    return lpm_table('dstip', identity,
+                     { ip : modify(dstmac=mac) for (ip,mac) in mac_of.iteritems() })
 
 
 class arp(DynamicPolicy):
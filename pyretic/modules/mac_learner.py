@@ -53,7 +53,9 @@ class mac_learner(DynamicPolicy):
     def set_initial_state(self):
         self.query = packets(1,['srcmac','switch'])
         self.query.register_callback(self.learn_new_MAC)
-        self.forward = self.flood  # REUSE A SINGLE FLOOD INSTANCE
+        # FORWARD ON LEARNED (switch,dstmac), FLOOD THE REST
+        self.forward = match_table(['switch','dstmac'],
+                                   self.flood)  # REUSE A SINGLE FLOOD INSTANCE
         self.update_policy()
 
     def set_network(self,network):
@@ -65,11 +67,7 @@ class mac_learner(DynamicPolicy):
 
     def learn_new_MAC(self,pkt):
         """Update forward policy based on newly seen (mac,port)"""
-        self.forward = if_(match(dstmac=pkt['srcmac'],
-                                switch=pkt['switch']),
-                          fwd(pkt['inport']),
-                          self.forward) 
-        self.update_policy()
+        self.forward.add((pkt['switch'],pkt['srcmac']),fwd(pkt['inport']))
        
 
 def main():
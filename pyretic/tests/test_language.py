@@ -111,6 +111,378 @@ def test_repeat_initialization():
     assert c2.rules == [Rule(identity, [drop])]
 
 
+# Indexed evaluation
+
+def _linear_eval(classifier, pkt):
+    for rule in classifier.rules:
+        pkts = rule.eval(pkt)
+        if pkts is not None:
+            return pkts
+    raise TypeError('Classifier is not total.')
+
+def _rules_summary(classifier):
+    """ The rules of classifier, with their actions in a canonical order. """
+    return [ (r.match, sorted(map(repr, r.actions))) for r in classifier.rules ]
+
+def _packet_grid(**values):
+    """
+    A packet for each combination of the given values of each field, None
+    leaving the field out of the packet.  Addresses are given as strings.
+    """
+    import itertools
+    fields = sorted(values)
+    def value(f, v):
+        if f in ['srcip', 'dstip']:
+            return IPAddr(v)
+        elif f in ['srcmac', 'dstmac']:
+            return EthAddr(v)
+        return v
+    return [ Packet(dict((f, value(f, v))
+                         for (f, v) in zip(fields, combination)
+                         if v is not None))
+             for combination in itertools.product(*[values[f]
+                                                    for f in fields]) ]
+
+def test_indexed_and_batch_eval_match_linear_scan():
+    from pyretic.core import classifier
+    c = Classifier([
+        Rule(match(switch=1, dstip='10.0.1.0/24'), [modify(outport=1)]),
+        Rule(match(srcip='10.0.0.0/8', dstip='10.0.0.0/16'),
+             [modify(outport=2)]),
+        Rule(~match(inport=3), [modify(outport=3)]),
+        Rule(match(switch=2, dstmac=EthAddr('00:00:00:00:00:01')),
+             [modify(outport=4), modify(outport=5)]),
+        Rule(match(switch=2, dstmac=EthAddr('00:00:00:00:00:01')),
+             [modify(outport=6)]),
+        Rule(drop, [modify(outport=7)]),
+        Rule(match(inport=3, srcip='0.0.0.0/0'), [Controller]),
+        Rule(match(switch=3), [drop]),
+        Rule(identity, [identity]) ])
+    pkts = _packet_grid(switch=[1, 2, 3], inport=[1, 3],
+                        srcip=['10.0.0.1', None],
+                        dstip=['10.0.0.1', '10.0.1.7', '10.1.0.1', None],
+                        dstmac=['00:00:00:00:00:01', None])
+    expected = [_linear_eval(c, pkt) for pkt in pkts]
+    assert [c.eval(pkt) for pkt in pkts] == expected
+    assert c.eval_batch(pkts) == expected
+    numpy = classifier.numpy
+    classifier.numpy = None
+    try:
+        assert c.eval_batch(pkts) == expected
+    finally:
+        classifier.numpy = numpy
+    c.rules.pop()
+    with pytest.raises(TypeError):
+        c.eval_batch(pkts)
+
+def test_indexed_eval_sees_appended_rules():
+    c = Classifier([Rule(match(inport=1), [modify(outport=1)])])
+    pkt = Packet({'inport' : 2})
+    with pytest.raises(TypeError):
+        c.eval(pkt)
+    c.append(Rule(identity, [modify(outport=2)]))
+    assert c.eval(pkt) == {pkt.modify(outport=2)}
+
+def test_policy_batch_eval_matches_eval():
+    pkts = _packet_grid(switch=[1, 2, 3], inport=[1, 3],
+                        dstip=['10.0.1.7', '10.1.0.1', None])
+    pols = [ identity, drop, Controller, modify(outport=2),
+             ~match(inport=3) >> fwd(2),
+             if_(match(dstip='10.0.0.0/16'),
+                 modify(dstip='10.0.1.1') >> match(dstip='10.0.1.0/24'),
+                 fwd(1) + fwd(3)) >> (match(outport=1) + match(switch=2)),
+             if_(match(switch=3), drop) >>
+             ((match(inport=1) + match(inport=3)) >> fwd(1) >> fwd(2)) ]
+    for pol in pols:
+        assert pol.eval_batch(pkts) == [pol.eval(pkt) for pkt in pkts]
+    assert (match(switch=1) >> identity).eval_batch([]) == []
+
+def test_policy_batch_eval_overridden_eval():
+    class first_port(DerivedPolicy):
+        def __init__(self):
+            super(first_port, self).__init__(fwd(2))
+        def eval(self, pkt):
+            return {pkt.modify(outport=1)}
+    pkts = _packet_grid(switch=[1, 2, 3], inport=[1, 3])
+    b = FwdBucket()
+    pol = first_port() + (match(switch=1) >> b)
+    assert pol.eval_batch(pkts) == [pol.eval(pkt) for pkt in pkts]
+    assert b.bucket == set(pkt for pkt in pkts if pkt['switch'] == 1)
+
+
+# Match evaluation
+
+def test_match_eval_precompiled():
+    m = match(inport=1, srcip='10.0.0.0/8')
+    def pkt(**fields):
+        return Packet(dict(switch=1, **fields))
+    assert m.eval(pkt(inport=1, srcip=IPAddr('10.1.2.3'))) != set()
+    assert m.eval(pkt(inport=1, srcip='10.1.2.3')) != set()
+    assert m.eval(pkt(inport=1, srcip='junk')) == set()
+    assert m.eval(pkt(inport=1, srcip='11.1.2.3')) == set()
+    assert m.eval(pkt(inport=2, srcip='10.1.2.3')) == set()
+    assert m.eval(pkt(inport=1)) == set()
+    assert match(vlan_id=None).eval(pkt(inport=1)) != set()
+    assert match(vlan_id=None).eval(pkt(vlan_id=3)) == set()
+
+def test_match_eval_sees_new_virtual_fields():
+    from pyretic.core.runtime import virtual_field
+    m = match(test_vf='b')
+    pkt = Packet({'switch' : 1, 'inport' : 1})
+    assert m.eval(pkt) == {pkt}
+    virtual_field('test_vf', ['a', 'b'])
+    try:
+        assert m.eval(pkt) == set()
+    finally:
+        del virtual_field.fields['test_vf']
+        match.generation += 1
+    assert m.eval(pkt) == {pkt}
+
+
+# Interning
+
+def test_interned_leaf_policies():
+    assert match(switch=1, srcip='10.0.0.1') is match(srcip='10.0.0.1', switch=1)
+    assert match(switch=1) is not match(switch=2)
+    assert modify(outport=1) is modify({'outport' : 1})
+    assert fwd(1) is fwd(1) and fwd(1).policy is modify(outport=1)
+    assert match(switch=1).compile() is match(switch=1).compile()
+    assert match(switch=[1]) is not match(switch=[1])
+    assert modify(vlan_id=True) is not modify(vlan_id=1)
+    assert modify(vlan_id=True).map['vlan_id'] is True
+    assert match(switch=1L) is not match(switch=1) and fwd(True) is not fwd(1)
+    from pyretic.core import language
+    language.INTERN = False
+    try:
+        assert match(switch=1) is not match(switch=1)
+    finally:
+        language.INTERN = True
+
+def test_interned_modify_unchanged_by_sequencing():
+    m = modify(srcip='10.0.0.1')
+    (m >> modify(dstip='10.0.0.2')).compile()
+    assert m.map == {'srcip' : '10.0.0.1'}
+
+
+# Structural hashing
+
+def test_structural_hash_consistent_with_eq():
+    def pol(port):
+        return (if_(match(switch=1), fwd(port), drop) +
+                (match(inport=2) >> modify(vlan_id=3) >> fwd(1)))
+    assert pol(1) == pol(1) and hash(pol(1)) == hash(pol(1))
+    assert pol(1) != pol(2) and hash(pol(1)) != hash(pol(2))
+    assert hash(identity) == hash(match())
+    compiled = { pol(1) : 'compiled' }
+    assert compiled[pol(1)] == 'compiled'
+    assert not pol(2) in compiled
+
+def test_structural_hash_follows_dynamic_change():
+    d1 = DynamicPolicy(fwd(1))
+    d2 = DynamicPolicy(fwd(1))
+    p1 = match(switch=1) >> d1
+    p2 = match(switch=1) >> d2
+    assert p1 == p2 and hash(p1) == hash(p2)
+    d1.policy = fwd(2)
+    assert p1 != p2 and hash(p1) != hash(p2)
+    d2.policy = fwd(2)
+    assert p1 == p2 and hash(p1) == hash(p2)
+    assert d1 in set([d1]) and not d1 in set([d2])
+
+
+# Match tables
+
+def test_match_table_matches_if_chain():
+    macs = [ EthAddr('00:00:00:00:00:0%d' % i) for i in [1, 2] ]
+    entries = [ ((1, macs[0]), fwd(1)),
+                ((1, macs[1]), fwd(2) + fwd(3)),
+                ((2, macs[0]), match(inport=2) >> fwd(3)),
+                ((1, macs[0]), fwd(4)) ]
+    pkts = _packet_grid(switch=[1, 2, 3], inport=[1, 2],
+                        dstmac=['00:00:00:00:00:01', '00:00:00:00:00:02',
+                                '00:00:00:00:00:03', None])
+    default = match(inport=1) >> fwd(9)
+    table = match_table(['switch', 'dstmac'], default)
+    chain = default
+    for (key, pol) in entries:
+        table.add(key, pol)
+        chain = if_(match(switch=key[0], dstmac=key[1]), pol, chain)
+    c = table.compile()
+    # a rule per entry (two for the one filtering on inport), then the default
+    assert len(c) == 1 + 1 + 2 + len(default.compile())
+    for pkt in pkts:
+        assert table.eval(pkt) == chain.eval(pkt)
+        assert c.eval(pkt) == chain.eval(pkt)
+    assert table.eval_batch(pkts) == [chain.eval(pkt) for pkt in pkts]
+
+def test_match_table_add_remove():
+    mac = EthAddr('00:00:00:00:00:01')
+    table = match_table(['switch', 'dstmac'], drop)
+    (key, pol) = ((1, mac), fwd(1))
+    table.add(key, pol)
+    pkt = Packet({'switch' : 1, 'inport' : 1, 'dstmac' : mac})
+    assert table.compile().eval(pkt) == fwd(1).eval(pkt)
+    table.remove(key)
+    assert table.compile().eval(pkt) == set()
+    assert table.eval(pkt) == set()
+    notified = []
+    table.attach(notified.append)
+    table.add(key, pol)
+    assert notified == [table]
+    assert table.policy is table.policy
+    built = table.policy
+    table.add((2, mac), fwd(2) + fwd(3))
+    assert table.policy is not built
+    other_pkt = pkt.modify(switch=2)
+    assert table.policy.eval(other_pkt) == table.eval(other_pkt)
+    table.policy = fwd(7)
+    assert notified == [table, table, table] and not table.table
+    assert table.eval(pkt) == table.compile().eval(pkt) == fwd(7).eval(pkt)
+    other = match_table(['switch', 'dstmac'], fwd(7))
+    assert table != other and len({table, other}) == 2
+
+def test_match_table_sub_policies():
+    from pyretic.core.language_tools import (ast_fold, add_dynamic_sub_pols,
+                                             on_recompile_path_list)
+    d = DynamicPolicy(fwd(1))
+    table = match_table(['switch'], d, {(1,) : fwd(2)})
+    pol = table + match(switch=2)
+    assert ast_fold(add_dynamic_sub_pols, list(), pol) == [table, d]
+    assert on_recompile_path_list(id(d), pol) == [pol, table, d]
+
+
+# LPM tables
+
+def test_lpm_table_matches_if_chain():
+    routes = [ ('10.0.0.0/8', fwd(1)),
+               ('10.1.0.0/16', fwd(2)),
+               ('10.1.2.0/24', match(inport=1) >> fwd(3)),
+               ('10.1.2.3/32', fwd(4)),
+               ('0.0.0.0/1', fwd(5)) ]
+    pkts = _packet_grid(switch=[1], inport=[1, 2],
+                        dstip=['10.0.0.1', '10.1.0.1', '10.1.2.1', '10.1.2.3',
+                               '20.0.0.1', '192.168.0.1', None])
+    default = match(inport=2) >> fwd(9)
+    table = lpm_table('dstip', default, dict(routes))
+    chain = default
+    for (prefix, pol) in sorted(routes, key=lambda r: int(r[0].split('/')[1])):
+        chain = if_(match(dstip=prefix), pol, chain)
+    c = table.compile()
+    assert len(c) == len(routes) + 1 + len(default.compile())
+    for pkt in pkts:
+        assert table.eval(pkt) == chain.eval(pkt)
+        assert table.policy.eval(pkt) == chain.eval(pkt)
+        assert c.eval(pkt) == chain.eval(pkt)
+    assert table.eval_batch(pkts) == [chain.eval(pkt) for pkt in pkts]
+
+def test_lpm_table_add_remove():
+    table = lpm_table('dstip', drop, {'10.0.0.0/8' : fwd(1),
+                                      '10.1.0.0/16' : fwd(2)})
+    pkt = Packet({'dstip' : IPAddr('10.1.2.3')})
+    assert table.compile().eval(pkt) == fwd(2).eval(pkt)
+    table.add('10.1.2.3/32', fwd(4))
+    assert table.eval(pkt) == fwd(4).eval(pkt)
+    assert table.compile().eval(pkt) == fwd(4).eval(pkt)
+    table.remove('10.1.0.0/16')
+    assert table.eval(pkt) == fwd(4).eval(pkt)
+    table.remove('10.1.2.3/32')
+    assert table.eval(pkt) == fwd(1).eval(pkt)
+    assert table.compile().eval(pkt) == fwd(1).eval(pkt)
+    table.policy = fwd(7)
+    assert table.eval(pkt) == table.policy.eval(pkt) == fwd(7).eval(pkt)
+    table.add('10.0.0.0/8', fwd(1))
+    assert table.eval(pkt) == table.compile().eval(pkt) == fwd(1).eval(pkt)
+    # prefixes are kept in canonical form
+    table.add('10.1.2.9/24', fwd(3))
+    assert sorted(table.table) == ['10.0.0.0/8', '10.1.2.0/24']
+
+def test_prefix_trie():
+    t = util.PrefixTrie()
+    t.insert(10 << 24, 8, 'a')
+    t.insert((10 << 24) | (1 << 16), 16, 'b')
+    t.insert((10 << 24) | (2 << 16), 16, 'c')
+    assert len(t) == 3
+    assert t.lookup((10 << 24) | (1 << 16) | 5) == 'b'
+    assert t.lookup((10 << 24) | (3 << 16)) == 'a'
+    assert t.lookup(11 << 24, 'none') == 'none'
+    t.remove(10 << 24, 8)
+    assert t.lookup((10 << 24) | (3 << 16)) is None
+    assert t.lookup((10 << 24) | (2 << 16)) == 'c'
+    assert len(t) == 2
+
+
+# Traversals
+
+def test_traversals_past_recursion_limit():
+    import sys
+    from pyretic.core.language_tools import (ast_fold, ast_map,
+                                             queries_in_eval, default_mapper)
+    bucket = CountBucket()
+    pol = bucket
+    for i in range(sys.getrecursionlimit()):
+        pol = DynamicPolicy(pol) if i % 2 else if_(match(inport=1), pol, drop)
+    assert ast_fold(lambda acc, p: acc + 1, 0, pol) > sys.getrecursionlimit()
+    copied = ast_map(default_mapper, pol)
+    queries = lambda acc, p: acc + [p] if isinstance(p, Query) else acc
+    assert ast_fold(queries, [], copied) == [bucket]
+    pkt = Packet({'switch' : 1, 'inport' : 1})
+    assert queries_in_eval((set(), {pkt}), pol) == ({bucket}, set())
+    assert queries_in_eval((set(), {pkt.modify(inport=2)}), pol) == (set(), set())
+
+
+def test_eval_with_queries_matches_two_passes():
+    from pyretic.core.language_tools import queries_in_eval, eval_with_queries
+    b1, b2, b3 = CountBucket(), FwdBucket(), CountBucket()
+    table = match_table(['switch'], b3, {(1,) : fwd(1) + b2})
+    pol = (if_(match(inport=1), modify(vlan_id=2) >> b1, ~match(switch=2))
+           >> (table + fwd(3)))
+    for pkt in _packet_grid(switch=[1, 2, 3], inport=[1, 2]):
+        (queries, _) = queries_in_eval((set(), {pkt}), pol)
+        assert eval_with_queries(pol, pkt) == (queries, pol.eval(pkt))
+
+
+# Evaluation cache
+
+def test_eval_fields():
+    from pyretic.core.language_tools import eval_fields
+    pol = (match(switch=1, srcip='10.0.0.1') >> fwd(2)) + (~match(inport=3))
+    assert eval_fields(pol) == {'switch', 'srcip', 'inport', 'outport'}
+    assert eval_fields(breakpoint(pol)) is None
+    class by_srcport(DynamicPolicy):
+        def eval(self, pkt):
+            return {pkt} if pkt['srcport'] == 80 else set()
+    assert eval_fields(by_srcport(pol)) is None
+    assert eval_fields(if_(match(dstport=22), drop, pol)) == \
+        {'switch', 'srcip', 'inport', 'outport', 'dstport'}
+
+def test_eval_cache_deltas_replay_eval():
+    from pyretic.core.language_tools import eval_fields
+    from pyretic.core.runtime import header_deltas
+    pol = ((match(switch=1) >> (fwd(1) + (modify(srcip='10.0.0.9') >> fwd(2))))
+           + (match(switch=2) >> modify(vlan_id=None) >> fwd(3)))
+    fields = sorted(eval_fields(pol))
+    for s in [1, 2]:
+        first = Packet({'switch' : s, 'inport' : 1, 'vlan_id' : 5,
+                        'dstip' : IPAddr('10.0.0.1')})
+        second = first.modify(dstip=IPAddr('10.0.0.2'))
+        assert ([first.header.get(f) for f in fields] ==
+                [second.header.get(f) for f in fields])
+        deltas = header_deltas(first, pol.eval(first))
+        assert {second.modifymany(d) for d in deltas} == pol.eval(second)
+
+def test_lru_cache():
+    c = util.LRUCache(2)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    c.put('c', 3)
+    assert c.get('b') is None
+    assert c.get('a') == 1 and c.get('c') == 3
+    assert (c.hits, c.misses) == (3, 1)
+    c.clear()
+    assert len(c) == 0
+
+
 # Sequencing
 
 def test_empty_sequential_composition():
@@ -220,6 +592,70 @@ def test_sequencing_match_match():
 def test_empty_parallel_composition():
     assert parallel() == drop
 
+def test_parallel_composition_partitioned():
+    c1 = Classifier(
+        [ Rule(match(switch=s, dstmac=EthAddr('00:00:00:00:00:0%d' % s)),
+               {modify(outport=s)}) for s in [1, 2, 3] ] +
+        [ Rule(match(dstip='10.0.0.0/8'), {modify(outport=9)}),
+          Rule(identity, set()) ])
+    c2 = Classifier(
+        [ Rule(match(switch=s, inport=1), {Controller}) for s in [2, 3, 4] ] +
+        [ Rule(match(inport=2), {identity}),
+          Rule(identity, set()) ])
+    c3 = c1 + c2
+    pkts = _packet_grid(switch=[1, 2, 3, 4], inport=[1, 2],
+                        dstip=['10.0.0.1', '11.0.0.1'],
+                        dstmac=['00:00:00:00:00:0%d' % m for m in [1, 2, 3]])
+    for pkt in pkts:
+        assert c3.eval(pkt) == c1.eval(pkt) | c2.eval(pkt)
+
+def test_parallel_composition_pairwise():
+    pols = [ match(switch=1, inport=i) >> fwd(i % 3 + 1) for i in range(7) ]
+    classifiers = [ p.compile() for p in pols ]
+    folded = reduce(lambda acc, c: acc + c, classifiers)
+    c = parallel(pols).compile()
+    assert _rules_summary(c) == _rules_summary(folded)
+
+def test_incremental_parallel_composition():
+    import pyretic.core.language as language
+    from pyretic.core.language_tools import on_recompile_path_list
+    dyn = DynamicPolicy(match(inport=3) >> fwd(1))
+    pols = [ match(switch=1, inport=i) >> fwd(i % 3 + 1) for i in range(7) ]
+    pol = parallel(pols + [dyn])
+    language.INCREMENTAL = True
+    try:
+        pol.compile()
+        kept = pol._reduction.levels[2][0]
+        dyn.policy = match(inport=4) >> fwd(2)
+        map(lambda p: p.invalidate_classifier(),
+            on_recompile_path_list(id(dyn), pol))
+        c = pol.compile()
+        # only the combinations including dyn's classifier were recomputed
+        assert pol._reduction.levels[2][0] is kept
+    finally:
+        language.INCREMENTAL = False
+    expected = parallel(pols + [dyn.policy]).compile()
+    assert _rules_summary(c) == _rules_summary(expected)
+
+def test_incremental_adopts_replaced_policy():
+    import pyretic.core.language as language
+    done = [ match(srcmac=i) for i in range(5) ]
+    dyn = DynamicFilter(~union(done))
+    language.INCREMENTAL = True
+    try:
+        dyn.compile()
+        reduction = dyn.policy.policies[0]._reduction
+        kept = reduction.levels[2][0]
+        done.append(match(srcmac=5))
+        dyn.policy = ~union(done)
+        dyn.invalidate_classifier()
+        c = dyn.compile()
+        assert dyn.policy.policies[0]._reduction is reduction
+        assert reduction.levels[2][0] is kept
+    finally:
+        language.INCREMENTAL = False
+    assert _rules_summary(c) == _rules_summary((~union(done)).compile())
+
 
 # Intersection
 
@@ -481,6 +917,49 @@ def test_remove_shadow_cover_single():
     print c
     assert c.rules == [Rule(identity, [drop])]
 
+def test_remove_shadow_cover_indexed_matches_linear():
+    c = Classifier([
+        Rule(match(switch=1, dstip='10.0.0.0/16'), {modify(outport=1)}),
+        Rule(match(switch=1, dstip='10.0.1.0/24'), {modify(outport=2)}),
+        Rule(match(switch=1, dstip='10.0.1.0/24', inport=2), set()),
+        Rule(match(switch=2, dstip='10.0.1.0/24'), {modify(outport=3)}),
+        Rule(match(switch=2), {modify(outport=4)}),
+        Rule(match(switch=2, inport=1), set()),
+        Rule(drop, set()),
+        Rule(match(inport=1), {identity}),
+        Rule(identity, set()),
+        Rule(match(inport=2), {identity}) ])
+    assert (c.remove_shadowed_cover_single().rules ==
+            c.remove_shadowed_cover_linear().rules)
+
+def test_remove_shadow_cover_reuses_index():
+    c = Classifier([Rule(match(inport=1), {modify(outport=1)})]).optimize()
+    c.append(Rule(match(inport=1, switch=2), {modify(outport=2)}))
+    c.append(Rule(identity, set()))
+    assert list(c.optimize().rules) == [
+        Rule(match(inport=1), {modify(outport=1)}),
+        Rule(identity, set()) ]
+
+def test_rule_provenance():
+    import pyretic.core.classifier as classifier
+    from pyretic.core.classifier import get_rule_derivation_tree
+    def first_rule():
+        return (match(switch=1) >> fwd(1)).compile().rules[0]
+    try:
+        classifier.PROVENANCE = 'full'
+        r = first_rule()
+        assert len(r.parents) == 2
+        classifier.PROVENANCE = 'ids'
+        r = first_rule()
+        assert r.parents == ()
+        tree = get_rule_derivation_tree(r)
+        assert '[operator sequential]' in tree
+        assert "match: ('switch', 1)" in tree
+    finally:
+        classifier.PROVENANCE = 'off'
+    r = first_rule()
+    assert r.parents == () and r.prov is None
+
 def test_optimize_bug_1():
     classifier = Classifier([
         Rule(match(inport=1), [modify(outport=1)]),
@@ -490,3 +969,555 @@ def test_optimize_bug_1():
     print 'classifier.optimize():'
     print classifier.optimize()
     assert classifier == classifier.optimize()
+
+
+# Forwarding decision diagrams
+
+def test_fdd_shares_equal_subdiagrams():
+    from pyretic.core import fdd
+    def pol():
+        return (match(switch=1) >> fwd(1)) + (match(switch=2) >> fwd(2))
+    d1 = fdd.from_policy(pol())
+    d2 = fdd.from_policy(pol())
+    assert d1 is d2
+    assert fdd.size(d1) == 5
+
+def test_fdd_test_order_ignores_earlier_compiles():
+    from pyretic.core import fdd
+    def order(tests):
+        fdd._test_keys.clear()
+        return sorted(tests, key=fdd.test_key)
+    tests = [('dstport', 80), ('dstport', 22), ('switch', 2), ('switch', 1),
+             ('dstmac', MAC('00:00:00:00:00:02')),
+             ('dstmac', MAC('00:00:00:00:00:01'))]
+    assert order(tests) == order(list(reversed(tests)))
+    size = fdd.TEST_KEYS_SIZE
+    fdd.TEST_KEYS_SIZE = 4
+    try:
+        order(('dstport', p) for p in range(10))
+        assert len(fdd._test_keys) <= 4
+    finally:
+        fdd.TEST_KEYS_SIZE = size
+
+def test_fdd_compilation_matches_eval():
+    from pyretic.core import fdd
+    pol = (if_(match(srcip='10.0.0.0/16'),
+               modify(srcip='10.0.1.1') >> match(srcip='10.0.1.0/24'),
+               ~match(inport=1) >> fwd(2)) +
+           (match(switch=2, dstport=80) >> Controller))
+    c = fdd.compile_policy(pol)
+    for pkt in _packet_grid(switch=[1, 2], inport=[1, 2],
+                            srcip=['10.0.0.1', '10.1.0.1'], dstport=[22, 80]):
+        assert c.eval(pkt) == pol.eval(pkt)
+
+def test_fdd_compiler_switch():
+    import pyretic.core.language as language
+    pol = (match(switch=1) >> fwd(1)) + (match(inport=2) >> fwd(2))
+    expected = pol.compile()
+    language.COMPILER = 'fdd'
+    try:
+        pol.invalidate_classifier()
+        c = pol.compile()
+    finally:
+        language.COMPILER = 'classifier'
+    assert _rules_summary(c) == _rules_summary(expected)
+
+
+# Code generation
+
+def test_codegen_matches_eval():
+    from pyretic.core import codegen
+    pols = [ identity, drop, match(switch=1),
+             ~match(inport=1) >> fwd(2),
+             if_(match(srcip='10.0.0.0/16'),
+                 modify(srcip='10.0.1.1') >> match(srcip='10.0.1.0/24'),
+                 fwd(1) + fwd(3)),
+             (match(switch=2, dstport=80) >> Controller) +
+             ((match(inport=2) + match(dstport=22)) >> fwd(1) >> fwd(2)) ]
+    pkts = _packet_grid(switch=[1, 2], inport=[1, 2],
+                        srcip=['10.0.0.1', '10.1.0.1'], dstport=[22, 80])
+    for pol in pols:
+        evaluate = codegen.evaluator(pol)
+        for pkt in pkts:
+            assert evaluate(pkt) == pol.eval(pkt)
+
+def test_codegen_regenerates_on_dynamic_change():
+    from pyretic.core import codegen
+    dyn = DynamicPolicy(fwd(1))
+    pol = match(switch=1) >> dyn
+    evaluate = codegen.evaluator(pol)
+    pkt = Packet({'switch' : 1, 'inport' : 1})
+    assert evaluate(pkt) == pol.eval(pkt)
+    dyn.policy = fwd(2)
+    assert evaluate(pkt) == pol.eval(pkt)
+    assert evaluate(pkt) == set([pkt.modify(outport=2)])
+
+def test_codegen_falls_back_to_eval():
+    from pyretic.core import codegen
+    b = FwdBucket()
+    pol = (match(inport=1) >> b) + fwd(2)
+    (source, constants) = codegen.generate(pol)
+    assert '.eval(' in source
+    assert b in constants
+    evaluate = codegen.evaluator(pol)
+    for pkt in _packet_grid(switch=[1, 2], inport=[1, 2]):
+        assert evaluate(pkt) == pol.eval(pkt)
+
+
+# Classifier cache
+
+def _cache_network():
+    from pyretic.core.network import Network, Topology, Port
+    topology = Topology()
+    for s in [1, 2]:
+        topology.add_switch(s)
+        topology.node[s]['ports'][1] = Port(1)
+    return Network(topology)
+
+def test_classifier_cache_fingerprint():
+    from pyretic.core.classifier_cache import fingerprint
+    def pol():
+        return (match(srcip='10.0.0.1') >> CountBucket()) + fwd(1)
+    q1, q2 = [], []
+    assert fingerprint(pol(), q1) == fingerprint(pol(), q2)
+    assert len(q1) == 1 and q1[0] is not q2[0]
+    assert fingerprint(pol(), []) != fingerprint(fwd(1) + fwd(2), [])
+
+def test_classifier_cache_round_trip(tmpdir):
+    from pyretic.core.classifier_cache import ClassifierCache
+    cache = ClassifierCache(str(tmpdir))
+    network = _cache_network()
+    def pol():
+        return ((match(srcip='10.0.0.1') >> modify(dstip='10.0.0.2') >> fwd(2))
+                + (match(inport=1) >> Controller)
+                + (match(inport=2) >> CountBucket()))
+    p1 = pol()
+    c = p1.compile()
+    cache.entry(p1, network).store_classifier(c)
+
+    p2 = pol()
+    entry = cache.entry(p2, network)
+    loaded = entry.load_classifier()
+    assert _rules_summary(loaded) == _rules_summary(p2.compile())
+    bucket = entry.queries[0]
+    assert any(bucket in r.actions for r in loaded.rules)
+
+    stored = cache.entry(p1, network)
+    rules = [({'switch': 1}, 60000, [{'outport': 2}, stored.queries[0]])]
+    stored.store_switch_rules(rules)
+    assert entry.load_switch_rules() == \
+        [({'switch': 1}, 60000, [{'outport': 2}, bucket])]
+    assert cache.entry(pol(), Network()).load_classifier() is None
+
+def test_classifier_cache_evicts_least_recently_used(tmpdir):
+    import os
+    from pyretic.core.classifier_cache import ClassifierCache
+    cache = ClassifierCache(str(tmpdir), max_bytes=10000)
+    cache.store('a', 'x' * 1000)
+    cache.store('b', 'y' * 1000)
+    os.utime(cache.path('a'), (0, 0))
+    os.utime(cache.path('b'), (1, 1))
+    assert cache.load('a') == 'x' * 1000   # touches a
+    cache.max_bytes = os.path.getsize(cache.path('a')) * 2
+    cache.store('c', 'z' * 1000)
+    assert cache.load('b') is None
+    assert cache.load('a') is not None and cache.load('c') is not None
+
+def test_classifier_cache_store_failures_are_misses(tmpdir):
+    import os
+    from pyretic.core.classifier_cache import ClassifierCache
+    cache = ClassifierCache(str(tmpdir))
+    cache.store('a', lambda: None)
+    os.mkdir(cache.path('b'))   # the rename onto it fails
+    cache.store('b', 'x')
+    assert cache.load('a') is None
+    assert sorted(os.listdir(str(tmpdir))) == ['b' + cache.SUFFIX]
+
+
+# Policy updates
+
+def _packet_in(switch=1, inport=1, **headers):
+    """ A TCP packet-in, with headers in place of the defaults. """
+    from pyretic.core.network import IP, MAC
+    fields = {'raw' : '', 'ethtype' : 0x800, 'protocol' : 6,
+              'srcmac' : MAC('00:00:00:00:00:01'),
+              'dstmac' : MAC('00:00:00:00:00:02'),
+              'srcip' : '10.0.0.1', 'dstip' : '10.0.0.9',
+              'srcport' : 1000, 'dstport' : 80}
+    fields.update(headers)
+    for field in ['srcip', 'dstip']:
+        fields[field] = IP(fields[field])
+    raw = get_packet_processor().pack(fields)
+    return {'switch' : switch, 'inport' : inport, 'raw' : raw}
+
+class _Switches(object):
+    """
+    A backend keeping the packets sent and the rules installed, which
+    answers barriers at once unless holding them in barriers.
+    """
+    def __init__(self):
+        self.sent = []
+        self.rules = []
+        self.barriers = None
+        self.updates = 0
+
+    def send_packet(self, concrete_pkt):
+        self.sent.append((concrete_pkt['outport'], concrete_pkt['raw']))
+
+    def send_install(self, pred, priority, action_list, cookie, notify=False):
+        self.rules.append((pred, action_list))
+
+    def send_barrier(self, switch, xid=None):
+        if self.barriers is None:
+            self.runtime.handle_barrier_reply(switch, xid)
+        else:
+            self.barriers.append((switch, xid))
+
+def _runtime(pol, mode='interpreted', **kwargs):
+    """
+    A runtime for pol over a _Switches backend, which also counts the
+    runtime's updates of the switch classifiers.
+    """
+    from pyretic.core.runtime import Runtime
+    backend = _Switches()
+    runtime = Runtime(backend, lambda: pol, None, {}, mode=mode, **kwargs)
+    update = runtime.update_switch_classifiers
+    def counted():
+        backend.updates += 1
+        update()
+    runtime.update_switch_classifiers = counted
+    return (runtime, backend)
+
+def test_policy_transaction_coalesces_changes():
+    a = DynamicPolicy(fwd(1))
+    b = DynamicPolicy(fwd(2))
+    (runtime, backend) = _runtime(a + b)
+    a.policy = fwd(3)
+    assert backend.updates == 1
+    with runtime.policy_transaction():
+        a.policy = fwd(4)
+        with runtime.policy_transaction():
+            b.policy = fwd(5)
+        assert backend.updates == 1
+    assert backend.updates == 2
+    with runtime.policy_transaction():
+        pass
+    assert backend.updates == 2
+    pkt = Packet({'switch' : 1, 'inport' : 1})
+    assert runtime.policy.eval(pkt) == (fwd(4) + fwd(5)).eval(pkt)
+
+def test_update_delay_coalesces_changes():
+    a = DynamicPolicy(fwd(1))
+    (runtime, backend) = _runtime(a)
+    runtime.update_delay = 60
+    a.policy = fwd(2)
+    a.policy = fwd(3)
+    assert backend.updates == 0 and runtime.update_timer is not None
+    runtime.flush_policy_update()
+    assert backend.updates == 1 and runtime.update_timer is None
+    runtime.flush_policy_update()
+    assert backend.updates == 1
+
+def test_policy_index_follows_changes():
+    from pyretic.core.language_tools import PolicyIndex, on_recompile_path_list
+    inner = DynamicPolicy(fwd(1))
+    outer = DynamicPolicy(inner >> fwd(2))
+    shared = match(switch=1) >> outer
+    root = shared + (shared >> modify(vlan_id=1))
+    added, removed = [], []
+    index = PolicyIndex(root, added.append, removed.append)
+    assert set(added) == {inner, outer}
+    for p in [inner, outer]:
+        assert (set(map(id, index.ancestors(p))) ==
+                set(map(id, on_recompile_path_list(id(p), root))))
+    other = DynamicPolicy(fwd(3))
+    outer.policy = other
+    index.update(outer)
+    assert removed == [inner] and added[-1] is other
+    assert not inner in index and other in index
+    assert index.ancestors(inner) == []
+    assert set(map(id, index.ancestors(other))) == \
+        set(map(id, on_recompile_path_list(id(other), root)))
+
+def test_policy_index_reindexes_only_changed_table_entries():
+    from pyretic.core.language_tools import PolicyIndex
+    table = match_table(['dstmac'], fwd(9))
+    root = table >> fwd(1)
+    added, removed = [], []
+    index = PolicyIndex(root, added.append, removed.append)
+    operations = []
+    for name in ['add', 'remove']:
+        def counted(child, parent, op=getattr(index, name)):
+            operations.append(child)
+            op(child, parent)
+        setattr(index, name, counted)
+    for i in range(50):
+        table.add((i,), DynamicPolicy(fwd(i)))
+        index.update(table)
+    assert len(operations) == 50 and len(added) == 51
+    first = table.table[(0,)]
+    del operations[:]
+    table.add((0,), fwd(2))
+    index.update(table)
+    table.remove((1,))
+    index.update(table)
+    assert len(operations) == 3
+    assert removed == [first, added[2]] and not first in index
+    assert index.ancestors(table.table[(2,)])
+    table.policy = drop
+    index.update(table)
+    assert len(removed) == 50 and set(index.dynamic_sub_pols()) == {table}
+
+def test_runtime_attaches_new_dynamic_sub_policies():
+    inner = DynamicPolicy(fwd(1))
+    outer = DynamicPolicy(drop)
+    (runtime, backend) = _runtime(outer + fwd(2))
+    outer.policy = inner
+    assert runtime.dynamic_sub_pols == {outer, inner}
+    inner.policy = fwd(3)
+    assert backend.updates == 2
+    outer.policy = drop
+    assert runtime.dynamic_sub_pols == {outer} and inner.notify is None
+
+def test_interpret_reads_snapshot_without_lock():
+    import threading
+    a = DynamicPolicy(fwd(1))
+    (runtime, backend) = _runtime(a)
+    pkt = Packet({'switch' : 1, 'inport' : 1})
+    first = runtime.snapshot
+    held = threading.Event()
+    release = threading.Event()
+    def compiling():
+        with runtime.policy_lock:
+            # as when compiling after a topology change
+            runtime.in_network_update = True
+            held.set()
+            release.wait()
+            runtime.in_network_update = False
+    compiler = threading.Thread(target=compiling)
+    compiler.start()
+    held.wait()
+    results = []
+    reader = threading.Thread(target=lambda: results.append(
+        runtime.interpret(pkt)))
+    reader.start()
+    reader.join(10)
+    release.set()
+    compiler.join()
+    assert results == [(set(), fwd(1).eval(pkt))]
+    a.policy = fwd(2)
+    assert runtime.snapshot.version > first.version
+    assert runtime.snapshot.eval_cache is not first.eval_cache
+    assert runtime.interpret(pkt) == (set(), fwd(2).eval(pkt))
+    assert len(first.eval_cache) == 1
+
+def test_interpret_sees_transactions_whole():
+    import threading
+    a = DynamicPolicy(fwd(1))
+    b = DynamicPolicy(fwd(1))
+    (runtime, backend) = _runtime(match(switch=1) >> (a + b))
+    pkt = Packet({'switch' : 1, 'inport' : 1})
+    halfway = threading.Event()
+    release = threading.Event()
+    def transaction():
+        with runtime.policy_transaction():
+            a.policy = fwd(2)
+            halfway.set()
+            release.wait()
+            b.policy = fwd(2)
+    writer = threading.Thread(target=transaction)
+    writer.start()
+    halfway.wait()
+    results = []
+    reader = threading.Thread(target=lambda: results.append(
+        runtime.interpret(pkt)))
+    reader.start()
+    reader.join(0.2)
+    # the reader waits for the transaction rather than see half of it
+    assert results == []
+    release.set()
+    writer.join()
+    reader.join()
+    assert results == [(set(), fwd(2).eval(pkt))]
+
+
+# Packet-in workers
+
+def test_packet_in_workers_match_serial_evaluation():
+    pkts = [_packet_in(srcip='10.0.0.%d' % (i % 4 + 1), tos=i)
+            for i in range(40)]
+    def run(workers):
+        heard = []
+        bucket = FwdBucket()
+        bucket.register_callback(lambda pkt: heard.append(pkt['tos']))
+        routing = DynamicPolicy(fwd(2))
+        pol = (match(srcip='10.0.0.1') >> bucket) + routing
+        (runtime, backend) = _runtime(pol, workers=workers)
+        for pkt in pkts[:20]:
+            runtime.handle_packet_in(pkt)
+        if runtime.packet_pool is not None:
+            # the packets reaching the bucket are handed back to the runtime,
+            # which evaluates them with the policy of the time
+            runtime.packet_pool.stop()
+        routing.policy = fwd(3)
+        for pkt in pkts[20:]:
+            runtime.handle_packet_in(pkt)
+        if runtime.packet_pool is not None:
+            runtime.packet_pool.stop()
+        return (backend.sent, heard)
+    (serial_sent, serial_heard) = run(0)
+    (sent, heard) = run(2)
+    assert heard == serial_heard == range(0, 40, 4)
+    assert len(sent) == 40 and sorted(sent) == sorted(serial_sent)
+    assert [outport for (outport, raw) in sorted(sent)] == [2] * 20 + [3] * 20
+    unpack = get_packet_processor().unpack
+    flows = {}
+    for (outport, raw) in sent:
+        h = unpack(raw)
+        flows.setdefault(h['srcip'], []).append(h['tos'])
+    assert all(tos == sorted(tos) for tos in flows.values())
+
+def test_packet_in_workers_leave_queries_to_runtime():
+    from pyretic.lib.query import count_packets
+    counter = count_packets(3600)
+    pol = (match(inport=1) >> counter) + fwd(2)
+    (runtime, backend) = _runtime(pol, workers=2)
+    runtime.packet_pool.start()
+    for i in range(10):
+        runtime.handle_packet_in(_packet_in(srcport=1000 + i))
+    runtime.packet_pool.stop()
+    assert counter.aggregate == 10
+
+def test_packet_in_workers_refork_at_most_once_per_interval():
+    pkts = [_packet_in(srcip='10.0.0.%d' % (i % 10 + 1), dstip='10.0.0.99',
+                       tos=i)
+            for i in range(50)]
+    def run(workers):
+        # a learning policy: each new source changes it
+        bucket = FwdBucket()
+        learned = match_table(['srcip'], bucket)
+        bucket.register_callback(
+            lambda pkt: learned.add((pkt['srcip'],), fwd(2)))
+        (runtime, backend) = _runtime(learned, workers=workers)
+        if runtime.packet_pool is not None:
+            runtime.packet_pool.refork_interval = 3600
+            runtime.packet_pool.start()
+        for pkt in pkts:
+            runtime.handle_packet_in(pkt)
+        if runtime.packet_pool is not None:
+            runtime.packet_pool.stop()
+            assert runtime.packet_pool.forks == 1
+        return backend.sent
+    serial = run(0)
+    assert len(serial) == 40
+    assert sorted(run(2)) == sorted(serial)
+
+
+# Megaflows
+
+def test_eval_with_reads_finds_fields_looked_at():
+    from pyretic.core.language_tools import eval_with_reads
+    pol = (if_(match(dstip='10.0.0.0/24'), fwd(1), match(srcport=80) >> fwd(2))
+           >> (match(outport=1) >> modify(tos=3)))
+    near = Packet({'switch' : 1, 'inport' : 2, 'dstip' : IP('10.0.0.5'),
+                   'srcport' : 80, 'tos' : 0})
+    (output, reads, written) = eval_with_reads(pol, near)
+    assert output == pol.eval(near)
+    assert reads == {'dstip'} and written == {'outport', 'tos'}
+    far = near.modify(dstip=IP('10.1.0.5'))
+    (output, reads, written) = eval_with_reads(pol, far)
+    assert output == pol.eval(far) == set()
+    assert reads == {'dstip', 'srcport'} and written == {'outport'}
+
+def test_reactive0_installs_megaflows():
+    pol = (if_(match(dstip='10.0.0.0/24'), fwd(1), fwd(2)) +
+           (match(dstport=22) >> modify(tos=4) >> fwd(3)))
+    (runtime, backend) = _runtime(pol, mode='reactive0')
+    def packet_in(srcport, dstport):
+        runtime.handle_packet_in(
+            _packet_in(inport=4, srcip='10.1.0.1', dstip='10.0.0.7',
+                       srcport=srcport, dstport=dstport))
+        return backend.rules.pop()
+    (pred, actions) = packet_in(1000, 80)
+    assert pred == {'switch' : 1, 'inport' : 4, 'ethtype' : 0x800,
+                    'protocol' : 6, 'dstip' : IP('10.0.0.7'), 'dstport' : 80}
+    assert actions == [{'outport' : 1}]
+    (pred, actions) = packet_in(1000, 22)
+    assert sorted(pred) == ['dstip', 'dstport', 'ethtype', 'inport',
+                            'protocol', 'switch', 'tos']
+    assert sorted(actions) == [{'outport' : 1}, {'outport' : 3, 'tos' : 4}]
+    runtime.megaflows = False
+    (pred, actions) = packet_in(1000, 80)
+    assert pred['srcport'] == 1000 and pred['srcip'] == IP('10.1.0.1')
+
+def test_reactive0_evaluates_packet_ins_once():
+    evaluations = []
+    class counted(DynamicPolicy):
+        def eval(self, pkt):
+            evaluations.append(pkt)
+            return self.policy.eval(pkt)
+    pol = match(dstip='10.0.0.7') >> fwd(1)
+    (runtime, backend) = _runtime(counted(pol), mode='reactive0')
+    def packet_in(srcport):
+        runtime.handle_packet_in(
+            _packet_in(inport=4, srcip='10.1.0.1', dstip='10.0.0.7',
+                       srcport=srcport))
+    def preds():
+        return [pred for (pred, actions) in backend.rules]
+    packet_in(1000)
+    assert len(evaluations) == 1
+    megaflow = {'switch' : 1, 'inport' : 4, 'ethtype' : 0x800,
+                'dstip' : IP('10.0.0.7')}
+    assert preds() == [megaflow]
+    # packets the evaluation cache answers get the megaflow all the same
+    (runtime, backend) = _runtime(pol, mode='reactive0')
+    packet_in(1000)
+    packet_in(1001)
+    assert runtime.snapshot.eval_cache.hits == 1
+    assert preds() == [megaflow] * 2
+
+def test_reactive0_reuses_inflight_installs():
+    pol = (match(dstip='10.0.0.7') >> fwd(2)) + (match(dstip='10.0.0.8') >> fwd(3))
+    (runtime, backend) = _runtime(pol, mode='reactive0')
+    backend.barriers = []
+    evaluated = []
+    interpret = runtime.interpret
+    def counted(pkt, *args):
+        evaluated.append(pkt)
+        return interpret(pkt, *args)
+    runtime.interpret = counted
+    lookups = []
+    inflight_install = runtime.inflight_install
+    def looked_up(pkt):
+        lookups.append(pkt)
+        return inflight_install(pkt)
+    runtime.inflight_install = looked_up
+    def packet_in(srcport, dstip='10.0.0.7'):
+        runtime.handle_packet_in(
+            _packet_in(inport=4, srcip='10.1.0.1', dstip=dstip,
+                       srcport=srcport))
+    def outports():
+        return [outport for (outport, raw) in backend.sent]
+    # packets reaching the controller before the rule installed for them
+    # reached the switch are forwarded as the rule will, and install nothing
+    packet_in(1000)
+    assert len(backend.rules) == 1 and len(backend.barriers) == 1
+    packet_in(1000)
+    packet_in(1001)
+    assert len(backend.rules) == 1 and len(evaluated) == 1
+    assert outports() == [2, 2, 2]
+    packet_in(1000, '10.0.0.8')
+    assert len(backend.rules) == 2 and len(evaluated) == 2
+    assert outports()[-1] == 3
+    # once the switch answered the barrier, packet-ins are evaluated again
+    runtime.handle_barrier_reply(*backend.barriers[0])
+    packet_in(1000)
+    assert len(backend.rules) == 3 and len(evaluated) == 3
+    packet_in(1001, '10.0.0.8')
+    assert len(backend.rules) == 3 and len(evaluated) == 3
+    runtime.inflight_timeout = 0
+    packet_in(1002, '10.0.0.9')
+    packet_in(1002, '10.0.0.9')
+    assert len(backend.rules) == 5 and len(backend.barriers) == 3
+    # each packet-in looks for an install on its way once
+    assert len(lookups) == 8